@@ -6,6 +6,8 @@ This code will apply Particle Filter on BusSim, requires model BusSim_static.py
 import numpy as np
 import matplotlib.pyplot as plt
 import pickle
+import sys
+sys.path.append('../stationsim')
 
 #Comment/Uncomment the model that you want to evaluate here:
 
@@ -14,6 +14,9 @@ save requests: true_state
 import numpy as np
 from copy import deepcopy
 import matplotlib.pyplot as plt
+# resampling and likelihoods are in stationsim (on the path of the launcher)
+from resampling import systematic
+from likelihoods import InverseDistanceLikelihood
 
 class ParticleFilter:
     '''
@@ -31,8 +34,11 @@ class ParticleFilter:
     'do_save': Boolean to determine if data should be saved and stats printed
     'do_ani': Boolean to determine if particle filter data should be animated
         and displayed
+    'likelihood': The observation likelihood (see likelihoods.py), by default
+        1/distance
     '''
-    def __init__(self, model, number_of_particles, arr_std=0,dep_std=0, traffic_std=0, resample_window=10, do_copies=True, do_save=False):
+    def __init__(self, model, number_of_particles, arr_std=0,dep_std=0, traffic_std=0, resample_window=10, do_copies=True, do_save=False,
+                 likelihood=None):
         '''
         Initialise Particle Filter
 
@@ -64,6 +70,9 @@ class ParticleFilter:
         self.dep_std = dep_std
         self.traffic_std=traffic_std
         self.resample_window = resample_window
+        if likelihood is None:
+            likelihood = InverseDistanceLikelihood(power=1, offset=0)
+        self.likelihood = likelihood
         # Save
         self.do_save = do_save
         if self.do_save:
@@ -97,18 +106,11 @@ class ParticleFilter:
 
         Add noise to the base model state to get a measured state. Calculate
         the distance between the particle states and the measured base model
-        state and then calculate the new particle weights as 1/distance.
-        Add a small term to avoid dividing by 0. Normalise the weights.
+        state and then calculate the new particle weights from the
+        likelihood (1/distance by default), normalised in log space.
         '''
-        
-        states = self.states[:, :len(measured_state)]  # For shorter measurements to state vectors
-        
-        #print(states)
-        distance = np.linalg.norm(states - measured_state, axis=1)  #Frobenius norm
-        #print(distance)
-        self.weights = 1 / np.fmax(distance, 1e-99)  # to avoid fp_err
-        #self.weights = np.exp(-np.fmax(distance, 1e-99))  # to avoid fp_err
-        self.weights /= np.sum(self.weights)
+        # The likelihood compares shorter measurements to the start of the state vectors
+        self.weights = np.exp(self.likelihood.log_weights(self.states, measured_state))
         #print(self.weights)
         return 
 
@@ -116,23 +118,13 @@ class ParticleFilter:
         '''
         Resample
 
-        Calculate a random partition of (0,1) and then
-        take the cumulative sum of the particle weights.
-        Carry out a systematic resample of particles.
+        Choose the particles to keep with a systematic
+        resample of the particle weights (see resampling.py).
         Set the new particle states and weights and then
         update agent locations in particle models.
         '''
         if not self.time % self.resample_window:
-            offset = (np.arange(self.number_of_particles) + np.random.uniform()) / self.number_of_particles
-            cumsum = np.cumsum(self.weights)
-            i, j = 0, 0
-            indexes = np.zeros(self.number_of_particles, 'i')
-            while i < self.number_of_particles and j < self.number_of_particles:
-                if offset[i] < cumsum[j]:  # reject
-                    indexes[i] = j
-                    i += 1
-                else:
-                    j += 1
+            indexes = systematic(self.weights, np.random)
             self.states = self.states[indexes]
             #print(self.states)
             self.weights = self.weights[indexes]
@@ -6,6 +6,7 @@ Particle Filter - external data version
 #import sys
 from filter import Filter
 from stationsim_density_model import Model
+from resampling import systematic
 import numpy as np
 import matplotlib.pyplot as plt
 from copy import deepcopy
@@ -456,23 +457,14 @@ class ParticleFilter(Filter):
         Resample
 
         DESCRIPTION
-        Calculate a random partition of (0,1) and then
-        take the cumulative sum of the particle weights.
-        Carry out a systematic resample of particles.
+        Choose the particles to keep with a systematic
+        resample of the particle weights (see resampling.py).
         Set the new particle states and weights and then
         update agent locations in particle models using
         multiprocessing methods.
         '''
-        offset_partition = ((np.arange(self.number_of_particles)
-                             + np.random.uniform()) / self.number_of_particles)
-        cumsum = np.cumsum(self.weights)
-        i, j = 0, 0
-        while i < self.number_of_particles:
-            if offset_partition[i] < cumsum[j]:
-                self.indexes[i] = j
-                i += 1
-            else:
-                j += 1
+        # The particle models use the global numpy generator
+        self.indexes[:] = systematic(self.weights, np.random)
 
         self.states[:] = self.states[self.indexes]
         self.weights[:] = self.weights[self.indexes]
@@ -13,6 +13,9 @@ Particle Filter - external data version
 #import sys
 from filter import Filter
 from stationsim_density_model_temper import Model
+from resampling import systematic
+from likelihoods import get_likelihood
+from tempering import AdaptiveTempering, metropolis_accept
 import numpy as np
 import matplotlib.pyplot as plt
 from copy import deepcopy
@@ -58,6 +61,17 @@ class ParticleFilter(Filter):
                                     or internally (False). The third element is a boolean to determine 
                                     whether it is to determine the gate_out using external data (True) 
                                     or internally (False).
+         - tempering:               How to bring in each observation: 'fixed' (default, reweight with
+                                    dfactor 5, 4, 3, 2, 1, each followed by one Monte Carlo step),
+                                    'adaptive' (the temperatures and Monte Carlo moves chosen by an
+                                    AdaptiveTempering, see stationsim/tempering.py) or an
+                                    AdaptiveTempering object.
+         - likelihood:              The observation likelihood of adaptive tempering (see
+                                    stationsim/likelihoods.py): 'inverse_distance' (default,
+                                    1/distance**2), 'gaussian' or 'student_t' (with the observation
+                                    and particle noise as standard deviation), or a Likelihood object.
+                                    1/distance**2 is too flat to tell the particles apart at the
+                                    lower temperatures (use 'gaussian').
         DESCRIPTION
         Firstly, set all attributes using filter parameters. Set time and
         initialise base model using model parameters. Initialise particle
@@ -94,6 +108,23 @@ class ParticleFilter(Filter):
         if not self.do_resample:
             print("**Warning**: Not resampling. This should only be used for benchmarking")
 
+        try:
+            self.tempering
+        except AttributeError:
+            self.tempering = 'fixed'
+        try:
+            self.likelihood
+        except AttributeError:
+            self.likelihood = 'inverse_distance'
+        if self.likelihood in ('gaussian', 'student_t'):
+            self.likelihood = get_likelihood(self.likelihood,
+                                             std=np.hypot(self.model_std ** 2, self.particle_std ** 2))
+        else:
+            self.likelihood = get_likelihood(self.likelihood)
+
+        if self.tempering == 'adaptive':
+            self.tempering = AdaptiveTempering()
+
         ## We get problems when there are more processes than particles (larger particle variance for some reason)
         #if numcores > self.number_of_particles:
         #    numcores = self.number_of_particles
@@ -294,12 +325,15 @@ class ParticleFilter(Filter):
 
 
                         if self.do_resample: # Can turn off resampling for benchmarking                            
-                            dfactors=list(range(1,6))
-                            dfactors.reverse()
-                            for i in dfactors:
-                                self.reweight(dfactor=i)
-                                self.resample()
-                                self.predict_mc(numiter=1)
+                            if self.tempering == 'fixed':
+                                dfactors=list(range(1,6))
+                                dfactors.reverse()
+                                for i in dfactors:
+                                    self.reweight(dfactor=i)
+                                    self.resample()
+                                    self.predict_mc(numiter=1)
+                            else:
+                                self.temper()
                             weightdf=pd.DataFrame(list(self.weights))
                             self.weight_hist = pd.concat([self.weight_hist,weightdf],axis=1)
 
@@ -538,28 +572,59 @@ class ParticleFilter(Filter):
         
         return
 
+    def temper(self):
+        '''
+        Temper
+
+        DESCRIPTION
+        Bring in the measured state of this window at the temperatures
+        chosen by self.tempering (see tempering.AdaptiveTempering), with
+        self.likelihood. At each one the particles are reweighted,
+        resampled and moved with Monte Carlo steps (predict_mc); the
+        particles whose move the tempered likelihood rejects go back to the
+        state they had before it (a snapshot of what step_mc changes, not
+        only the locations). The stages and moves of each window are kept
+        in self.tempering.
+        '''
+        if self.do_external_data: 
+            measured_state = self.base_model.get_state(sensor='location')
+        else:        
+            measured_state = (self.base_model.get_state(sensor='location')
+                              + np.random.normal(0, self.model_std ** 2, size=self.states.shape))
+
+        def resample(weights):
+            self.weights = weights
+            self.resample()
+            return self.indexes
+
+        def move(temperature, log_likelihood):
+            # The whole particles, as step_mc can change more than the locations
+            states = self.states.copy()
+            snapshots = [model.snapshot() for model in self.models]
+            self.predict_mc(numiter=1)
+            proposed = self.likelihood.log_likelihood(self.states, measured_state)
+            accept = metropolis_accept(log_likelihood, proposed, temperature, np.random)
+            for i in np.flatnonzero(~accept):
+                self.states[i] = states[i]
+                self.models[i].restore(snapshots[i])
+            return accept, np.where(accept, proposed, log_likelihood)
+
+        log_likelihood = self.likelihood.log_likelihood(self.states, measured_state)
+        self.weights = np.exp(self.tempering.temper(log_likelihood, resample, move))
+
     def resample(self):
         '''
         Resample
 
         DESCRIPTION
-        Calculate a random partition of (0,1) and then
-        take the cumulative sum of the particle weights.
-        Carry out a systematic resample of particles.
+        Choose the particles to keep with a systematic
+        resample of the particle weights (see resampling.py).
         Set the new particle states and weights and then
         update agent locations in particle models using
         multiprocessing methods.
         '''
-        offset_partition = ((np.arange(self.number_of_particles)
-                             + np.random.uniform()) / self.number_of_particles)
-        cumsum = np.cumsum(self.weights)
-        i, j = 0, 0
-        while i < self.number_of_particles:
-            if offset_partition[i] < cumsum[j]:
-                self.indexes[i] = j
-                i += 1
-            else:
-                j += 1
+        # The particle models use the global numpy generator
+        self.indexes[:] = systematic(self.weights, np.random)
 
         self.states[:] = self.states[self.indexes]
         self.weights[:] = self.weights[self.indexes]
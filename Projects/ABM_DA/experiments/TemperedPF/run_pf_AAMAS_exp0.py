@@ -7,6 +7,7 @@
 # Need to append the main project directory (ABM_DA) and stationsim folders to the path, otherwise either
 # this script will fail, or the code in the stationsim directory will fail.
 import sys
+sys.path.append('../../stationsim')
 #from particle_filter_AAMAS import ParticleFilter
 from particle_filter_AAMAS_temmper import ParticleFilter
 #from stationsim_density_model import Model
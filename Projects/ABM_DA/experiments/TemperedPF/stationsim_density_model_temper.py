@@ -526,8 +526,44 @@ class Model:
 
         [agent.monte_step() for agent in self.agents]
 
-
-
+    def snapshot(self):
+        '''
+        Save what a Monte Carlo step (step_mc) can change: the status,
+        location and start of every agent, the population counts and the
+        lengths of the lists of finished agents. Much cheaper than
+        deepcopy of the model.
+        '''
+        snapshot = {
+            'agents': [(agent.status, agent.location,
+                        getattr(agent, 'step_start', None),
+                        getattr(agent, 'loc_start', None))
+                       for agent in self.agents],
+            'pop_active': self.pop_active,
+            'pop_finished': self.pop_finished}
+        if self.do_history:
+            snapshot['lengths'] = (len(self.steps_exped),
+                                   len(self.steps_taken),
+                                   len(self.steps_delay))
+        return snapshot
+
+    def restore(self, snapshot):
+        '''
+        Go back to a snapshot.
+        '''
+        for agent, (status, location, step_start, loc_start) in zip(
+                self.agents, snapshot['agents']):
+            agent.status = status
+            agent.location = location
+            agent.step_start = step_start
+            if loc_start is not None:
+                agent.loc_start = loc_start
+        self.pop_active = snapshot['pop_active']
+        self.pop_finished = snapshot['pop_finished']
+        if self.do_history:
+            for history, length in zip((self.steps_exped, self.steps_taken,
+                                        self.steps_delay),
+                                       snapshot['lengths']):
+                del history[length:]
 
     # State
     def get_state(self, sensor=None):
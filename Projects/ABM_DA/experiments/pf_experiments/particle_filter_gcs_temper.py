@@ -8,13 +8,18 @@ Created on Mon Jun 29 13:04:26 2020
 #import sys
 from filter import Filter
 from stationsim_gcs_model import Model
+from gct_observations import ObservationStore
+from shared_arrays import SharedArray
+from resampling import systematic, log_normalise
+from likelihoods import get_likelihood
+from tempering import AdaptiveTempering, metropolis_accept
 import numpy as np
 import matplotlib.pyplot as plt
-from copy import deepcopy
 import multiprocessing
 import warnings
 import itertools
 import time
+import os
 
 
 class ParticleFilter(Filter): 
@@ -52,10 +57,22 @@ class ParticleFilter(Filter):
                                     or internally (False). The third element is a boolean to determine 
                                     whether it is to determine the gate_out using external data (True) 
                                     or internally (False).
+        - likelihood:               The observation likelihood (see likelihoods.py): 'inverse_distance'
+                                    (default, 1/distance**2 over all the agents), 'gaussian' or
+                                    'student_t' (over the active agents of the base model, with the
+                                    observation and particle noise as standard deviation), or a
+                                    Likelihood object.
+        - tempering:                How to bring in each observation: 'fixed' (default, reweight with
+                                    dfactor 5, 4, 3, 2, 1, each followed by one Monte Carlo step),
+                                    'adaptive' (the temperatures and Monte Carlo moves chosen by an
+                                    AdaptiveTempering, see tempering.py) or an AdaptiveTempering object.
+                                    Adaptive tempering needs the Monte Carlo moves of Model.step_mc,
+                                    and a likelihood that is not as flat as 1/distance**2 (use
+                                    'gaussian').
         DESCRIPTION
         Firstly, set all attributes using filter parameters. Set time and
         initialise base model using model parameters. Initialise particle
-        models using a deepcopy of base model. Determine particle filter 
+        models as copies of the base model. Determine particle filter 
         dimensions, initialise all remaining arrays, and set initial
         particle states to the base model state using multiprocessing. 
         '''
@@ -64,14 +81,24 @@ class ParticleFilter(Filter):
         self.time = 0
         self.number_of_iterations = model_params['batch_iterations']
         self.base_model = ModelClass(**model_params) # (Model does not need a unique id)
-        self.models = list([deepcopy(self.base_model) for _ in range(self.number_of_particles)])
-        # To store the final result
-        self.estimate_model = ModelClass(**model_params)
+        self.models = [self.base_model.copy() for _ in range(self.number_of_particles)]
+        # To store the final result (with its history in a directory of its
+        # own, so it does not truncate the files of the base model)
+        estimate_params = dict(model_params)
+        if model_params.get('history_dir') is not None:
+            estimate_params['history_dir'] = os.path.join(
+                model_params['history_dir'], 'estimate')
+        self.estimate_model = ModelClass(**estimate_params)
         if self.do_external_data:
+            self.observations = ObservationStore.open(self.external_info[0])
             self.set_initial_conditions()
         self.dimensions = len(self.base_model.get_state(sensor='location'))
-        self.states = np.zeros((self.number_of_particles, self.dimensions))
-        self.weights = np.ones(self.number_of_particles)
+        # The states and weights live in shared memory (see particle_filter_gcs)
+        self.shared_states = SharedArray((self.number_of_particles, self.dimensions))
+        self.shared_weights = SharedArray(self.number_of_particles)
+        self.states = self.shared_states.array
+        self.weights = self.shared_weights.array
+        self.weights[:] = 1
         self.indexes = np.zeros(self.number_of_particles, 'i')
         self.window_counter = 0 # Just for printing the progress of the PF
         # Pool object needed for multiprocessing
@@ -86,6 +113,23 @@ class ParticleFilter(Filter):
         if not self.do_resample:
             print("**Warning**: Not resampling. This should only be used for benchmarking")
 
+        try:
+            self.tempering
+        except AttributeError:
+            self.tempering = 'fixed'
+        try:
+            self.likelihood
+        except AttributeError:
+            self.likelihood = 'inverse_distance'
+        if self.likelihood in ('gaussian', 'student_t'):
+            self.likelihood = get_likelihood(self.likelihood,
+                                             std=np.hypot(self.model_std ** 2, self.particle_std ** 2))
+        else:
+            self.likelihood = get_likelihood(self.likelihood)
+
+        if self.tempering == 'adaptive':
+            self.tempering = AdaptiveTempering()
+
         ## We get problems when there are more processes than particles (larger particle variance for some reason)
         #if numcores > self.number_of_particles:
         #    numcores = self.number_of_particles
@@ -103,7 +147,8 @@ class ParticleFilter(Filter):
 
         #print("Creating initial states ... ")
         base_model_state = self.base_model.get_state(sensor='location')
-        self.states = np.array([ self.initial_state(i, base_model_state) for i in range(self.number_of_particles )])
+        for i in range(self.number_of_particles):
+            self.initial_state(i, base_model_state)
         #print("\t ... finished")
         print("Running filter with {} particles and {} runs (on {} cores) with {} agents.".format(
             filter_params['number_of_particles'], filter_params['number_of_runs'], numcores, model_params["pop_total"]),
@@ -125,23 +170,21 @@ class ParticleFilter(Filter):
          self.external_info[1]: boolean to use speed
          self.external_info[2]: boolean to use gate_out
         '''
-        file_name = self.external_info[0] + 'activation.dat'
-        ID, time, gateIn, gateOut, speed_ = np.loadtxt(file_name,unpack=True)
-        for i in range(self.base_model.pop_total):
-            self.base_model.agents[i].steps_activate = time[i]
-            self.estimate_model.agents[i].step_start = time[i]
-            self.base_model.agents[i].gate_in = int(gateIn[i])
-            for model in self.models:
-                model.agents[i].steps_activate = time[i]
-                model.agents[i].gate_in = int(gateIn[i])
+        ID, time, gateIn, gateOut, speed_ = np.array(self.observations.activation).T
+        n = self.base_model.pop_total
+        time, gateIn, gateOut, speed_ = time[:n], gateIn[:n].astype(int), gateOut[:n].astype(int), speed_[:n]
+        for agent, t in zip(self.estimate_model.agents, time):
+            agent.step_start = t
+        if self.external_info[2]:
+            loc_desire = self.base_model.get_gate_locations(gateOut, self.base_model.agents_size[:n])
+        for model in [self.base_model] + self.models:
+            model.agents_steps_activate[:n] = time
+            model.activation_queue = None
+            model.agents_gate_in[:n] = gateIn
             if self.external_info[1]:
-                self.base_model.agents[i].speed = speed_[i]
-                for model in self.models:
-                    model.agents[i].speed = speed_[i]
+                model.agents_speed[:n] = speed_
             if self.external_info[2]:
-                self.base_model.agents[i].loc_desire = self.base_model.agents[i].set_agent_location(int(gateOut[i]))
-                for model in self.models:
-                    model.agents[i].loc_desire = self.base_model.agents[i].loc_desire
+                model.agents_loc_desire[:n] = loc_desire
 
         '''
          If the speed is not obteined from external data, generate new speeds
@@ -149,12 +192,7 @@ class ParticleFilter(Filter):
         '''
         if not self.external_info[1]:
             for model in self.models:
-                for agent in model.agents:
-                    speed_max = 0
-                    while speed_max <= model.speed_min:
-                        speed_max = np.random.normal(model.speed_mean, model.speed_std)
-                    agent.speeds = np.arange(speed_max, model.speed_min, - model.speed_step)
-                    agent.speed = np.random.choice((agent.speeds))
+                model.set_speeds()
 
         '''
          If the gate_out is not obteined from external data, generate new 
@@ -162,9 +200,7 @@ class ParticleFilter(Filter):
         '''
         if not self.external_info[2]:
             for model in self.models:
-                for agent in model.agents:
-                    agent.set_gate_out()
-                    agent.loc_desire = agent.set_agent_location(agent.gate_out)
+                model.set_gates_out()
 
 
     @classmethod
@@ -194,7 +230,8 @@ class ParticleFilter(Filter):
         return model
 
     @classmethod
-    def step_particle(cls, particle_num: int, model: Model, num_iter: int, particle_std: float, particle_shape: tuple):
+    def step_particle(cls, particle_num: int, model: Model, num_iter: int, particle_std: float, particle_shape: tuple,
+                      states: SharedArray = None):
         """
         Step a particle, assign the locations of the
         agents to the particle state with some noise, and
@@ -206,6 +243,8 @@ class ParticleFilter(Filter):
         :param num_iter: The number of iterations to step
         :param particle_std: the particle noise standard deviation
         :param particle_shape: the shape of the particle array
+        :param states: the shared states of the filter (optional). If given, the particle state is
+            written in row particle_num instead of being returned
         """
         # Force the model to re-seed its random number generator (otherwise each child process
         # has the same generator https://stackoverflow.com/questions/14504866/python-multiprocessing-numpy-random
@@ -216,6 +255,9 @@ class ParticleFilter(Filter):
         noise = np.random.normal(0, particle_std ** 2, size=particle_shape)
         state = model.get_state(sensor='location') + noise
         model.set_state(state, sensor='location')
+        if states is not None:
+            states.array[particle_num] = state
+            state = None
         return model, state
     
     
@@ -302,13 +344,16 @@ class ParticleFilter(Filter):
                             self.save(before=True)
 
                         if self.do_resample: # Can turn off resampling for benchmarking
-                            dfactors=list(range(1,6))
-                            dfactors.reverse()
-                            for i in dfactors:
-                                print('starting reweight')
-                                self.reweight(i)
-                                self.resample()
-                                self.predict_mc(1)
+                            if self.tempering == 'fixed':
+                                dfactors=list(range(1,6))
+                                dfactors.reverse()
+                                for i in dfactors:
+                                    print('starting reweight')
+                                    self.reweight(i)
+                                    self.resample()
+                                    self.predict_mc(1)
+                            else:
+                                self.temper()
 
    
 
@@ -373,6 +418,8 @@ class ParticleFilter(Filter):
 
         finally: # Whatever happens, make sure the multiprocessing pool is colsed
             self.pool.close()
+            self.shared_states.close()
+            self.shared_weights.close()
 
     def predict(self, numiter=1):
         '''
@@ -394,49 +441,8 @@ class ParticleFilter(Filter):
         if self.do_external_data:
             for i in range(numiter):
                 time = time + 1
-                file_name = self.external_info[0] + 'frame_' + str(time)+ '.0.dat'
-                try:
-                    agentID, x, y = np.loadtxt(file_name,unpack=True)
-                    j = 0
-                    for agent in self.base_model.agents:
-                        if (agent.unique_id in agentID):
-                            
-                            agent.status = 1
-                            agent.location = [x[j], y[j]]
-                            j += 1
-                        elif (agent.status == 1):
-                            agent.status = 2
-                except TypeError:
-                    '''
-                    This error occurs when only one agent is active. In
-                    this case, the data is read as a float instead of an
-                    array.
-                    '''
-                    for agent in self.base_model.agents:
-                        if (agent.unique_id == agentID):
-                            agent.status = 1
-                            agent.location = [x, y]
-                        elif (agent.status == 1):
-                            agent.status = 2
-                except ValueError:
-                    '''
-                     This error occurs when there is no active agent in
-                     the frame.
-                     - Deactivate all active agents.
-                    '''
-                    for agent in self.base_model.agents:
-                        if (agent.status == 1):
-                            agent.status = 2
-
-                except OSError:
-                    '''
-                    This error occurs when there is no external file to
-                    read. It should only occur at the end of the simulation.
-                    - Deactivate all agent.
-                    '''
-                    for agent in self.base_model.agents:
-                        agent.status = 2
-                
+                self.observations.update_model(self.base_model, time)
+
         else:
             for i in range(numiter):
                 self.base_model.step()
@@ -447,10 +453,11 @@ class ParticleFilter(Filter):
             [numiter] * self.number_of_particles,  # Number of iterations to step each particle (an integer)
             [self.particle_std] * self.number_of_particles,  # Particle std (for adding noise) (a float)
             [s.shape for s in self.states],  # Shape (for adding noise) (a tuple)
+            [self.shared_states] * self.number_of_particles,  # Where to write the states
         ))))
 
+        # The states are already in self.states
         self.models = [stepped_particles[i][0] for i in range(len(stepped_particles))]
-        self.states = np.array([stepped_particles[i][1] for i in range(len(stepped_particles))])
         self.get_state_estimate()
         
 
@@ -499,7 +506,7 @@ class ParticleFilter(Filter):
         ))))
 
         self.models = [stepped_particles[i][0] for i in range(len(stepped_particles))]
-        self.states = np.array([stepped_particles[i][1] for i in range(len(stepped_particles))])
+        self.states[:] = [stepped_particles[i][1] for i in range(len(stepped_particles))]
 
         return
     
@@ -513,9 +520,22 @@ class ParticleFilter(Filter):
         DESCRIPTION
         Add noise to the base model state to get a measured state, or
         use external data to get a measured state. Calculate
-        the distance between the particle states and the measured base model
-        state and then calculate the new particle weights as 1/distance.
-        Add a small term to avoid dividing by 0. Normalise the weights.
+        the log-likelihood of the measured state for every particle (by
+        default from the distance between the particle states and the
+        measured base model state, as 1/distance**2), temper it by dfactor
+        and normalise the weights in log space.
+        '''
+        measured_state, observed = self.measure()
+        log_likelihood = self.likelihood.log_likelihood(self.states, measured_state, observed)
+        self.weights[:] = np.exp(log_normalise(log_likelihood / dfactor))
+
+        return
+
+    def measure(self):
+        '''
+        Returns the measured state (the base model state with some noise,
+        or the external data) and which of its elements are observed (the
+        active agents of the base model).
         '''
         if self.do_external_data: 
             measured_state = self.base_model.get_state(sensor='location')
@@ -523,36 +543,58 @@ class ParticleFilter(Filter):
             measured_state = (self.base_model.get_state(sensor='location')
                               + np.random.normal(0, self.model_std ** 2, size=self.states.shape))
 
-        distance = np.linalg.norm(self.states - measured_state, axis=1)
+        # Only the active agents of the base model are observed
+        observed = np.repeat(self.base_model.agents_status[:self.base_model.pop_total] == 1, 2)
+        return measured_state, observed
 
-        self.weights = 1 / (distance + 1e-9) ** 2
-        self.weights= (self.weights/dfactor)**(1/dfactor)
-        self.weights /= np.sum(self.weights)
+    def temper(self):
+        '''
+        Temper
 
-        return
+        DESCRIPTION
+        Bring in the measured state of this window at the temperatures
+        chosen by self.tempering (see tempering.AdaptiveTempering). At each
+        one the particles are reweighted, resampled and moved with Monte
+        Carlo steps (predict_mc); the particles whose move the tempered
+        likelihood rejects go back to the state they had before it (their
+        whole model, not only the locations). The stages and moves of each
+        window are kept in self.tempering.
+        '''
+        measured_state, observed = self.measure()
+
+        def resample(weights):
+            self.weights[:] = weights
+            self.resample()
+            return self.indexes
+
+        def move(temperature, log_likelihood):
+            # The whole particles, as step_mc can change more than the locations
+            states = self.states.copy()
+            snapshots = [model.snapshot() for model in self.models]
+            self.predict_mc(1)
+            proposed = self.likelihood.log_likelihood(self.states, measured_state, observed)
+            accept = metropolis_accept(log_likelihood, proposed, temperature, np.random)
+            for i in np.flatnonzero(~accept):
+                self.states[i] = states[i]
+                self.models[i].restore(snapshots[i])
+            return accept, np.where(accept, proposed, log_likelihood)
+
+        log_likelihood = self.likelihood.log_likelihood(self.states, measured_state, observed)
+        self.weights[:] = np.exp(self.tempering.temper(log_likelihood, resample, move))
 
     def resample(self):
         '''
         Resample
 
         DESCRIPTION
-        Calculate a random partition of (0,1) and then
-        take the cumulative sum of the particle weights.
-        Carry out a systematic resample of particles.
+        Choose the particles to keep with a systematic
+        resample of the particle weights (see resampling.py).
         Set the new particle states and weights and then
         update agent locations in particle models using
         multiprocessing methods.
         '''
-        offset_partition = ((np.arange(self.number_of_particles)
-                             + np.random.uniform()) / self.number_of_particles)
-        cumsum = np.cumsum(self.weights)
-        i, j = 0, 0
-        while i < self.number_of_particles:
-            if offset_partition[i] < cumsum[j]:
-                self.indexes[i] = j
-                i += 1
-            else:
-                j += 1
+        # The particle models use the global numpy generator
+        self.indexes[:] = systematic(self.weights, np.random)
 
         self.states[:] = self.states[self.indexes]
         self.weights[:] = self.weights[self.indexes]
@@ -592,16 +634,12 @@ class ParticleFilter(Filter):
             mean = np.average(self.states[:, active_states], weights=self.weights, axis=0)
             #variance = np.average((self.states[:, active_states] - mean) ** 2, weights=self.weights, axis=0)
 
-        i = 0
-        for agent in self.base_model.agents:
-            unique_id = agent.unique_id
-            if agent.status == 1:                
-                self.estimate_model.agents[unique_id].history_locations.append((mean[i], mean[i+1]))
-                #self.estimate_model.history_locations_err.append((variance[i], variance[i+1]))
-                i += 2
-            else:
-                self.estimate_model.agents[unique_id].history_locations.append((None, None))
-                #self.estimate_model.history_locations_err.append((None, None))
+        # Record the estimate in the history of the estimate model (inactive agents are NaN)
+        active = np.array(active_states[::2])
+        locations = np.zeros((len(active), 2))
+        if any(active_states):
+            locations[active] = np.reshape(mean, (-1, 2))
+        self.estimate_model.recorder.record(locations, active)
 
     def save(self, before: bool):
         '''
@@ -691,7 +729,7 @@ class ParticleFilter(Filter):
             fig = plt.figure(len(self.animation)+1) # Make sure figures aren't overridden
             plt.clf()
 
-            markersizes = self.weights
+            markersizes = self.weights.copy()  # Scaling in place would change the weights
             if np.std(markersizes) != 0:
                 markersizes *= 4 / np.std(markersizes)  # revar
             markersizes += 8 - np.mean(markersizes)  # remean
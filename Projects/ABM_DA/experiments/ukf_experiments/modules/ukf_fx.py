@@ -35,7 +35,8 @@ def fx(x, **fx_kwargs):
     Uses much less memory and is generally more efficient than
     running the full 2n + 1 stationsims particularly when multiprocessing.
     
-    - Copies current base model
+    - Copies current base model (or takes a snapshot of it if the model
+      has Model.snapshot, and restores it at the end)
     - Replaces positions with some sigma points
     - Step replaced model forwards one time point
     - record new stationsim positions as forecasted sigmapoint
@@ -59,11 +60,24 @@ def fx(x, **fx_kwargs):
     #model = pickle.load(f)
     #f.close()
     base_model = fx_kwargs["base_model"]
-    model = deepcopy(base_model)
-    if x is not None:
-        model.set_state(state = x, sensor="location")    
-    with HiddenPrints():
-        model.step() #step model with print suppression
-    state = model.get_state(sensor="location")
+    if not hasattr(base_model, "snapshot"):
+        model = deepcopy(base_model)
+        if x is not None:
+            model.set_state(state = x, sensor="location")    
+        with HiddenPrints():
+            model.step() #step model with print suppression
+        state = model.get_state(sensor="location")
+        return state
+
+    "step the base model itself and put it back as it was afterwards"
+    snapshot = base_model.snapshot()
+    try:
+        if x is not None:
+            base_model.set_state(state = x, sensor="location")
+        with HiddenPrints():
+            base_model.step() #step model with print suppression
+        state = base_model.get_state(sensor="location")
+    finally:
+        base_model.restore(snapshot)
     
     return state
@@ -0,0 +1,79 @@
+"""
+Benchmark the collision table of the StationSim GrandCentral model.
+
+Places pop_total active agents at random in the Grand Central station and
+times Model.get_collisionTable (vectorized, with and without the cell list
+broad phase) against Model.get_collisionTable_pairwise (agent by agent),
+checking that all of them give the same tmin and wiggle set.
+
+Usage:
+    python benchmark_collisions.py [pop_total ...]
+"""
+# Imports
+import sys
+import time
+import numpy as np
+from stationsim_gcs_model import Model
+
+
+# Functions
+def set_up_model(pop_total, seed=1):
+    """
+    Set up a Grand Central model with every agent active at a random
+    location away from the walls.
+    """
+    model = Model(pop_total=pop_total, station='Grand_Central',
+                  random_seed=seed, do_history=False, do_print=False)
+    margin = 2 * model.agent_size
+    for agent in model.agents:
+        agent.status = 1
+        agent.location = model.rng.uniform((margin, margin),
+                                           (model.width - margin,
+                                            model.height - margin))
+        agent.step_start = model.total_time
+        agent.loc_start = agent.location.copy()
+    model.pop_active = model.pop_total
+    return model
+
+
+def time_call(function, repeats):
+    """
+    Return the result of function() and the best of repeats timings.
+    """
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return result, min(timings)
+
+
+def benchmark(populations, repeats=3, max_pairwise=800):
+    print('pop_total  cell list(s)  vectorized(s)  pairwise(s)  same')
+    for pop_total in populations:
+        model = set_up_model(pop_total)
+        (table, tmin), t_vec = time_call(model.get_collisionTable, repeats)
+        wiggle = model.get_wiggleTable(table, tmin * 0.98)
+
+        model.do_cell_list = True
+        (table1, tmin1), t_cell = time_call(
+            lambda: model.get_collisionTable(1.0), repeats)
+        wiggle1 = model.get_wiggleTable(table1, tmin1 * 0.98)
+        same = tmin > 1.0 or (tmin1 == tmin and wiggle1 == wiggle)
+
+        if pop_total > max_pairwise:
+            print(f'{pop_total:9d}  {t_cell:12.4f}  {t_vec:13.4f}  '
+                  f'{"-":>11}  {same}')
+            continue
+        (table0, tmin0), t_pair = time_call(
+            model.get_collisionTable_pairwise, 1)
+        wiggle0 = model.get_wiggleTable(table0, tmin0 * 0.98)
+        same = same and np.isclose(tmin, tmin0) and wiggle == wiggle0
+        print(f'{pop_total:9d}  {t_cell:12.4f}  {t_vec:13.4f}  '
+              f'{t_pair:11.4f}  {same}')
+
+
+if __name__ == '__main__':
+    populations = [int(n) for n in sys.argv[1:]] or [50, 100, 200, 400, 800,
+                                                      1600, 3200]
+    benchmark(populations)
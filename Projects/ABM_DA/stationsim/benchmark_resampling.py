@@ -0,0 +1,74 @@
+"""
+Benchmark the resampling schemes of the particle filters.
+
+Times every scheme in resampling.py for number_of_particles random weights,
+against the Python loop the filters used for systematic resampling,
+checking that systematic() gives the same indexes as the loop.
+
+Usage:
+    python benchmark_resampling.py [number_of_particles ...]
+"""
+# Imports
+import sys
+import time
+import numpy as np
+import resampling
+
+
+# Functions
+def systematic_loop(weights, rng):
+    """
+    Systematic resampling as the particle filters used to do it.
+    """
+    n = len(weights)
+    offset_partition = (np.arange(n) + rng.uniform()) / n
+    cumsum = np.cumsum(weights)
+    indexes = np.zeros(n, 'i')
+    i, j = 0, 0
+    while i < n:
+        if offset_partition[i] < cumsum[j]:
+            indexes[i] = j
+            i += 1
+        else:
+            j += 1
+    return indexes
+
+
+def time_call(function, repeats):
+    """
+    Return the result of function() and the best of repeats timings.
+    """
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return result, min(timings)
+
+
+def benchmark(sizes, repeats=3, max_loop=100000):
+    names = list(resampling.schemes)
+    print('particles  ' + '  '.join(f'{name + "(s)":>14}' for name in names)
+          + '         loop(s)  same')
+    for n in sizes:
+        weights = np.random.default_rng(1).exponential(size=n)
+        weights /= np.sum(weights)
+        timings = []
+        for name in names:
+            _, t = time_call(lambda: resampling.schemes[name](
+                weights, np.random.default_rng(2)), repeats)
+            timings.append(f'{t:14.4f}')
+        row = f'{n:9d}  ' + '  '.join(timings)
+
+        if n > max_loop:
+            print(row + f'  {"-":>14}  -')
+            continue
+        indexes0, t_loop = time_call(
+            lambda: systematic_loop(weights, np.random.default_rng(2)), 1)
+        indexes = resampling.systematic(weights, np.random.default_rng(2))
+        print(row + f'  {t_loop:14.4f}  {np.array_equal(indexes, indexes0)}')
+
+
+if __name__ == '__main__':
+    sizes = [int(n) for n in sys.argv[1:]] or [10000, 100000, 1000000]
+    benchmark(sizes)
@@ -155,9 +155,18 @@ class EnsembleKalmanFilter(Filter):
 
     def __set_up_models(self, n=None):
         # Set up ensemble of models
-        # Deep copy preserves knowledge of agent origins and destinations
+        # Deep copy preserves knowledge of agent origins and destinations;
+        # models that can copy themselves do it without deepcopy
         n = self.ensemble_size if n is None else n
-        models = [dcopy(self.base_model) for _ in range(n)]
+        if hasattr(self.base_model, 'copy'):
+            models = [self.base_model.copy() for _ in range(n)]
+        else:
+            models = [dcopy(self.base_model) for _ in range(n)]
+        # Models with their own random generator need different seeds
+        if hasattr(self.base_model, 'spawn_random_seeds'):
+            seeds = self.base_model.spawn_random_seeds(n)
+            for model, seed in zip(models, seeds):
+                model.set_random_seed(seed)
 
         if self.mode == EnsembleKalmanFilterType.DUAL_EXIT:
             for model in models:
@@ -0,0 +1,162 @@
+'''
+Observation store for the Grand Central Terminal (GCT) real data.
+
+The GCT data is one text file per frame, frame_<t>.0.dat ('# pedestrianID
+x y'), either in a directory or packed in frames.tar.gz, and activation.dat
+('# pedestrianID time_activation gate_in gate_out speed'). ObservationStore
+reads all of it once and saves it next to the data as
+- trajectories.npy: every frame and pedestrian (see TrajectoryFile), and
+- activation.npy: the activation.dat table,
+which are then opened memory-mapped, so a frame is found by its number
+without reading any text. The store is built again when a source file is
+newer than it.
+'''
+import os
+import re
+import tarfile
+import warnings
+import numpy as np
+from stationsim_gcs_model import TrajectoryFile
+
+
+class ObservationStore:
+    '''
+    The frames and activation table of the GCT data, indexed by frame.
+
+    Use ObservationStore.open(directory), which ingests the text data the
+    first time it is used on a directory (or when it has changed since)
+    and opens the saved store after.
+    '''
+
+    _store_names = ('trajectories.npy', 'activation.npy')
+
+    _frame_name = re.compile(r'frame_(\d+)(?:\.0)?\.dat$')
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.trajectories = TrajectoryFile(
+            os.path.join(directory, 'trajectories.npy'))
+        self.activation = np.load(os.path.join(directory, 'activation.npy'),
+                                  mmap_mode='r')
+        self.n_frames = self.trajectories.n_frames
+        self.pop_total = self.trajectories.pop_total
+
+    @classmethod
+    def open(cls, directory):
+        '''
+        Open the store in directory, ingesting the data first if needed.
+        '''
+        if cls.is_stale(directory):
+            cls.ingest(directory)
+        return cls(directory)
+
+    @classmethod
+    def is_stale(cls, directory):
+        '''
+        Returns whether the store in directory is missing, or older than
+        activation.dat, a frame file or frames.tar.gz.
+        '''
+        stored = [os.path.join(directory, name) for name in cls._store_names]
+        if not all(os.path.exists(name) for name in stored):
+            return True
+        sources = [name for name in os.listdir(directory)
+                   if cls._frame_name.match(name)
+                   or name in ('activation.dat', 'frames.tar.gz')]
+        if not sources:
+            return False
+        newest = max(os.path.getmtime(os.path.join(directory, name))
+                     for name in sources)
+        return newest > min(os.path.getmtime(name) for name in stored)
+
+    @classmethod
+    def ingest(cls, directory):
+        '''
+        Read activation.dat and the frame files in directory (or in
+        directory/frames.tar.gz if there are none) and save the store.
+        '''
+        with warnings.catch_warnings():
+            # Frames with no pedestrian are empty files
+            warnings.simplefilter('ignore', UserWarning)
+            activation = np.loadtxt(os.path.join(directory, 'activation.dat'),
+                                    ndmin=2)
+            frames = dict(cls._read_frames(directory))
+
+        pop_total = len(activation)
+        if frames:
+            pop_total = max([pop_total] + [int(data[:, 0].max()) + 1
+                                           for data in frames.values()
+                                           if len(data)])
+        n_frames = max(frames) + 1 if frames else 0
+        locations = np.zeros((n_frames, pop_total, 2))
+        active = np.zeros((n_frames, pop_total), dtype=bool)
+        for frame, data in frames.items():
+            ids = data[:, 0].astype(int)
+            locations[frame, ids] = data[:, 1:3]
+            active[frame, ids] = True
+
+        # Written aside and moved in place, so a store that is already
+        # open (memory-mapped) keeps reading the old files
+        activation_file = os.path.join(directory, 'activation.npy')
+        trajectories_file = os.path.join(directory, 'trajectories.npy')
+        with open(activation_file + '.tmp', 'wb') as file:
+            np.save(file, activation)
+        TrajectoryFile.write(trajectories_file + '.tmp', locations, active)
+        os.replace(activation_file + '.tmp', activation_file)
+        os.replace(trajectories_file + '.tmp', trajectories_file)
+
+    @classmethod
+    def _read_frames(cls, directory):
+        '''
+        Yields (frame, data) for every frame file, data being (n, 3).
+        '''
+        names = [name for name in os.listdir(directory)
+                 if cls._frame_name.match(name)]
+        if names:
+            for name in names:
+                frame = int(cls._frame_name.match(name).group(1))
+                data = np.loadtxt(os.path.join(directory, name), ndmin=2)
+                yield frame, data.reshape(-1, 3)
+            return
+        with tarfile.open(os.path.join(directory, 'frames.tar.gz')) as tar:
+            for member in tar:
+                match = cls._frame_name.search(member.name)
+                if member.isfile() and match:
+                    data = np.loadtxt(tar.extractfile(member), ndmin=2)
+                    yield int(match.group(1)), data.reshape(-1, 3)
+
+    def get_observation(self, frame, pop_total=None):
+        '''
+        Returns the locations (pop_total, 2) of the first pop_total
+        pedestrians in a frame and whether they are active (pop_total,).
+        Nobody is active after the last frame.
+        '''
+        if pop_total is None:
+            pop_total = self.pop_total
+        locations = np.zeros((pop_total, 2))
+        active = np.zeros(pop_total, dtype=bool)
+        if 0 <= frame < self.n_frames:
+            n = min(pop_total, self.pop_total)
+            records = self.trajectories.records[frame, :n]
+            active[:n] = records['status'] == 1
+            locations[:n, 0] = records['x']
+            locations[:n, 1] = records['y']
+            locations[~active] = 0
+        return locations, active
+
+    def update_model(self, model, frame):
+        '''
+        Set the agents of model as in a frame: the pedestrians in the frame
+        are active at their observed location, the ones that were active
+        and are not any more are finished and, after the last frame, every
+        agent is finished.
+        '''
+        n = model.pop_total
+        status = model.agents_status[:n]
+        if frame >= self.n_frames:
+            status[:] = 2
+            return
+        locations, active = self.get_observation(frame, n)
+        status[(status == 1) & ~active] = 2
+        status[active] = 1
+        model.agents_location[:n][active] = locations[active]
+        model.spatial_index.invalidate()
@@ -0,0 +1,124 @@
+'''
+Observation likelihoods for the particle filters.
+
+A likelihood turns the particle states (number_of_particles, dimensions)
+and an observation (dimensions,) into the log-likelihood of every particle,
+in one vectorized operation. Working in log space means that the weights do
+not underflow to 0 when there are many agents: the filter adds the
+log-likelihoods to its log weights and normalises them with log-sum-exp
+(see resampling.log_normalise), or calls log_weights.
+
+Only some of the state can be observed. The elements of the observation
+that are NaN, and the ones outside mask (a boolean array over the
+dimensions, for example the active agents of the base model repeated for
+x and y), are left out of the likelihood.
+'''
+import numpy as np
+from resampling import log_normalise
+
+
+class Likelihood:
+    '''
+    Base class of the likelihoods, which implement _log_likelihood on the
+    residuals (number_of_particles, observed dimensions).
+    '''
+    use_mask = True
+
+    def log_likelihood(self, states, observation, mask=None):
+        '''
+        Returns the log-likelihood of the observation for every particle,
+        up to a constant (number_of_particles,). The observation can also
+        be one per particle (number_of_particles, dimensions).
+        '''
+        states = np.atleast_2d(states)
+        observation = np.asarray(observation, dtype=float)
+        # Shorter observations are of the first elements of the states
+        residuals = states[:, :observation.shape[-1]] - observation
+        observed = ~np.isnan(observation)
+        if observed.ndim > 1:
+            # One observation per particle
+            observed = np.all(observed, axis=0)
+        if mask is not None and self.use_mask:
+            observed &= np.asarray(mask, dtype=bool)
+        if not np.all(observed):
+            residuals = residuals[:, observed]
+        return self._log_likelihood(residuals)
+
+    def log_weights(self, states, observation, mask=None):
+        '''
+        Returns the normalised log weights of the particles given the
+        observation.
+        '''
+        return log_normalise(self.log_likelihood(states, observation, mask))
+
+    def _log_likelihood(self, residuals):
+        raise NotImplementedError
+
+
+class InverseDistanceLikelihood(Likelihood):
+    '''
+    The weights the filters have always used, 1 / (distance + offset) **
+    power, distance being the Euclidean distance between the particle and
+    the observation. By default the mask is not used, so every agent
+    counts, as before.
+    '''
+
+    def __init__(self, power=2, offset=1e-9, use_mask=False):
+        self.power = power
+        self.offset = offset
+        self.use_mask = use_mask
+
+    def _log_likelihood(self, residuals):
+        distance = np.linalg.norm(residuals, axis=1)
+        return -self.power * np.log(np.fmax(distance + self.offset, 1e-99))
+
+
+class GaussianLikelihood(Likelihood):
+    '''
+    Independent Gaussian observation errors with standard deviation std.
+    '''
+
+    def __init__(self, std=1.0, use_mask=True):
+        self.std = std
+        self.use_mask = use_mask
+
+    def _log_likelihood(self, residuals):
+        return -0.5 * np.sum(residuals ** 2, axis=1) / self.std ** 2
+
+
+class StudentTLikelihood(Likelihood):
+    '''
+    Independent Student-t observation errors with scale std and dof
+    degrees of freedom. The heavy tails keep a particle that is far from a
+    few of the agents from losing all its weight.
+    '''
+
+    def __init__(self, std=1.0, dof=4, use_mask=True):
+        self.std = std
+        self.dof = dof
+        self.use_mask = use_mask
+
+    def _log_likelihood(self, residuals):
+        return (-0.5 * (self.dof + 1)
+                * np.sum(np.log1p(residuals ** 2 / (self.dof * self.std ** 2)),
+                         axis=1))
+
+
+likelihoods = {'inverse_distance': InverseDistanceLikelihood,
+               'gaussian': GaussianLikelihood,
+               'student_t': StudentTLikelihood}
+
+
+def get_likelihood(likelihood='inverse_distance', **params):
+    '''
+    Returns likelihood if it is a Likelihood, or a new likelihood of the
+    kind named (one of the keys of likelihoods) made with params.
+    '''
+    if isinstance(likelihood, Likelihood):
+        return likelihood
+    try:
+        cls = likelihoods[likelihood]
+    except KeyError:
+        raise ValueError(f'Unknown likelihood {likelihood!r}, use one of '
+                         f'{sorted(likelihoods)}')
+    return cls(**params)
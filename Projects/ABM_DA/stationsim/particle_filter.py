@@ -1,5 +1,8 @@
 from filter import Filter
 from stationsim_model import Model
+from shared_arrays import SharedArray
+from resampling import systematic
+from likelihoods import get_likelihood
 
 
 import numpy as np
@@ -38,6 +41,11 @@ class ParticleFilter(Filter):
                                     and displayed
          - show_ani:                If false then don't actually show the animation. The individual
                                     can be retrieved later from self.animation
+        - likelihood:               The observation likelihood (see likelihoods.py): 'inverse_distance'
+                                    (default, 1/distance**2 over all the agents), 'gaussian' or
+                                    'student_t' (over the active agents of the base model, with the
+                                    observation and particle noise as standard deviation), or a
+                                    Likelihood object.
         
         DESCRIPTION
         Firstly, set all attributes using filter parameters. Set time and
@@ -53,8 +61,13 @@ class ParticleFilter(Filter):
         self.base_model = ModelClass(**model_params) # (Model does not need a unique id)
         self.models = list([deepcopy(self.base_model) for _ in range(self.number_of_particles)])  
         self.dimensions = len(self.base_model.get_state(sensor='location'))
-        self.states = np.zeros((self.number_of_particles, self.dimensions))
-        self.weights = np.ones(self.number_of_particles)
+        # The states and weights live in shared memory, so the processes that
+        # step the particles write their states there instead of sending them back
+        self.shared_states = SharedArray((self.number_of_particles, self.dimensions))
+        self.shared_weights = SharedArray(self.number_of_particles)
+        self.states = self.shared_states.array
+        self.weights = self.shared_weights.array
+        self.weights[:] = 1
         self.indexes = np.zeros(self.number_of_particles, 'i')
         self.window_counter = 0 # Just for printing the progress of the PF
         # Pool object needed for multiprocessing
@@ -69,6 +82,16 @@ class ParticleFilter(Filter):
         if not self.do_resample:
             print("**Warning**: Not resampling. This should only be used for benchmarking")
 
+        try:
+            self.likelihood
+        except AttributeError:
+            self.likelihood = 'inverse_distance'
+        if self.likelihood in ('gaussian', 'student_t'):
+            self.likelihood = get_likelihood(self.likelihood,
+                                             std=np.hypot(self.model_std ** 2, self.particle_std ** 2))
+        else:
+            self.likelihood = get_likelihood(self.likelihood)
+
         ## We get problems when there are more processes than particles (larger particle variance for some reason)
         #if numcores > self.number_of_particles:
         #    numcores = self.number_of_particles
@@ -86,7 +109,8 @@ class ParticleFilter(Filter):
 
         #print("Creating initial states ... ")
         base_model_state = self.base_model.get_state(sensor='location')
-        self.states = np.array([ self.initial_state(i, base_model_state) for i in range(self.number_of_particles )])
+        for i in range(self.number_of_particles):
+            self.initial_state(i, base_model_state)
         #print("\t ... finished")
         print("Running filter with {} particles and {} runs (on {} cores) with {} agents.".format(
             filter_params['number_of_particles'], filter_params['number_of_runs'], numcores, model_params["pop_total"]),
@@ -114,7 +138,8 @@ class ParticleFilter(Filter):
         return model
 
     @classmethod
-    def step_particle(cls, particle_num: int, model: Model, num_iter: int, particle_std: float, particle_shape: tuple):
+    def step_particle(cls, particle_num: int, model: Model, num_iter: int, particle_std: float, particle_shape: tuple,
+                      states: SharedArray = None):
         """
         Step a particle, assign the locations of the
         agents to the particle state with some noise, and
@@ -126,6 +151,8 @@ class ParticleFilter(Filter):
         :param num_iter: The number of iterations to step
         :param particle_std: the particle noise standard deviation
         :param particle_shape: the shape of the particle array
+        :param states: the shared states of the filter (optional). If given, the particle state is
+            written in row particle_num instead of being returned
         """
         # Force the model to re-seed its random number generator (otherwise each child process
         # has the same generator https://stackoverflow.com/questions/14504866/python-multiprocessing-numpy-random
@@ -136,6 +163,9 @@ class ParticleFilter(Filter):
         noise = np.random.normal(0, particle_std ** 2, size=particle_shape)
         state = model.get_state(sensor='location') + noise
         model.set_state(state, sensor='location')
+        if states is not None:
+            states.array[particle_num] = state
+            state = None
         return model, state
 
     def step(self):
@@ -258,6 +288,8 @@ class ParticleFilter(Filter):
 
         finally: # Whatever happens, make sure the multiprocessing pool is colsed
             self.pool.close()
+            self.shared_states.close()
+            self.shared_weights.close()
 
     def predict(self, numiter=1):
         '''
@@ -282,10 +314,11 @@ class ParticleFilter(Filter):
             [numiter] * self.number_of_particles,  # Number of iterations to step each particle (an integer)
             [self.particle_std] * self.number_of_particles,  # Particle std (for adding noise) (a float)
             [s.shape for s in self.states],  # Shape (for adding noise) (a tuple)
+            [self.shared_states] * self.number_of_particles,  # Where to write the states
         )))
 
+        # The states are already in self.states
         self.models = [stepped_particles[i][0] for i in range(len(stepped_particles))]
-        self.states = np.array([stepped_particles[i][1] for i in range(len(stepped_particles))])
 
         return
 
@@ -295,15 +328,16 @@ class ParticleFilter(Filter):
 
         DESCRIPTION
         Add noise to the base model state to get a measured state. Calculate
-        the distance between the particle states and the measured base model
-        state and then calculate the new particle weights as 1/distance.
-        Add a small term to avoid dividing by 0. Normalise the weights.
+        the log-likelihood of the measured state for every particle (by
+        default from the distance between the particle states and the
+        measured base model state, as 1/distance**2) and normalise the
+        weights in log space.
         '''
         measured_state = (self.base_model.get_state(sensor='location')
                           + np.random.normal(0, self.model_std ** 2, size=self.states.shape))
-        distance = np.linalg.norm(self.states - measured_state, axis=1)
-        self.weights = 1 / (distance + 1e-9) ** 2
-        self.weights /= np.sum(self.weights)
+        # Only the active agents of the base model are observed
+        observed = [agent.status == 1 for agent in self.base_model.agents for _ in range(2)]
+        self.weights[:] = np.exp(self.likelihood.log_weights(self.states, measured_state, observed))
 
         return
 
@@ -312,23 +346,14 @@ class ParticleFilter(Filter):
         Resample
 
         DESCRIPTION
-        Calculate a random partition of (0,1) and then
-        take the cumulative sum of the particle weights.
-        Carry out a systematic resample of particles.
+        Choose the particles to keep with a systematic
+        resample of the particle weights (see resampling.py).
         Set the new particle states and weights and then
         update agent locations in particle models using
         multiprocessing methods.
         '''
-        offset_partition = ((np.arange(self.number_of_particles)
-                             + np.random.uniform()) / self.number_of_particles)
-        cumsum = np.cumsum(self.weights)
-        i, j = 0, 0
-        while i < self.number_of_particles:
-            if offset_partition[i] < cumsum[j]:
-                self.indexes[i] = j
-                i += 1
-            else:
-                j += 1
+        # The particle models use the global numpy generator
+        self.indexes[:] = systematic(self.weights, np.random)
 
         self.states[:] = self.states[self.indexes]
         self.weights[:] = self.weights[self.indexes]
@@ -431,7 +456,7 @@ class ParticleFilter(Filter):
             fig = plt.figure(len(self.animation)+1) # Make sure figures aren't overridden
             plt.clf()
 
-            markersizes = self.weights
+            markersizes = self.weights.copy()  # Scaling in place would change the weights
             if np.std(markersizes) != 0:
                 markersizes *= 4 / np.std(markersizes)  # revar
             markersizes += 8 - np.mean(markersizes)  # remean
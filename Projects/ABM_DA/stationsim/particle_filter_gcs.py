@@ -5,14 +5,21 @@ Particle Filter - GCT data version
 '''
 #import sys
 from filter import Filter
-from stationsim_gcs_model import Model
+from stationsim_gcs_model import Model, ModelEnsemble
+from gct_observations import ObservationStore
+from particle_workers import ParticleWorkers
+from particle_nodes import ParticleNodes
+from shared_arrays import SharedArray
+from resampling import resample, minimise_copies, balance_copies, log_normalise, effective_sample_size
+from likelihoods import get_likelihood
+from pf_metrics import MetricsAccumulator, weighted_moments
 import numpy as np
 import matplotlib.pyplot as plt
-from copy import deepcopy
 import multiprocessing
 import warnings
-import itertools
 import time
+import os
+import pickle
 
 
 class ParticleFilter(Filter): 
@@ -51,26 +58,77 @@ class ParticleFilter(Filter):
                                     whether it is to determine the gate_out using external data (True) 
                                     or internally (False).
         - pf_method:                The name of the desired PF method: 'sir', 'hybrid', 'tempered'                                    
+        - do_ensemble:              Boolean to determine whether the particles are stepped together
+                                    in one ModelEnsemble (True) or one by one in the multiprocessing
+                                    pool (False, default).
+        - do_resident:              Boolean to determine whether each worker process keeps a shard of
+                                    the particles for the whole run (True), so only states go through
+                                    the pipes, or the particles are sent to the pool every window
+                                    (False, default).
+        - nodes:                    The particle nodes (see particle_nodes.py) to keep the particles in,
+                                    like resident workers but connected over TCP, possibly on other
+                                    machines: a list of their addresses ('host:port'), or the number of
+                                    nodes to start on this machine. If None (default), no nodes are used.
+        - authkey:                  The key to connect to the nodes (default the STATIONSIM_AUTHKEY
+                                    environment variable).
+        - resample_scheme:          The resampling scheme: 'systematic' (default), 'stratified',
+                                    'residual' or 'multinomial' (see resampling.py).
+        - ess_threshold:            Fraction of number_of_particles. If given, the weights are carried
+                                    over between windows and the particles are only resampled when
+                                    the effective sample size falls below ess_threshold *
+                                    number_of_particles. If None (default), resample every window.
+        - likelihood:               The observation likelihood (see likelihoods.py): 'inverse_distance'
+                                    (default, 1/distance**2 over all the agents), 'gaussian' or
+                                    'student_t' (over the active agents of the base model, with the
+                                    observation and particle noise as standard deviation), or a
+                                    Likelihood object.
+        - checkpoint_dir:           Directory to save a checkpoint in (see checkpoint) every
+                                    checkpoint_every windows (default 1), to resume the run from if
+                                    it stops. If None (default), no checkpoints are saved.
         DESCRIPTION
         Firstly, set all attributes using filter parameters. Set time and
         initialise base model using model parameters. Initialise particle
-        models using a deepcopy of base model. Determine particle filter 
+        models as copies of the base model. Determine particle filter 
         dimensions, initialise all remaining arrays, and set initial
         particle states to the base model state using multiprocessing. 
         '''
         for key, value in filter_params.items():
             setattr(self, key, value)
+        # Kept to make the same filter again when resuming from a checkpoint
+        self.ModelClass = ModelClass
+        self.model_params = model_params
+        self.filter_params = filter_params
         self.time = 0
         self.number_of_iterations = model_params['batch_iterations']
         self.base_model = ModelClass(**model_params) # (Model does not need a unique id)
-        self.models = list([deepcopy(self.base_model) for _ in range(self.number_of_particles)])
-        # To store the final result
-        self.estimate_model = ModelClass(**model_params)
+        self.models = [self.base_model.copy() for _ in range(self.number_of_particles)]
+        # Each particle (and the filter) gets its own random numbers, spawned from the model seed
+        seeds = self.base_model.spawn_random_seeds(self.number_of_particles + 1)
+        self.rng = np.random.default_rng(seeds[0])
+        for model, seed in zip(self.models, seeds[1:]):
+            model.set_random_seed(seed)
+        # To store the final result (with its history in a directory of its
+        # own, so it does not truncate the files of the base model)
+        estimate_params = dict(model_params)
+        if model_params.get('history_dir') is not None:
+            estimate_params['history_dir'] = os.path.join(
+                model_params['history_dir'], 'estimate')
+        self.estimate_model = ModelClass(**estimate_params)
         if self.do_external_data:
+            self.observations = ObservationStore.open(self.external_info[0])
             self.set_initial_conditions()
         self.dimensions = len(self.base_model.get_state(sensor='location'))
-        self.states = np.zeros((self.number_of_particles, self.dimensions))
-        self.weights = np.ones(self.number_of_particles)
+        # The elements of the state that are active (set again by predict in each window)
+        self.active_states = self.get_active_states()
+        # The states and weights live in shared memory, so the processes that
+        # step the particles write their states there instead of sending them back
+        self.shared_states = SharedArray((self.number_of_particles, self.dimensions))
+        self.shared_weights = SharedArray(self.number_of_particles)
+        self.states = self.shared_states.array
+        self.weights = self.shared_weights.array
+        self.weights[:] = 1
+        # The weights are kept in log space, so they can be multiplied over many windows
+        self.log_weights = np.full(self.number_of_particles, -np.log(self.number_of_particles))
         self.indexes = np.zeros(self.number_of_particles, 'i')
         self.window_counter = 0 # Just for printing the progress of the PF
         # Pool object needed for multiprocessing
@@ -85,28 +143,88 @@ class ParticleFilter(Filter):
         if not self.do_resample:
             print("**Warning**: Not resampling. This should only be used for benchmarking")
 
+        # Step the particles one by one in the pool unless asked otherwise
+        try:
+            self.do_ensemble
+        except AttributeError:
+            self.do_ensemble = False
+        try:
+            self.do_resident
+        except AttributeError:
+            self.do_resident = False
+        try:
+            self.nodes
+        except AttributeError:
+            self.nodes = None
+        if self.nodes is not None:
+            # The nodes keep their particles like resident workers
+            self.do_resident = True
+        try:
+            self.authkey
+        except AttributeError:
+            self.authkey = os.environ.get('STATIONSIM_AUTHKEY')
+        try:
+            self.resample_scheme
+        except AttributeError:
+            self.resample_scheme = 'systematic'
+        try:
+            self.ess_threshold
+        except AttributeError:
+            self.ess_threshold = None
+        try:
+            self.checkpoint_dir
+        except AttributeError:
+            self.checkpoint_dir = None
+        try:
+            self.checkpoint_every
+        except AttributeError:
+            self.checkpoint_every = 1
+        try:
+            self.likelihood
+        except AttributeError:
+            self.likelihood = 'inverse_distance'
+        if self.likelihood in ('gaussian', 'student_t'):
+            self.likelihood = get_likelihood(self.likelihood,
+                                             std=np.hypot(self.model_std ** 2, self.particle_std ** 2))
+        else:
+            self.likelihood = get_likelihood(self.likelihood)
+
         ## We get problems when there are more processes than particles (larger particle variance for some reason)
         #if numcores > self.number_of_particles:
         #    numcores = self.number_of_particles
-        self.pool = multiprocessing.Pool(processes=numcores)
+        if self.do_resident or self.do_ensemble:
+            # The particles go to the workers once, at the end of __init__, or are stepped in this process
+            self.pool = None
+        else:
+            self.pool = multiprocessing.Pool(processes=numcores)
         if self.do_save or self.p_save:
-            self.active_agents = []
+            # Errors, variances and effective sample sizes of the saves, before and after resampling in each window
+            number_of_windows = -(-self.number_of_iterations // self.resample_window)
+            self.metrics = MetricsAccumulator(capacity=2 * number_of_windows)
             self.mean_states = [] # Mean state of all partciles, weighted by distance from observations
-            self.mean_errors = [] # Mean distance between weighted mean state and the true state
-            self.variances = []
-            self.absolute_errors = [] # Unweighted distance between mean state and the true state
             self.unique_particles = []
-            self.before_resample = [] # Records whether the errors were before or after resampling
+        self.resampled = [] # Records whether the particles were resampled in each window
+        self.copy_counts = [] # Number of particles overwritten with a copy at each resample
+        self.copy_times = [] # Time taken to copy them
 
         self.animation = [] # Keep a record of each plot created if animating so the individual ones can be viewed later
 
         #print("Creating initial states ... ")
         base_model_state = self.base_model.get_state(sensor='location')
-        self.states = np.array([ self.initial_state(i, base_model_state) for i in range(self.number_of_particles )])
+        for i in range(self.number_of_particles):
+            self.initial_state(i, base_model_state)
         #print("\t ... finished")
         print("Running filter with {} particles and {} runs (on {} cores) with {} agents.".format(
             filter_params['number_of_particles'], filter_params['number_of_runs'], numcores, model_params["pop_total"]),
             flush=True)
+        if self.nodes is not None:
+            self.workers = ParticleNodes(self.models, self.nodes, self.authkey, states=self.shared_states)
+            self.communication = [] # Bytes sent to and received from the nodes in each window
+            self.traffic = self.workers.traffic()
+            print("Sent the particles to {} nodes ({} MB)".format(
+                len(self.workers.shards), round(self.traffic / 2 ** 20, 2)), flush=True)
+        elif self.do_resident:
+            self.workers = ParticleWorkers(self.models, numcores, states=self.shared_states)
         
         #self.estimate_model.history_locations_err = []
     def initial_state(self, particle_number, base_model_state):
@@ -124,23 +242,21 @@ class ParticleFilter(Filter):
          self.external_info[1]: boolean to use speed
          self.external_info[2]: boolean to use gate_out
         '''
-        file_name = self.external_info[0] + 'activation.dat'
-        ID, time, gateIn, gateOut, speed_ = np.loadtxt(file_name,unpack=True)
-        for i in range(self.base_model.pop_total):
-            self.base_model.agents[i].steps_activate = time[i]
-            self.estimate_model.agents[i].step_start = time[i]
-            self.base_model.agents[i].gate_in = int(gateIn[i])
-            for model in self.models:
-                model.agents[i].steps_activate = time[i]
-                model.agents[i].gate_in = int(gateIn[i])
+        ID, time, gateIn, gateOut, speed_ = np.array(self.observations.activation).T
+        n = self.base_model.pop_total
+        time, gateIn, gateOut, speed_ = time[:n], gateIn[:n].astype(int), gateOut[:n].astype(int), speed_[:n]
+        for agent, t in zip(self.estimate_model.agents, time):
+            agent.step_start = t
+        if self.external_info[2]:
+            loc_desire = self.base_model.get_gate_locations(gateOut, self.base_model.agents_size[:n])
+        for model in [self.base_model] + self.models:
+            model.agents_steps_activate[:n] = time
+            model.activation_queue = None
+            model.agents_gate_in[:n] = gateIn
             if self.external_info[1]:
-                self.base_model.agents[i].speed = speed_[i]
-                for model in self.models:
-                    model.agents[i].speed = speed_[i]
+                model.agents_speed[:n] = speed_
             if self.external_info[2]:
-                self.base_model.agents[i].loc_desire = self.base_model.agents[i].set_agent_location(int(gateOut[i]))
-                for model in self.models:
-                    model.agents[i].loc_desire = self.base_model.agents[i].loc_desire
+                model.agents_loc_desire[:n] = loc_desire
 
         '''
          If the speed is not obteined from external data, generate new speeds
@@ -148,12 +264,7 @@ class ParticleFilter(Filter):
         '''
         if not self.external_info[1]:
             for model in self.models:
-                for agent in model.agents:
-                    speed_max = 0
-                    while speed_max <= model.speed_min:
-                        speed_max = np.random.normal(model.speed_mean, model.speed_std)
-                    agent.speeds = np.arange(speed_max, model.speed_min, - model.speed_step)
-                    agent.speed = np.random.choice((agent.speeds))
+                model.set_speeds()
 
         '''
          If the gate_out is not obteined from external data, generate new 
@@ -161,9 +272,7 @@ class ParticleFilter(Filter):
         '''
         if not self.external_info[2]:
             for model in self.models:
-                for agent in model.agents:
-                    agent.set_gate_out()
-                    agent.loc_desire = agent.set_agent_location(agent.gate_out)
+                model.set_gates_out()
 
 
     @classmethod
@@ -193,7 +302,8 @@ class ParticleFilter(Filter):
         return model
 
     @classmethod
-    def step_particle(cls, particle_num: int, model: Model, num_iter: int, particle_std: float, particle_shape: tuple):
+    def step_particle(cls, particle_num: int, model: Model, num_iter: int, particle_std: float, particle_shape: tuple,
+                      states: SharedArray = None):
         """
         Step a particle, assign the locations of the
         agents to the particle state with some noise, and
@@ -205,17 +315,24 @@ class ParticleFilter(Filter):
         :param num_iter: The number of iterations to step
         :param particle_std: the particle noise standard deviation
         :param particle_shape: the shape of the particle array
+        :param states: the shared states of the filter (optional). If given, the particle state is
+            written in row particle_num instead of being returned
+        :return: The snapshot of the stepped model (see Model.snapshot) and the particle state (None
+            if it was written in states)
         """
-        # Force the model to re-seed its random number generator (otherwise each child process
-        # has the same generator https://stackoverflow.com/questions/14504866/python-multiprocessing-numpy-random
-        model.set_random_seed()
+        # The model brings its own random number generator, so the result does not
+        # depend on the process it runs in
         for i in range(num_iter):
             model.step()
 
-        noise = np.random.normal(0, particle_std ** 2, size=particle_shape)
+        noise = model.rng.normal(0, particle_std ** 2, size=particle_shape)
         state = model.get_state(sensor='location') + noise
         model.set_state(state, sensor='location')
-        return model, state
+        if states is not None:
+            states.array[particle_num] = state
+            state = None
+        # Only send back the dynamic state of the model, not the whole object
+        return model.snapshot(), state
 
     def step(self):
         '''
@@ -233,16 +350,19 @@ class ParticleFilter(Filter):
         animations and saves will only report once per window, rather than
         every iteration
 
-        :return: Information about the run as a list with two tuples. The first
-        tuple has information about the state of the PF *before* reweighting,
+        :return: Information about the run as a list with two lists. The first
+        list has information about the state of the PF *before* reweighting,
         the second has the state after reweighting.
-        Each tuple has the following:
-           min(self.mean_errors) - the error of the particle with the smallest error
-           max(self.mean_errors) - the error of the particle with the largest error
-           np.average(self.mean_errors) - average of all particle errors
-           min(self.variances) - min particle variance
-           max(self.variances) - max particle variance
-           np.average(self.variances) - mean particle variance
+        Each list has the following (see MetricsAccumulator.summary, which has
+        them as a structured array):
+           min(mean_error) - the smallest error of the weighted mean state
+           max(mean_error) - the largest error of the weighted mean state
+           average(mean_error) - average error of the weighted mean state
+           min(absolute_error), max(absolute_error), average(absolute_error) - the
+           same for the unweighted mean state
+           min(variance) - min particle variance
+           max(variance) - max particle variance
+           average(variance) - mean particle variance
         '''
         print("Starting particle filter step()")
 
@@ -274,7 +394,12 @@ class ParticleFilter(Filter):
 
                         if self.do_resample: # Can turn off resampling for benchmarking
                             self.reweight()
-                            self.resample()
+                            # Only resample when the particles have degenerated (if asked to)
+                            resample = bool(self.ess_threshold is None or
+                                            self.get_ess() < self.ess_threshold * self.number_of_particles)
+                            if resample:
+                                self.resample()
+                            self.resampled.append(resample)
                             #self.get_state_estimate()
                         #self.get_state_estimate()
                         # Store the model states before and after resampling
@@ -285,8 +410,24 @@ class ParticleFilter(Filter):
                         if self.do_ani:
                             self.ani()
 
-                        print("\tFinished window {}, step {} (took {}s)".format(
-                            self.window_counter, self.time, round(float(time.time() - window_start_time), 2)))
+                        copies = ''
+                        if self.resampled and self.resampled[-1]:
+                            copies = ', copied {} particles in {}s'.format(
+                                self.copy_counts[-1], round(self.copy_times[-1], 4))
+                        if self.nodes is not None:
+                            traffic = self.workers.traffic()
+                            self.communication.append(traffic - self.traffic)
+                            self.traffic = traffic
+                            copies += ', {} MB to and from the nodes'.format(
+                                round(self.communication[-1] / 2 ** 20, 3))
+                        print("\tFinished window {}, step {} (took {}s{})".format(
+                            self.window_counter, self.time, round(float(time.time() - window_start_time), 2),
+                            copies))
+
+                        if self.checkpoint_dir is not None and self.window_counter % self.checkpoint_every == 0:
+                            size, write_time = self.checkpoint()
+                            print("\tSaved checkpoint ({} MB in {}s)".format(
+                                round(size / 2 ** 20, 2), round(write_time, 2)))
                         window_start_time = time.time()
 
                     elif self.multi_step:
@@ -302,42 +443,27 @@ class ParticleFilter(Filter):
                 self.p_save()
 
             # Return the errors and variences before and after sampling (if we're saving information)
-            # Useful for debugging in console:
-            # for i, a in enumerate(zip([x[1] for x in zip(self.before_resample, self.mean_errors) if x[0] == True],
-            #                          [x[1] for x in zip(self.before_resample, self.mean_errors) if x[0] == False])):
-            #    print("{} - before: {}, after: {}".format(i, a[0], a[1]))
+            # Useful for debugging in console: print(self.metrics.records)
             if self.do_save:
-                if self.mean_errors == []:
-                    warnings.warn("For some reason the mean_errors array is empty. Cannot store errors for this run.")
+                if len(self.metrics) == 0:
+                    warnings.warn("For some reason no errors were saved. Cannot store errors for this run.")
                     return
 
-                # Return two tuples, one with the about the error before reweighting, one after
-
-                # Work out which array indices point to results before and after reweighting
-                before_indices = [i for i, x in enumerate(self.before_resample) if x]
-                after_indices = [i for i, x in enumerate(self.before_resample) if not x]
-
-                result = []
-
-                for before in [before_indices, after_indices]:
-                    result.append([
-                        min(np.array(self.mean_errors)[before]),
-                        max(np.array(self.mean_errors)[before]),
-                        np.average(np.array(self.mean_errors)[before]),
-                        min(np.array(self.absolute_errors)[before]),
-                        max(np.array(self.absolute_errors)[before]),
-                        np.average(np.array(self.absolute_errors)[before]),
-                        min(np.array(self.variances)[before]),
-                        max(np.array(self.variances)[before]),
-                        np.average(np.array(self.variances)[before])
-                    ])
-                return result
+                # Return two lists, one with the error before reweighting, one after
+                return [[row[name][stat] for name in self.metrics.summary_fields
+                         for stat in ('min', 'max', 'average')]
+                        for row in self.metrics.summary()]
 
             # If not saving then just return null
             return
 
         finally: # Whatever happens, make sure the multiprocessing pool is colsed
-            self.pool.close()
+            if self.do_resident:
+                self.workers.close()
+            elif self.pool is not None:
+                self.pool.close()
+            self.shared_states.close()
+            self.shared_weights.close()
 
     def predict(self, numiter=1):
         '''
@@ -351,73 +477,46 @@ class ParticleFilter(Filter):
         states. We extract the models and states from the stepped
         particles variable.
 
+        The particles are started first (with Pool.starmap_async, or
+        ParticleWorkers.step_async) and the base model is stepped, or the
+        observations loaded, while they run, so the work of this process is
+        not added to the time of the window.
+
         :param numiter: The number of iterations to step (usually either 1, or the  resample window
         '''
+        if self.do_resident:
+            # The workers step their own particles and write the states in place
+            stepped_particles = self.workers.step_async(numiter, self.particle_std)
+        elif not self.do_ensemble:
+            stepped_particles = self.pool.starmap_async(ParticleFilter.step_particle, list(zip( \
+                range(self.number_of_particles),  # Particle numbers (in integer)
+                [m for m in self.models],  # Associated Models (a Model object)
+                [numiter] * self.number_of_particles,  # Number of iterations to step each particle (an integer)
+                [self.particle_std] * self.number_of_particles,  # Particle std (for adding noise) (a float)
+                [s.shape for s in self.states],  # Shape (for adding noise) (a tuple)
+                [self.shared_states] * self.number_of_particles,  # Where to write the states
+            )))
+
+        self.predict_base_model(numiter)
+
+        if self.do_resident:
+            stepped_particles.get()
+
+        elif self.do_ensemble:
+            # Step all the particles together, each with its own random generator
+            ensemble = ModelEnsemble(self.models)
+            ensemble.step(numiter)
+            noise = np.array([m.rng.normal(0, self.particle_std ** 2, size=s.shape)
+                              for m, s in zip(self.models, self.states)])
+            self.states[:] = ensemble.get_state(sensor='location') + noise
+            ensemble.set_state(self.states, sensor='location')
 
-        time = self.time - numiter
-
-        if self.do_external_data:
-            for i in range(numiter):
-                time = time + 1
-                file_name = self.external_info[0] + 'frame_' + str(time)+ '.0.dat'
-                try:
-                    agentID, x, y = np.loadtxt(file_name,unpack=True)
-                    j = 0
-                    for agent in self.base_model.agents:
-                        if (agent.unique_id in agentID):
-                            
-                            agent.status = 1
-                            agent.location = [x[j], y[j]]
-                            j += 1
-                        elif (agent.status == 1):
-                            agent.status = 2
-                except TypeError:
-                    '''
-                    This error occurs when only one agent is active. In
-                    this case, the data is read as a float instead of an
-                    array.
-                    '''
-                    for agent in self.base_model.agents:
-                        if (agent.unique_id == agentID):
-                            agent.status = 1
-                            agent.location = [x, y]
-                        elif (agent.status == 1):
-                            agent.status = 2
-                except ValueError:
-                    '''
-                     This error occurs when there is no active agent in
-                     the frame.
-                     - Deactivate all active agents.
-                    '''
-                    for agent in self.base_model.agents:
-                        if (agent.status == 1):
-                            agent.status = 2
-
-                except OSError:
-                    '''
-                    This error occurs when there is no external file to
-                    read. It should only occur at the end of the simulation.
-                    - Deactivate all agent.
-                    '''
-                    for agent in self.base_model.agents:
-                        agent.status = 2
-                
         else:
-            for i in range(numiter):
-                self.base_model.step()
-        
-        stepped_particles = self.pool.starmap(ParticleFilter.step_particle, list(zip( \
-            range(self.number_of_particles),  # Particle numbers (in integer)
-            [m for m in self.models],  # Associated Models (a Model object)
-            [numiter] * self.number_of_particles,  # Number of iterations to step each particle (an integer)
-            [self.particle_std] * self.number_of_particles,  # Particle std (for adding noise) (a float)
-            [s.shape for s in self.states],  # Shape (for adding noise) (a tuple)
-        )))
+            # The states are already in self.states
+            for model, (snapshot, state) in zip(self.models, stepped_particles.get()):
+                model.restore(snapshot)
 
-        self.models = [stepped_particles[i][0] for i in range(len(stepped_particles))]
-        self.states = np.array([stepped_particles[i][1] for i in range(len(stepped_particles))])
         self.get_state_estimate()
-        
 
         '''
         for i in range (numiter):
@@ -434,98 +533,255 @@ class ParticleFilter(Filter):
         '''
         return
 
+    def predict_base_model(self, numiter=1):
+        '''
+        Step the base model numiter times, or set it from the observations
+        of the next numiter frames, and find its active agents.
+        '''
+        time = self.time - numiter
+
+        if self.do_external_data:
+            for i in range(numiter):
+                time = time + 1
+                self.observations.update_model(self.base_model, time)
+
+        else:
+            for i in range(numiter):
+                self.base_model.step()
+
+        # The elements of the state (x and y of each agent) that are active in this window
+        self.active_states = self.get_active_states()
+
     def reweight(self):
         '''
         Reweight
 
         DESCRIPTION
         Add noise to the base model state to get a measured state, or
-        use external data to get a measured state. Calculate
-        the distance between the particle states and the measured base model
-        state and then calculate the new particle weights as 1/distance.
-        Add a small term to avoid dividing by 0. Normalise the weights.
+        use external data to get a measured state. Calculate the
+        log-likelihood of the measured state for every particle (by default
+        from the distance between the particle states and the measured base
+        model state, as 1/distance**2) and normalise the weights in log
+        space. With an ess_threshold, the new weights multiply the weights carried
+        over from the last windows (they are added in log space).
         '''
         if self.do_external_data: 
             measured_state = self.base_model.get_state(sensor='location')
         else:        
             measured_state = (self.base_model.get_state(sensor='location')
-                              + np.random.normal(0, self.model_std ** 2, size=self.states.shape))
+                              + self.rng.normal(0, self.model_std ** 2, size=self.states.shape))
 
-        distance = np.linalg.norm(self.states - measured_state, axis=1)
-        self.weights = 1 / (distance + 1e-9) ** 2
-        self.weights /= np.sum(self.weights)
+        # Only the active agents of the base model are observed
+        log_likelihood = self.likelihood.log_likelihood(self.states, measured_state, self.active_states)
+        if self.ess_threshold is None:
+            self.log_weights[:] = log_likelihood
+        else:
+            self.log_weights += log_likelihood
+        self.log_weights[:] = log_normalise(self.log_weights)
+        self.weights[:] = np.exp(self.log_weights)
 
         return
 
+    def get_ess(self):
+        '''
+        Returns the effective sample size of the particle weights (see
+        resampling.effective_sample_size).
+        '''
+        return effective_sample_size(self.log_weights)
+
     def resample(self):
         '''
         Resample
 
         DESCRIPTION
-        Calculate a random partition of (0,1) and then
-        take the cumulative sum of the particle weights.
-        Carry out a systematic resample of particles.
-        Set the new particle states and weights and then
-        update agent locations in particle models using
-        multiprocessing methods.
-        '''
-        offset_partition = ((np.arange(self.number_of_particles)
-                             + np.random.uniform()) / self.number_of_particles)
-        cumsum = np.cumsum(self.weights)
-        i, j = 0, 0
-        while i < self.number_of_particles:
-            if offset_partition[i] < cumsum[j]:
-                self.indexes[i] = j
-                i += 1
-            else:
-                j += 1
+        Choose the particles to keep with the resampling
+        scheme (systematic by default, see resampling.py).
+        The particles that survive keep their place and are
+        not touched, and each of the others is overwritten
+        with a copy of a survivor. Set the new particle states
+        and weights and then update agent locations in the
+        overwritten particle models.
+        '''
+        self.indexes[:] = minimise_copies(resample(self.weights, self.resample_scheme, self.rng))
+        if self.nodes is not None:
+            # Copy the particles inside their own node unless it has too many copies to fill
+            self.indexes[:] = balance_copies(self.indexes, self.workers.shard_of)
+        targets = np.flatnonzero(self.indexes != np.arange(self.number_of_particles))
+        if self.do_save or self.p_save:
+            self.unique_particles.append(self.number_of_particles - len(targets))
+        copy_start = time.time()
 
         self.states[:] = self.states[self.indexes]
-        self.weights[:] = self.weights[self.indexes]
-        
-        if self.pf_method is 'sir':
-            '''
-             In addition to updating and resampling the position of agents 
-             (self.states), we will also resample the speed and gate_out. The
-             ideal would be to pass this information on self.states, but this
-             would require a change in many parts of the code.
-            '''
-            #for the hybrid version, the speed and the gate_out are not resampled!!!
-            for i in range(self.number_of_particles):
-                if (i != self.indexes[i]):
-                    model1 = self.models[i]
-                    model2 = self.models[self.indexes[i]]
-                    for i in range(self.base_model.pop_total):
-                        model1.agents[i].speed = model2.agents[i].speed
-                        model1.agents[i].loc_desire = model2.agents[i].loc_desire
-        
-       
-        # Could use pool.starmap here, but it's quicker to do it in a single process
-        self.models = list(itertools.starmap(ParticleFilter.assign_agents, list(zip(
-            range(self.number_of_particles),  # Particle numbers (in integer)
-            [s for s in self.states],  # States
-            [m for m in self.models]  # Associated Models (a Model object)
-        ))))
+        if self.ess_threshold is None:
+            self.weights[:] = self.weights[self.indexes]
+            self.log_weights[:] = self.log_weights[self.indexes]
+        else:
+            # The resampled particles start again with equal weights
+            self.log_weights[:] = -np.log(self.number_of_particles)
+            self.weights[:] = 1 / self.number_of_particles
+
+        if self.do_resident:
+            # The workers read the resampled states from the shared states
+            self.workers.resample(self.indexes, copy_agents=self.pf_method == 'sir')
+        else:
+            if self.pf_method == 'sir':
+                '''
+                 In addition to updating and resampling the position of agents 
+                 (self.states), we will also resample the speed and gate_out. The
+                 ideal would be to pass this information on self.states, but this
+                 would require a change in many parts of the code.
+                '''
+                #for the hybrid version, the speed and the gate_out are not resampled!!!
+                # The survivors are never overwritten, so they can be copied from directly
+                n = self.base_model.pop_total
+                for i in targets:
+                    source = self.models[self.indexes[i]]
+                    self.models[i].agents_speed[:n] = source.agents_speed[:n]
+                    self.models[i].agents_loc_desire[:n] = source.agents_loc_desire[:n]
+
+            # Could use pool.starmap here, but it's quicker to do it in a single process
+            for i in targets:
+                ParticleFilter.assign_agents(i, self.states[i], self.models[i])
+
+        self.copy_counts.append(len(targets))
+        self.copy_times.append(time.time() - copy_start)
         return
     
+    # The metrics saved by step() that go in a checkpoint (the ones that exist)
+    _checkpoint_metrics = ('metrics', 'mean_states', 'unique_particles', 'resampled', 'copy_counts', 'copy_times',
+                           'communication')
+
+    def checkpoint(self, filename=None):
+        '''
+        Checkpoint
+
+        DESCRIPTION
+        Save everything needed to carry on with the run from the end of
+        this window (see resume): the parameters, the time, the particle
+        states and weights, the snapshots of the base model and of the
+        particles (with their random generators, the arrays of all the
+        particles stacked together), the random generator of the filter,
+        the history of the estimate and the metrics saved so far. The file
+        is written next to the last checkpoint and then renamed over it, so
+        a run that stops while writing keeps the last complete one.
+
+        :param filename: The checkpoint file (default checkpoint_dir/checkpoint.pkl)
+        :return: The size of the file (bytes) and the time it took to write (s)
+        '''
+        start = time.time()
+        if filename is None:
+            filename = os.path.join(self.checkpoint_dir, 'checkpoint.pkl')
+        if self.do_resident:
+            snapshots = self.workers.get_snapshots()
+        else:
+            snapshots = [model.snapshot() for model in self.models]
+        recorder = self.estimate_model.recorder
+        checkpoint = {
+            'ModelClass': self.ModelClass,
+            'model_params': self.model_params,
+            'filter_params': self.filter_params,
+            'time': self.time,
+            'window_counter': self.window_counter,
+            'states': self.states.copy(),
+            'weights': self.weights.copy(),
+            'log_weights': self.log_weights.copy(),
+            'rng': self.rng.bit_generator.state,
+            'base_model': self.base_model.snapshot(),
+            'particles': self._stack_snapshots(snapshots),
+            'estimate_history': (recorder.locations.copy(), recorder.active.copy()),
+            'metrics': {name: getattr(self, name) for name in self._checkpoint_metrics
+                        if hasattr(self, name)},
+        }
+
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        with open(filename + '.tmp', 'wb') as f:
+            pickle.dump(checkpoint, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(filename + '.tmp', filename)
+        return os.path.getsize(filename), time.time() - start
+
+    @classmethod
+    def resume(cls, filename, numcores=None):
+        '''
+        Resume
+
+        DESCRIPTION
+        Make the particle filter saved in a checkpoint (see checkpoint).
+        Calling step() on it carries on with the run from the end of the
+        window it was saved in, and gives the same results as the run
+        that was not stopped.
+
+        :param filename: The checkpoint file
+        :param numcores: The number of processes to use (this does not change the results)
+        :return: The particle filter
+        '''
+        with open(filename, 'rb') as f:
+            checkpoint = pickle.load(f)
+        pf = cls(checkpoint['ModelClass'], checkpoint['model_params'], checkpoint['filter_params'], numcores)
+        pf.time = checkpoint['time']
+        pf.window_counter = checkpoint['window_counter']
+        pf.states[:] = checkpoint['states']
+        pf.weights[:] = checkpoint['weights']
+        pf.log_weights[:] = checkpoint['log_weights']
+        pf.rng.bit_generator.state = checkpoint['rng']
+        pf.base_model.restore(checkpoint['base_model'])
+        pf.active_states = pf.get_active_states()
+
+        snapshots = cls._unstack_snapshots(checkpoint['particles'])
+        for model, snapshot in zip(pf.models, snapshots):
+            model.restore(snapshot)
+        if pf.do_resident:
+            pf.workers.restore(snapshots)
+
+        for locations, active in zip(*checkpoint['estimate_history']):
+            pf.estimate_model.recorder.record(locations, active)
+        for name, value in checkpoint['metrics'].items():
+            setattr(pf, name, value)
+        return pf
+
+    @staticmethod
+    def _stack_snapshots(snapshots):
+        '''
+        Returns the snapshots of the particles as one dictionary, with the
+        arrays of all the particles stacked (number_of_particles, ...).
+        '''
+        stacked = {}
+        for key in snapshots[0]:
+            values = [snapshot[key] for snapshot in snapshots]
+            if isinstance(values[0], np.ndarray):
+                values = np.stack(values)
+            stacked[key] = values
+        return stacked
+
+    @staticmethod
+    def _unstack_snapshots(stacked):
+        '''
+        Returns the list of snapshots that _stack_snapshots stacked.
+        '''
+        number_of_particles = len(next(iter(stacked.values())))
+        return [{key: values[i] for key, values in stacked.items()}
+                for i in range(number_of_particles)]
+
+    def get_active_states(self):
+        '''
+        Returns which elements of the state (x and y of each agent) belong to
+        the agents that are active in the base model.
+        '''
+        return np.repeat(self.base_model.agents_status[:self.base_model.pop_total] == 1, 2)
+
     def get_state_estimate(self):
         '''
         # Save particles location estimate.
         '''
-        active_states = [agent.status == 1 for agent in self.base_model.agents for _ in range(2)]
-        if any(active_states):
-            # Mean and variance state of all particles, weighted by their distance to the observation
-            mean = np.average(self.states[:, active_states], weights=self.weights, axis=0)
-            #variance = np.average((self.states[:, active_states] - mean) ** 2, weights=self.weights, axis=0)
-
-        i = 0
-        for agent in self.base_model.agents:
-            unique_id = agent.unique_id
-            if agent.status == 1:                
-                self.estimate_model.agents[unique_id].history_locations.append((mean[i], mean[i+1]))
-                i += 2
-            else:
-                self.estimate_model.agents[unique_id].history_locations.append((None, None))
+        # Record the estimate in the history of the estimate model (inactive agents are NaN)
+        active = self.active_states[::2]
+        locations = np.zeros((len(active), 2))
+        if np.any(active):
+            # Mean state of all particles, weighted by their distance to the observation
+            weights = self.weights / np.sum(self.weights)
+            locations[active] = np.reshape(weights @ self.states[:, self.active_states], (-1, 2))
+        self.estimate_model.recorder.record(locations, active)
 
     def save(self, before: bool):
         '''
@@ -534,30 +790,35 @@ class ParticleFilter(Filter):
         DESCRIPTION
         Calculate number of active agents, mean, and variance
         of particles and calculate mean error between the mean
-        and the true base model state.
+        and the true base model state. They are recorded in
+        self.metrics (see MetricsAccumulator) in every window, with NaN
+        errors and variance when there are no active agents.
 
         :param before: whether this is being called before or after resampling as this will have a big impact on
         what the errors mean (if they're after resampling then they should be low, before and they'll be high)
         '''
-        self.active_agents.append(sum([agent.status == 1 for agent in self.base_model.agents]))
-
-        active_states = [agent.status == 1 for agent in self.base_model.agents for _ in range(2)]
+        active_states = self.active_states
+        mean_error = absolute_error = mean_variance = np.nan
 
-        if any(active_states):
+        if np.any(active_states):
             # Mean and variance state of all particles, weighted by their distance to the observation
-            mean = np.average(self.states[:, active_states], weights=self.weights, axis=0)
-            unweighted_mean = np.average(self.states[:, active_states], axis=0)
-            variance = np.average((self.states[:, active_states] - mean) ** 2, weights=self.weights, axis=0)
+            states = self.states[:, active_states]
+            mean, variance = weighted_moments(states, self.weights)
+            unweighted_mean = np.average(states, axis=0)
+            truth_state = self.base_model.get_state(sensor='location')[active_states]
 
             self.mean_states.append(mean)
-            self.variances.append(np.average(variance))
-            self.before_resample.append(before)  # Whether this save reflects the errors before or after resampling
-
-            truth_state = self.base_model.agents2state()
-            self.mean_errors.append(np.linalg.norm(mean - truth_state[active_states], axis=0))
-            self.absolute_errors.append(np.linalg.norm(unweighted_mean - truth_state[active_states], axis=0))
-
-            # min(mean_errors) is returning empty. CHeck small values for agents/particles
+            mean_error = np.linalg.norm(mean - truth_state)
+            absolute_error = np.linalg.norm(unweighted_mean - truth_state)
+            mean_variance = np.average(variance)
+
+        self.metrics.record(window=self.window_counter, time=self.time,
+                            before=before,  # Whether this save reflects the errors before or after resampling
+                            active_agents=np.count_nonzero(active_states) // 2,
+                            mean_error=mean_error,
+                            absolute_error=absolute_error,
+                            variance=mean_variance,
+                            ess=self.get_ess())
 
         return
 
@@ -568,18 +829,20 @@ class ParticleFilter(Filter):
         DESCRIPTION
         Plot active agents, mean error and mean variance.
         '''
+        records = self.metrics.records
+
         plt.figure(2)
-        plt.plot(self.active_agents)
+        plt.plot(records['active_agents'])
         plt.ylabel('Active agents')
         plt.show()
 
         plt.figure(3)
-        plt.plot(self.mean_errors)
+        plt.plot(records['mean_error'])
         plt.ylabel('Mean Error')
         plt.show()
 
         plt.figure(4)
-        plt.plot(self.variances)
+        plt.plot(records['variance'])
         plt.ylabel('Mean Variance')
         plt.show()
 
@@ -588,10 +851,18 @@ class ParticleFilter(Filter):
         plt.ylabel('Unique Particles')
         plt.show()
 
-        print('Max mean error = ', max(self.mean_errors))
-        print('Average mean error = ', np.average(self.mean_errors))
-        print('Max mean variance = ', max(self.variances[2:]))
-        print('Average mean variance = ', np.average(self.variances[2:]))
+        plt.figure(6)
+        plt.plot(records['ess'])
+        plt.ylabel('Effective Sample Size')
+        plt.show()
+
+        # The errors and variances of the windows with active agents
+        mean_errors = records['mean_error'][records['active_agents'] > 0]
+        variances = records['variance'][records['active_agents'] > 0]
+        print('Max mean error = ', max(mean_errors))
+        print('Average mean error = ', np.average(mean_errors))
+        print('Max mean variance = ', max(variances[2:]))
+        print('Average mean variance = ', np.average(variances[2:]))
 
     def ani(self):
         '''
@@ -608,6 +879,11 @@ class ParticleFilter(Filter):
         '''
         if any([agent.status == 1 for agent in self.base_model.agents]):
 
+            if self.do_resident:
+                # Bring the particles back from the workers to plot them
+                for model, snapshot in zip(self.models, self.workers.get_snapshots()):
+                    model.restore(snapshot)
+
             if not self.show_ani:
                 # Turn interactive plotting off
                 plt.ioff()
@@ -615,7 +891,7 @@ class ParticleFilter(Filter):
             fig = plt.figure(len(self.animation)+1) # Make sure figures aren't overridden
             plt.clf()
 
-            markersizes = self.weights
+            markersizes = self.weights.copy()  # Scaling in place would change the weights
             if np.std(markersizes) != 0:
                 markersizes *= 4 / np.std(markersizes)  # revar
             markersizes += 8 - np.mean(markersizes)  # remean
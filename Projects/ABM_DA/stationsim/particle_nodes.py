@@ -0,0 +1,223 @@
+'''
+Particle nodes: resident particle workers on other machines, over TCP.
+
+A particle node is a daemon that holds a shard of the particles of a filter
+(see ParticleWorkers) and runs its commands. It is started on every machine
+of a run with
+
+    STATIONSIM_AUTHKEY=<key> python particle_nodes.py <port> [<host>]
+
+and serves one filter after another. ParticleNodes connects to the nodes,
+with the same key, and sends each its shard once. Unlike the workers, the
+nodes do not share memory with the filter: a node sends back the states of
+its particles after a step, and gets the states of the particles that are
+overwritten by a resample. ParticleNodes counts the bytes that go through
+the connections (bytes_sent, bytes_received).
+
+ParticleNodes(models, 4) starts four nodes on this machine instead, to test
+a run on one host.
+'''
+import multiprocessing
+from multiprocessing.connection import Listener, Client
+import os
+import pickle
+import sys
+import numpy as np
+from particle_workers import ParticleWorkers, _Pending, _commands, _step, _set_state
+from shared_arrays import SharedArray
+
+
+def _step_rows(models, states, num_iter, particle_std):
+    '''
+    Step the models (see particle_workers._step) and return their states.
+    '''
+    _step(models, states, num_iter, particle_std)
+    return states
+
+
+def _set_rows(models, states, particles, rows):
+    '''
+    Copy rows into the states of the particles (all by default) and set the
+    locations of their agents from them.
+    '''
+    if particles is None:
+        states[:] = rows
+    else:
+        states[particles] = rows
+    _set_state(models, states, particles)
+
+
+_node_commands = dict(_commands, step=_step_rows, set_state=_set_rows)
+
+
+def _serve_filter(connection):
+    '''
+    Run the commands of a filter, starting with its shard ('init', (models,
+    dimensions)), until it closes the connection.
+    '''
+    try:
+        command, (models, dimensions) = connection.recv()
+    except EOFError:
+        return
+    states = np.zeros((len(models), dimensions))
+    connection.send((True, None))
+    while True:
+        try:
+            command, args = connection.recv()
+        except EOFError:
+            return
+        if command == 'close':
+            return
+        try:
+            connection.send((True, _node_commands[command](models, states,
+                                                           *args)))
+        except Exception as error:
+            connection.send((False, error))
+
+
+def serve(address, authkey, ready=None, sessions=None):
+    '''
+    Run a particle node on address (host, port): serve the filters that
+    connect with authkey, one after another, until sessions filters have
+    been served (forever by default). If ready is a connection, the address
+    the node listens on is sent to it once it does (to use port 0).
+    '''
+    with Listener(address, authkey=authkey) as listener:
+        if ready is not None:
+            ready.send(listener.address)
+            ready.close()
+        served = 0
+        while sessions is None or served < sessions:
+            with listener.accept() as connection:
+                _serve_filter(connection)
+            served += 1
+
+
+def start_local_nodes(number, authkey):
+    '''
+    Start number nodes on this machine, on free ports, that serve one
+    filter each. Returns the processes and their addresses.
+    '''
+    processes, addresses = [], []
+    for _ in range(number):
+        parent, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(
+            target=serve, args=(('localhost', 0), authkey, child, 1),
+            daemon=True)
+        process.start()
+        child.close()
+        addresses.append(parent.recv())
+        parent.close()
+        processes.append(process)
+    return processes, addresses
+
+
+def parse_address(node):
+    '''
+    Returns the (host, port) of a node given as 'host:port' or (host, port).
+    '''
+    if isinstance(node, str):
+        host, port = node.rsplit(':', 1)
+        return host, int(port)
+    host, port = node
+    return host, int(port)
+
+
+class ParticleNodes(ParticleWorkers):
+    '''
+    ParticleWorkers on particle nodes, connected over TCP (see serve).
+
+    nodes is the list of the addresses of running nodes ('host:port' or
+    (host, port)), which need authkey, or the number of nodes to start on
+    this machine. Particle i lives in node shard_of[i]. The states of all
+    the particles are gathered in states (a SharedArray, or one created
+    here) after every step, so the filter uses them as with the workers.
+    '''
+
+    def __init__(self, models, nodes, authkey=None, states=None):
+        if isinstance(authkey, str):
+            authkey = authkey.encode()
+        if isinstance(nodes, int):
+            if authkey is None:
+                authkey = os.urandom(16)
+            self.processes, nodes = start_local_nodes(min(nodes, len(models)),
+                                                      authkey)
+        else:
+            if authkey is None:
+                raise ValueError('The particle nodes need an authkey (or '
+                                 'STATIONSIM_AUTHKEY) to connect to them')
+            self.processes = []
+        addresses = [parse_address(node) for node in nodes]
+        n = len(models)
+        dimensions = len(models[0].get_state(sensor='location'))
+        self.own_states = states is None
+        if self.own_states:
+            states = SharedArray((n, dimensions))
+        self.states = states
+        self._split(n, len(addresses))
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+        self.connections = [Client(address, authkey=authkey)
+                            for address in addresses[:len(self.shards)]]
+        self._call({w: ('init', ([models[i] for i in shard], dimensions))
+                    for w, shard in enumerate(self.shards)})
+
+    def _send(self, commands):
+        '''
+        Send {node: (command, args)} to the nodes and return the _Pending
+        results, counting the bytes sent.
+        '''
+        for node, command in commands.items():
+            data = pickle.dumps(command, protocol=pickle.HIGHEST_PROTOCOL)
+            self.connections[node].send_bytes(data)
+            self.bytes_sent += len(data)
+        return _Pending(self, list(commands))
+
+    def _receive(self, nodes):
+        '''
+        Wait for the nodes to finish their commands and return {node:
+        result}, counting the bytes received.
+        '''
+        results = {}
+        for node in nodes:
+            data = self.connections[node].recv_bytes()
+            self.bytes_received += len(data)
+            ok, result = pickle.loads(data)
+            if not ok:
+                raise result
+            results[node] = result
+        return results
+
+    def _write_states(self, results):
+        for node, rows in results.items():
+            self.states.array[self.shards[node]] = rows
+
+    def _set_state_command(self, node, particles=None):
+        shard = self.shards[node]
+        rows = shard if particles is None else shard[particles]
+        return 'set_state', (particles, self.states.array[rows])
+
+    def step_async(self, num_iter, particle_std):
+        '''
+        Start stepping the particles (see ParticleWorkers.step_async). get()
+        on the returned object also writes their states in the states.
+        '''
+        pending = super().step_async(num_iter, particle_std)
+        pending.finish = self._write_states
+        return pending
+
+    def traffic(self):
+        '''
+        Returns the number of bytes sent to and received from the nodes.
+        '''
+        return self.bytes_sent + self.bytes_received
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3) or 'STATIONSIM_AUTHKEY' not in os.environ:
+        sys.exit('Usage: STATIONSIM_AUTHKEY=<key> python particle_nodes.py '
+                 '<port> [<host> (default localhost, 0.0.0.0 for every '
+                 'interface)]')
+    host = sys.argv[2] if len(sys.argv) == 3 else 'localhost'
+    serve((host, int(sys.argv[1])), os.environ['STATIONSIM_AUTHKEY'].encode())
@@ -0,0 +1,304 @@
+'''
+Worker processes that keep the particles of a particle filter resident.
+
+Each worker gets a fixed, contiguous shard of the particle models when it
+starts and keeps it for the whole run. The particle states live in a
+SharedArray (see shared_arrays) that every worker writes its rows of after
+a step and reads them from after a resample, so only small commands go
+through the pipes: the number of steps and the noise to apply, and the
+agent parameters that have to be copied between particles when they are
+resampled.
+'''
+import multiprocessing
+import numpy as np
+from shared_arrays import SharedArray
+
+
+def _step(models, states, num_iter, particle_std):
+    '''
+    Step the models, add noise to their locations and write the states in
+    their rows of the shared states (see ParticleFilter.step_particle).
+    '''
+    for model, state in zip(models, states):
+        for _ in range(num_iter):
+            model.step()
+        noise = model.rng.normal(0, particle_std ** 2, size=state.shape)
+        state[:] = model.get_state(sensor='location') + noise
+        model.set_state(state, sensor='location')
+
+
+def _set_state(models, states, particles=None):
+    if particles is None:
+        particles = range(len(models))
+    for i in particles:
+        models[i].set_state(states[i], sensor='location')
+
+
+def _get_agents(models, states, particles):
+    n = models[0].pop_total
+    return (np.array([models[i].agents_speed[:n] for i in particles]),
+            np.array([models[i].agents_loc_desire[:n] for i in particles]))
+
+
+def _set_agents(models, states, particles, speed, loc_desire):
+    n = models[0].pop_total
+    for i, s, loc in zip(particles, speed, loc_desire):
+        models[i].agents_speed[:n] = s
+        models[i].agents_loc_desire[:n] = loc
+
+
+def _copy_agents(models, states, targets, sources):
+    # Read every source before writing, as a target can also be a source
+    _set_agents(models, states, targets,
+                *_get_agents(models, states, sources))
+
+
+def _get_snapshots(models, states):
+    return [model.snapshot() for model in models]
+
+
+def _restore(models, states, snapshots):
+    for model, snapshot in zip(models, snapshots):
+        model.restore(snapshot)
+
+
+_commands = {'step': _step, 'set_state': _set_state,
+             'get_agents': _get_agents, 'set_agents': _set_agents,
+             'copy_agents': _copy_agents, 'get_snapshots': _get_snapshots,
+             'restore': _restore}
+
+
+def _serve(connection, models, shared, rows):
+    '''
+    Run the commands sent by ParticleWorkers on a shard of models, whose
+    states are the rows of the shared states, until the connection is
+    closed.
+    '''
+    states = shared.array[rows]
+    while True:
+        try:
+            command, args = connection.recv()
+        except EOFError:
+            return
+        if command == 'close':
+            return
+        try:
+            connection.send((True, _commands[command](models, states,
+                                                      *args)))
+        except Exception as error:
+            connection.send((False, error))
+
+
+class _Pending:
+    '''
+    The results of commands sent to some workers, received by get.
+    '''
+
+    def __init__(self, workers, sent_to, finish=None):
+        self.workers = workers
+        self.sent_to = sent_to
+        self.finish = finish
+        self.results = None
+
+    def get(self):
+        if self.results is None:
+            self.results = self.workers._receive(self.sent_to)
+            if self.finish is not None:
+                self.finish(self.results)
+        return self.results
+
+
+class ParticleWorkers:
+    '''
+    A pool of processes, each one holding a shard of the particle models
+    of a filter (see ParticleFilter with do_resident=True).
+
+    Particle i lives in worker shard_of[i], at position local[i] of its
+    shard, and its state is row i of states, a SharedArray
+    (number_of_particles, dimensions). The filter can pass its own states
+    array so the workers write into it; otherwise one is created and freed
+    by close. Every model brings its own random number generator, so the
+    results are the same as stepping the particles in a
+    multiprocessing.Pool, whatever the number of workers.
+    '''
+
+    def __init__(self, models, numcores=None, states=None):
+        if numcores is None:
+            numcores = multiprocessing.cpu_count()
+        n = len(models)
+        self.own_states = states is None
+        if self.own_states:
+            dimensions = len(models[0].get_state(sensor='location'))
+            states = SharedArray((n, dimensions))
+        self.states = states
+        self._split(n, numcores)
+
+        self.connections = []
+        self.processes = []
+        for shard in self.shards:
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=_serve, args=(child, [models[i] for i in shard],
+                                     states, slice(shard[0], shard[-1] + 1)),
+                daemon=True)
+            process.start()
+            child.close()
+            self.connections.append(parent)
+            self.processes.append(process)
+
+    def _split(self, n, numcores):
+        '''
+        Split the n particles in contiguous shards, one per worker.
+        '''
+        numcores = max(1, min(numcores, n))
+        self.number_of_particles = n
+        self.shards = np.array_split(np.arange(n), numcores)
+        self.shard_of = np.concatenate([np.full(len(shard), w) for w, shard
+                                        in enumerate(self.shards)])
+        self.local = np.concatenate([np.arange(len(shard))
+                                     for shard in self.shards])
+
+    def _set_state_command(self, worker, particles=None):
+        '''
+        Returns the command that sets the locations of the agents of the
+        particles (positions in the shard, all by default) of a worker
+        from their states.
+        '''
+        return 'set_state', (() if particles is None else (particles,))
+
+    def _send(self, commands):
+        '''
+        Send {worker: (command, args)} to the workers, so they run at the
+        same time, and return the _Pending results.
+        '''
+        for worker, command in commands.items():
+            self.connections[worker].send(command)
+        return _Pending(self, list(commands))
+
+    def _receive(self, workers):
+        '''
+        Wait for the workers to finish their commands and return
+        {worker: result}.
+        '''
+        results = {}
+        for worker in workers:
+            ok, result = self.connections[worker].recv()
+            if not ok:
+                raise result
+            results[worker] = result
+        return results
+
+    def _call(self, commands):
+        '''
+        Send {worker: (command, args)} to the workers, so they run at the
+        same time, and return {worker: result}.
+        '''
+        return self._send(commands).get()
+
+    def step_async(self, num_iter, particle_std):
+        '''
+        Start stepping the particles (see step) and return at once. get()
+        on the returned object waits for the workers, like the AsyncResult
+        of multiprocessing.Pool.starmap_async; no other command can be sent
+        until then.
+        '''
+        return self._send({w: ('step', (num_iter, particle_std))
+                           for w in range(len(self.shards))})
+
+    def step(self, num_iter, particle_std):
+        '''
+        Step every particle num_iter times and add noise to the locations
+        of the agents. The workers write the states in the shared states,
+        which are returned (number_of_particles, dimensions).
+        '''
+        self.step_async(num_iter, particle_std).get()
+        return self.states.array
+
+    def set_states(self, states=None):
+        '''
+        Set the locations of the agents of every particle from the shared
+        states, after copying states into them if it is given.
+        '''
+        if states is not None and states is not self.states.array:
+            self.states.array[:] = states
+        self._call({w: self._set_state_command(w)
+                    for w in range(len(self.shards))})
+
+    def resample(self, indexes, states=None, copy_agents=False):
+        '''
+        Particle i becomes a copy of particle indexes[i]: it gets the state
+        states[i] (by default, the shared states, already resampled by the
+        filter) and, if copy_agents is True, the speeds and destinations
+        of the agents of particle indexes[i]. Only the particles with
+        indexes[i] != i are touched (see resampling.minimise_copies).
+        Copies inside a worker are done there, and the agents of the
+        particles copied to another worker go through the parent once,
+        however many copies are made of them.
+        '''
+        if states is not None and states is not self.states.array:
+            self.states.array[:] = states
+        targets = np.flatnonzero(indexes != np.arange(len(indexes)))
+        sources = np.asarray(indexes)[targets]
+        if copy_agents and len(targets):
+            same = self.shard_of[targets] == self.shard_of[sources]
+
+            # Collect the agents that move between workers first
+            cross = {}
+            for w in np.unique(self.shard_of[sources[~same]]):
+                cross[w] = np.unique(
+                    sources[~same & (self.shard_of[sources] == w)])
+            fetched = self._call({w: ('get_agents', (self.local[particles],))
+                                  for w, particles in cross.items()})
+
+            commands = {}
+            for w in range(len(self.shards)):
+                rows = np.flatnonzero(same & (self.shard_of[targets] == w))
+                if len(rows):
+                    commands[w] = ('copy_agents', (self.local[targets[rows]],
+                                                   self.local[sources[rows]]))
+            self._call(commands)
+            commands = {}
+            for v in np.unique(self.shard_of[targets[~same]]):
+                rows = np.flatnonzero(~same & (self.shard_of[targets] == v))
+                speed, loc_desire = [], []
+                for source in sources[rows]:
+                    w = self.shard_of[source]
+                    k = np.searchsorted(cross[w], source)
+                    speed.append(fetched[w][0][k])
+                    loc_desire.append(fetched[w][1][k])
+                commands[v] = ('set_agents', (self.local[targets[rows]],
+                                              np.array(speed),
+                                              np.array(loc_desire)))
+            self._call(commands)
+
+        self._call({w: self._set_state_command(
+                        w, self.local[targets[self.shard_of[targets] == w]])
+                    for w in np.unique(self.shard_of[targets])})
+
+    def get_snapshots(self):
+        '''
+        Returns the snapshot (see Model.snapshot) of every particle.
+        '''
+        results = self._call({w: ('get_snapshots', ())
+                              for w in range(len(self.shards))})
+        return [snapshot for w in range(len(self.shards))
+                for snapshot in results[w]]
+
+    def restore(self, snapshots):
+        '''
+        Load the snapshot (see Model.restore) of every particle.
+        '''
+        self._call({w: ('restore', ([snapshots[i] for i in shard],))
+                    for w, shard in enumerate(self.shards)})
+
+    def close(self):
+        for connection in self.connections:
+            try:
+                connection.send(('close', ()))
+            except (BrokenPipeError, OSError):
+                pass
+            connection.close()
+        for process in self.processes:
+            process.join()
+        if self.own_states:
+            self.states.close()
@@ -0,0 +1,91 @@
+'''
+Metrics of the particle filters, kept in preallocated numpy arrays.
+
+MetricsAccumulator has a row (see MetricsAccumulator.dtype) for every time
+the filter saves its errors, before and after resampling in each window,
+and summarises them as structured arrays instead of nested lists.
+'''
+import numpy as np
+
+
+def weighted_moments(states, weights):
+    '''
+    Returns the weighted mean and variance over the particles of the states
+    (number_of_particles, dimensions), each of shape (dimensions,).
+    '''
+    weights = np.asarray(weights, dtype=float)
+    weights = weights / np.sum(weights)
+    mean = weights @ states
+    variance = weights @ (states - mean) ** 2
+    return mean, variance
+
+
+class MetricsAccumulator:
+    '''
+    The metrics of every save of a particle filter, in a structured array
+    that doubles in size when it is full:
+    - window, time: the window and step of the save,
+    - before: whether it was saved before resampling (or after),
+    - active_agents: the number of active agents in the base model,
+    - mean_error: distance between the weighted mean state of the
+      particles and the true state (NaN without active agents),
+    - absolute_error: the same for the unweighted mean state,
+    - variance: average weighted variance of the particle states,
+    - ess: effective sample size of the weights.
+    '''
+
+    dtype = np.dtype([('window', '<i4'), ('time', '<i4'), ('before', '?'),
+                      ('active_agents', '<i4'), ('mean_error', '<f8'),
+                      ('absolute_error', '<f8'), ('variance', '<f8'),
+                      ('ess', '<f8')])
+
+    # The metrics summarised by summary
+    summary_fields = ('mean_error', 'absolute_error', 'variance')
+
+    def __init__(self, capacity=64):
+        self._records = np.zeros(max(1, capacity), dtype=self.dtype)
+        self.n_records = 0
+
+    def __len__(self):
+        return self.n_records
+
+    def record(self, **values):
+        '''
+        Add a save with the values of the fields in dtype.
+        '''
+        if self.n_records == len(self._records):
+            records = np.zeros(2 * len(self._records), dtype=self.dtype)
+            records[:self.n_records] = self._records
+            self._records = records
+        row = self._records[self.n_records]
+        for name, value in values.items():
+            row[name] = value
+        self.n_records += 1
+
+    @property
+    def records(self):
+        return self._records[:self.n_records]
+
+    def summary(self):
+        '''
+        Returns a structured array with two rows, the saves before
+        resampling and the ones after, and the min, max and average of
+        each of summary_fields over them, leaving out the NaNs of the saves
+        without active agents (NaN if there are none).
+        '''
+        stats = [('min', '<f8'), ('max', '<f8'), ('average', '<f8')]
+        dtype = [('before', '?')] + [(name, stats)
+                                     for name in self.summary_fields]
+        summary = np.zeros(2, dtype=dtype)
+        records = self.records
+        for row, before in zip(summary, (True, False)):
+            row['before'] = before
+            selected = records[records['before'] == before]
+            for name in self.summary_fields:
+                values = selected[name]
+                values = values[~np.isnan(values)]
+                if len(values):
+                    row[name] = (values.min(), values.max(), values.mean())
+                else:
+                    row[name] = (np.nan, np.nan, np.nan)
+        return summary
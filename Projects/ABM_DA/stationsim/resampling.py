@@ -0,0 +1,179 @@
+'''
+Resampling schemes for the particle filters.
+
+Every scheme takes normalised (or at least non-negative) particle weights
+and returns the indexes of the particles to keep: particle i of the new set
+is a copy of particle indexes[i]. They are vectorized with np.searchsorted
+on the cumulative sum of the weights, so resampling a million particles
+takes milliseconds instead of a Python loop over every particle.
+
+The random numbers come from rng, a np.random.Generator (or anything with
+the same random and exponential methods, like the np.random module for the
+filters that still use the global generator). systematic() with a
+Generator gives the same indexes as the loop the filters used before.
+'''
+import numpy as np
+
+
+def _cumsum(weights):
+    '''
+    Returns the cumulative sum of the weights, scaled so that it ends at
+    exactly 1 (rounding would otherwise leave the last uniforms without a
+    particle).
+    '''
+    cumsum = np.cumsum(weights, dtype=float)
+    cumsum /= cumsum[-1]
+    cumsum[-1] = 1
+    return cumsum
+
+
+def _search(weights, positions):
+    '''
+    Returns, for every position in [0, 1), the first particle whose
+    cumulative weight is above it.
+    '''
+    return np.searchsorted(_cumsum(weights), positions, side='right')
+
+
+def _sorted_uniforms(n, rng):
+    '''
+    Returns n sorted independent uniforms in [0, 1), from the normalised
+    cumulative sum of n + 1 exponentials. This is quicker than sorting, and
+    sorted positions make np.searchsorted much quicker on large arrays.
+    '''
+    cumsum = np.cumsum(rng.exponential(size=n + 1))
+    return cumsum[:-1] / cumsum[-1]
+
+
+def systematic(weights, rng=None):
+    '''
+    Systematic resampling: a single uniform offset, shared by N evenly
+    spaced positions (i + u) / N.
+    '''
+    rng = np.random.default_rng() if rng is None else rng
+    n = len(weights)
+    return _search(weights, (np.arange(n) + rng.random()) / n)
+
+
+def stratified(weights, rng=None):
+    '''
+    Stratified resampling: one uniform position in each of the N strata
+    [i / N, (i + 1) / N).
+    '''
+    rng = np.random.default_rng() if rng is None else rng
+    n = len(weights)
+    return _search(weights, (np.arange(n) + rng.random(n)) / n)
+
+
+def multinomial(weights, rng=None):
+    '''
+    Multinomial resampling: N independent draws from the weights (returned
+    sorted).
+    '''
+    rng = np.random.default_rng() if rng is None else rng
+    return _search(weights, _sorted_uniforms(len(weights), rng))
+
+
+def residual(weights, rng=None):
+    '''
+    Residual resampling: particle i is copied floor(N * w_i) times, and
+    the remaining particles are drawn (multinomially) from the leftover
+    weights N * w_i - floor(N * w_i).
+    '''
+    rng = np.random.default_rng() if rng is None else rng
+    n = len(weights)
+    scaled = n * np.asarray(weights, dtype=float) / np.sum(weights)
+    counts = np.floor(scaled).astype(int)
+    indexes = np.repeat(np.arange(n), counts)
+    remaining = n - len(indexes)
+    if remaining == 0:
+        return indexes
+    residuals = scaled - counts
+    drawn = _search(residuals, _sorted_uniforms(remaining, rng))
+    return np.sort(np.concatenate([indexes, drawn]))
+
+
+def minimise_copies(indexes):
+    '''
+    Returns the same resampled particles as indexes, in an order where every
+    particle that survives keeps its own place (indexes[j] == j) and only
+    the places of the particles that die get a copy of another particle.
+    The particles that have to be copied are then never overwritten, and
+    the ones that are kept do not have to be touched at all.
+    '''
+    indexes = np.asarray(indexes)
+    n = len(indexes)
+    counts = np.bincount(indexes, minlength=n)
+    survivors = counts > 0
+    kept = np.empty(n, dtype=indexes.dtype)
+    kept[survivors] = np.flatnonzero(survivors)
+    # Every survivor fills the places of the dead with its extra copies
+    kept[~survivors] = np.repeat(np.arange(n), np.maximum(counts - 1, 0))
+    return kept
+
+
+def balance_copies(indexes, shard_of):
+    '''
+    Returns the same resampled particles as indexes, from minimise_copies,
+    with the copies of every particle given to the places of the particles
+    that die in its own shard (shard_of[i] is the shard of particle i, for
+    example the node that steps it) as far as there are any. Copies only
+    go to another shard when a shard has more copies than places to fill,
+    so the fewest particles move between shards.
+    '''
+    indexes = np.asarray(indexes)
+    shard_of = np.asarray(shard_of)
+    targets = np.flatnonzero(indexes != np.arange(len(indexes)))
+    sources = indexes[targets]
+    balanced = indexes.copy()
+    spare_targets, spare_sources = [], []
+    for shard in np.unique(shard_of[targets]):
+        places = targets[shard_of[targets] == shard]
+        copies = sources[shard_of[sources] == shard]
+        k = min(len(places), len(copies))
+        balanced[places[:k]] = copies[:k]
+        spare_targets.append(places[k:])
+        spare_sources.append(copies[k:])
+    # The shards that have no places to fill only have spare copies
+    for shard in np.setdiff1d(shard_of[sources], shard_of[targets]):
+        spare_sources.append(sources[shard_of[sources] == shard])
+    if spare_targets:
+        balanced[np.concatenate(spare_targets)] = np.concatenate(spare_sources)
+    return balanced
+
+
+def log_normalise(log_weights):
+    '''
+    Returns the log weights minus their log sum (logsumexp), so that their
+    exponentials add up to 1, without overflowing or underflowing.
+    '''
+    log_weights = np.asarray(log_weights, dtype=float)
+    top = np.max(log_weights)
+    return log_weights - (top + np.log(np.sum(np.exp(log_weights - top))))
+
+
+def effective_sample_size(log_weights):
+    '''
+    Returns the effective sample size 1 / sum(w_i ** 2) of the particles,
+    from their (not necessarily normalised) log weights. It is N when all
+    the weights are equal and 1 when a single particle has all of them.
+    '''
+    log_weights = log_normalise(log_weights)
+    return 1 / np.sum(np.exp(2 * log_weights))
+
+
+schemes = {'systematic': systematic, 'stratified': stratified,
+           'multinomial': multinomial, 'residual': residual}
+
+
+def resample(weights, scheme='systematic', rng=None):
+    '''
+    Returns the indexes of the particles to keep, with the scheme named
+    (one of the keys of schemes).
+    '''
+    try:
+        function = schemes[scheme]
+    except KeyError:
+        raise ValueError(f'Unknown resampling scheme {scheme!r}, use one of '
+                         f'{sorted(schemes)}')
+    return function(weights, rng)
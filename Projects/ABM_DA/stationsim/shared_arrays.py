@@ -0,0 +1,70 @@
+'''
+Numpy arrays in shared memory, for the particle filters.
+
+A SharedArray keeps its data in a multiprocessing.shared_memory block. It is
+pickled as the name, shape and dtype of the block, so sending it to a pool
+or a worker process costs nothing, and the other process attaches to the
+same memory: what it writes in the array is seen by the parent without
+copying or pickling the data back.
+
+The process that creates the array owns the block and has to free it once
+every process has attached to it (see close).
+'''
+from multiprocessing import shared_memory
+import numpy as np
+
+
+class _Mapping:
+    '''
+    The base of the arrays of a SharedArray. It holds the shared memory, so
+    the memory stays mapped for as long as any view of the array is alive.
+    '''
+
+    def __init__(self, memory, shape, dtype):
+        self.memory = memory
+        address = np.frombuffer(memory.buf, np.uint8).__array_interface__
+        self.__array_interface__ = {'version': 3, 'shape': shape,
+                                    'typestr': dtype.str, 'descr': dtype.descr,
+                                    'data': (address['data'][0], False)}
+
+
+class SharedArray:
+    '''
+    A numpy array, .array, stored in shared memory.
+
+    SharedArray(shape, dtype) creates a new block filled with zeros;
+    SharedArray(shape, dtype, name=name) attaches to an existing one.
+    '''
+
+    def __init__(self, shape, dtype=float, name=None):
+        self.shape = tuple(np.atleast_1d(shape))
+        self.dtype = np.dtype(dtype)
+        size = max(1, int(np.prod(self.shape)) * self.dtype.itemsize)
+        self.owner = name is None
+        memory = shared_memory.SharedMemory(name=name, create=self.owner,
+                                            size=size)
+        self.name = memory.name
+        self.array = np.asarray(_Mapping(memory, self.shape, self.dtype))
+        if self.owner:
+            self.array[...] = 0
+
+    def __getstate__(self):
+        return self.shape, self.dtype, self.name
+
+    def __setstate__(self, state):
+        shape, dtype, name = state
+        self.__init__(shape, dtype, name=name)
+
+    def __len__(self):
+        return len(self.array)
+
+    def close(self):
+        '''
+        Free the block if this is the array that created it: no other
+        process can attach to it after, and the memory is given back when
+        the last view of the array, in any process, is gone.
+        '''
+        self.array = None
+        if self.owner:
+            shared_memory.SharedMemory(name=self.name).unlink()
+            self.owner = False
@@ -5,6 +5,7 @@ StationSim - GrandCentral version
 '''
 
 import warnings
+import heapq
 import numpy as np
 import os
 from scipy.spatial import cKDTree
@@ -19,56 +20,98 @@ except ImportError:
                   "map) then it will fail.")
 
 
+def _agent_array(name, doc, update_index=False, update_queue=False):
+    '''
+    A property of the agent stored in row agent.unique_id of the model
+    array `name` (see Model.init_agent_arrays). If update_index is True,
+    the spatial index of the model is told when the value changes, and
+    if update_queue is True, the activation queue is rebuilt.
+    '''
+    def fget(self):
+        return getattr(self.model, name)[self.unique_id]
+
+    def fset(self, value):
+        getattr(self.model, name)[self.unique_id] = value
+        if update_index:
+            self.model.spatial_index.update(self.unique_id)
+        if update_queue:
+            self.model.activation_queue = None
+
+    return property(fget, fset, doc=doc)
+
+
 class Agent:
     '''
     A class representing a generic agent for the StationSim ABM.
+
+    The dynamic state of the agent is stored in the arrays of the model,
+    so the attributes below are views of one row of those arrays.
     '''
+    status = _agent_array('agents_status', '0 Not Started, 1 Active, '
+                          '2 Finished')
+    location = _agent_array('agents_location', 'Location (x, y)', True)
+    loc_desire = _agent_array('agents_loc_desire', 'Destination (x, y)')
+    speed = _agent_array('agents_speed', 'Current speed')
+    size = _agent_array('agents_size', 'Radius')
+    gate_in = _agent_array('agents_gate_in', 'Entrance gate')
+    gate_out = _agent_array('agents_gate_out', 'Exit gate')
+    steps_activate = _agent_array('agents_steps_activate', 'Activation '
+                                  'time', update_queue=True)
+    speed_max = _agent_array('agents_speed_max', 'Maximum speed')
+    loc_start = _agent_array('agents_loc_start', 'Entrance location (x, y), '
+                             'NaN before the agent is activated')
 
     def __init__(self, model, unique_id):
         '''
         Initialise a new agent.
 
         Description:
-            Creates a new agent and gives it a randomly chosen exit,
-            and desired speed.
-            All agents start with active state 0 ('not started').
-            Their initial location (** (x,y) tuple-floats **) is set to
-            (0,0) and changed when the agent is activated.
+            Creates a new agent. All agents start with active state 0
+            ('not started'). Their initial location (** (x,y)
+            tuple-floats **) is (0,0) and changed when the agent is
+            activated.
+            The gates, speeds and activation times of all the agents are
+            drawn together by the model (see Model.init_population).
 
         Parameters:
             model - a pointer to the StationSim model that is creating
             this agent
         '''
-        # Required
+        # Required (the status, location and size are set by the model)
         self.model = model
         self.unique_id = unique_id
-        self.status = 0  # 0 Not Started, 1 Active, 2 Finished
-        self.location = [0, 0]  # replaced when the agent is activated
-        self.size = model.agent_size
-
-        self.gate_in = np.random.randint(model.gates_in)
-        self.set_gate_out()
-        self.loc_desire = self.set_agent_location(self.gate_out)
-
-        # Speed
-        speed_max = 0
-        while speed_max <= model.speed_min:
-            speed_max = np.random.normal(model.speed_mean, model.speed_std)
-        self.speeds = np.arange(speed_max, model.speed_min, - model.speed_step)
-        self.speed = np.random.choice((self.speeds))
-        # Others
-        self.steps_activate = self.unique_id * 25.0 / model.birth_rate
-
-        # History
+
+        # History (the locations are kept by model.recorder)
         if model.do_history:
-            self.history_locations = []
             self.history_speeds = []
             self.history_wiggles = 0
             self.history_collisions = 0
-            self.step_start = None
-        else:
-            self.history_locations = []  # necessary in Particle Filter
-            self.step_start = None
+
+    @property
+    def step_start(self):
+        '''
+        The time at which the agent was activated (None before that).
+        '''
+        step_start = self.model.agents_step_start[self.unique_id]
+        return None if np.isnan(step_start) else step_start
+
+    @step_start.setter
+    def step_start(self, value):
+        self.model.agents_step_start[self.unique_id] = (np.nan if value is None
+                                                        else value)
+
+    @property
+    def speeds(self):
+        '''
+        The speeds the agent can walk at, from speed_max down to the
+        minimum speed of the model.
+        '''
+        return np.arange(self.speed_max, self.model.speed_min,
+                         - self.model.speed_step)
+
+    @speeds.setter
+    def speeds(self, speeds):
+        self.speed_max = speeds[0]
 
     def set_gate_out(self):
         '''
@@ -77,31 +120,9 @@ class Agent:
                             different side of the entrance gate.
         - ['Other'] The exit gate can be any gate in the opposite side of
                   the entrance gate.
+        (see Model.get_gates_out)
         '''
-
-        if (self.model.station == 'Grand_Central'):
-            # Use set differences to allocate gate_out on different side to
-            # gate_in
-            gates = set(range(self.model.gates_out))
-            gates_left = {0}
-            gates_top = {1, 2}
-            gates_right = {3, 4, 5, 6}
-            gates_bottom = {7, 8, 9, 10}
-
-            if (self.gate_in in gates_left):
-                options = list(gates - gates_left)
-            elif (self.gate_in in gates_top):
-                options = list(gates - gates_top)
-            elif (self.gate_in in gates_right):
-                options = list(gates - gates_right)
-            elif (self.gate_in in gates_bottom):
-                options = list(gates - gates_bottom)
-            else:
-                raise ValueError(f'Invalid entrance gates: {self.gate_in}')
-            self.gate_out = np.random.choice(options)
-        else:
-            random_gate_out = np.random.randint(self.model.gates_out)
-            self.gate_out = random_gate_out + self.model.gates_in
+        self.gate_out = self.model.get_gates_out([self.gate_in])[0]
 
     def step(self, time):
         '''
@@ -123,24 +144,9 @@ class Agent:
         It is necessary to ensure that the agent has an initial position
         different from the position of all active agents. If it was not
         possible, activate the agent on next time step.
+        (see Model.activate_agents)
         '''
-        if self.status == 0:
-            if self.model.total_time > self.steps_activate:
-                state = self.model.get_state('location2D')
-                self.model.tree = cKDTree(state)
-                for _ in range(10):
-                    new_location = self.set_agent_location(self.gate_in)
-                    neighbour_agents = self.model.tree.query_ball_point(
-                        new_location, self.size*1.1)
-                    if (neighbour_agents == [] or
-                            neighbour_agents == [self.unique_id]):
-                        self.location = new_location
-                        self.status = 1
-                        self.model.pop_active += 1
-                        # self.mode.step_id
-                        self.step_start = self.model.total_time
-                        self.loc_start = self.location
-                        break
+        self.model.activate_agents([self])
 
     def set_agent_location(self, gate):
         '''
@@ -148,34 +154,9 @@ class Agent:
 
             It is necessary to ensure that the agent has a distance from
             the station wall compatible with its own size.
+            (see Model.get_gate_locations)
         '''
-        wd = self.model.gates_width[gate] / 2.0
-        lateral_perturb = np.random.uniform(-wd, +wd)
-        wall_offset = 1.05 * self.size
-        gate_location = self.model.gates_locations[gate]
-
-        if(gate_location[0] == 0):
-            perturb = np.array([wall_offset, lateral_perturb])
-        elif(gate_location[0] == self.model.width):
-            perturb = np.array([-wall_offset, lateral_perturb])
-        elif(gate_location[1] == 0):
-            perturb = np.array([lateral_perturb, wall_offset])
-        elif(gate_location[1] == self.model.height):
-            perturb = np.array([lateral_perturb, -wall_offset])
-        else:
-            raise ValueError(f'Invalid gate location: {gate_location}')
-
-        new_location = gate_location + perturb
-        # print(gate_location, perturb, new_location)
-        # '''
-        #     As there are gates near the corners it is possible to create
-        #     a position outside the station. To fix this, rebound:
-        # '''
-        # if not self.model.is_within_bounds(self, new_location):
-        #     print('bounce')
-        #     new_location = self.model.re_bound(self, new_location)
-
-        return new_location
+        return self.model.get_gate_locations([gate], [self.size])[0]
 
     @staticmethod
     def distance(loc1, loc2):
@@ -205,14 +186,13 @@ class Agent:
             direction = (loc_desire - location) / distance
         return direction
 
-    @staticmethod
-    def get_normal_direction(direction):
+    def get_normal_direction(self, direction):
         '''
          A helpful function to rotate a two-dimensional array by 90
          degrees in clockwise or counter clockwise direction (-1, 1).
         '''
         return np.array([direction[1], direction[0] *
-                         np.random.choice((-1, 1))])
+                         self.model.rng.choice((-1, 1))])
 
     def move(self, time_step):
         '''
@@ -237,55 +217,9 @@ class Agent:
         - Otherwise, a new position will be determined.
         - This process has a limit of 10 attempts. If it is not possible
         to determine a new unique position, the agent just stay stopped.
+        (see Model.set_wiggles)
         '''
-        direction = self.get_direction(self.loc_desire, self.location)
-
-        state = self.model.get_state('location2D')
-        self.model.tree = cKDTree(state)
-        for _ in range(10):
-            normal_direction = self.get_normal_direction(direction)
-            new_location = self.location +\
-                normal_direction *\
-                np.random.normal(self.size, self.size)
-
-            # Rebound
-            if not self.model.is_within_bounds(self, new_location):
-                new_location = self.model.re_bound(self, new_location)
-
-            # collision_map
-            if self.model.do_history:
-                self.history_collisions += 1
-                self.model.history_collision_locs.append(new_location)
-                tt = self.model.total_time
-                self.model.history_collision_times.append(tt)
-
-            # Check if the new location is possible
-            tree = self.model.tree
-            neighbouring_agents = tree.query_ball_point(new_location,
-                                                        self.size*1.1)
-            dist = self.distance(new_location, self.model.clock.location)
-            if (dist > (self.size + self.model.clock.size)):
-                if (neighbouring_agents == [] or
-                        neighbouring_agents == [self.unique_id]):
-                    self.location = new_location
-                    # wiggle_map
-                    if self.model.do_history:
-                        self.history_wiggles += 1
-                        self.model.history_wiggle_locs.append(new_location)
-                    break
-
-            '''
-            if ((neighbouring_agents == [] or
-                    neighbouring_agents == [self.unique_id]) and
-                    (dist > (self.size + self.model.clock.size))):
-                self.location = new_location
-
-                # wiggle_map
-                if self.model.do_history:
-                    self.history_wiggles += 1
-                    self.model.history_wiggle_locs.append(new_location)
-                break
-            '''
+        self.model.set_wiggles([self.unique_id])
 
     def deactivate(self):
         '''
@@ -300,21 +234,20 @@ class Agent:
             self.model.pop_finished += 1
             if self.model.do_history:
                 steps_exped = (self.distance(self.loc_start, self.loc_desire) -
-                               self.model.gates_space) / self.speeds[0]
+                               self.model.gates_space) / self.speed_max
                 self.model.steps_exped.append(steps_exped)
                 steps_taken = self.model.total_time - self.step_start
                 self.model.steps_taken.append(steps_taken)
                 steps_delay = steps_taken - steps_exped
                 self.model.steps_delay.append(steps_delay)
 
-    def history(self):
+    @property
+    def history_locations(self):
         '''
-        Save agent location.
+        The location of the agent at the end of each step, or (None, None)
+        if it was not active (see HistoryRecorder).
         '''
-        if self.status == 1:
-            self.history_locations.append(self.location)
-        else:
-            self.history_locations.append((None, None))
+        return self.model.recorder.get_agent_locations(self.unique_id)
 
     def get_collisionTime2Agents(self, agentB):
         '''
@@ -368,6 +301,487 @@ class Agent:
         return tmin
 
 
+class HistoryRecorder:
+    '''
+    The history of a model, kept in preallocated numpy arrays that
+    double in size when they are full:
+    - locations (steps, pop_total, 2) and active (steps, pop_total): the
+      location of each agent at the end of each step, and whether it was
+      active. get_locations gives NaN for the agents that were not.
+    - collision_locs (n, 2) and collision_times (n,): every location tried
+      by a wiggling agent, and wiggle_locs (n, 2): the accepted ones.
+
+    If directory is given the arrays are memory-mapped .npy files in that
+    directory, so long runs do not have to fit in memory.
+    '''
+
+    _shapes = {'locations': (2,), 'active': (), 'collision_locs': (2,),
+               'collision_times': (), 'wiggle_locs': (2,)}
+
+    def __init__(self, pop_total, directory=None, capacity=64):
+        self.pop_total = pop_total
+        self.directory = directory
+        if directory is not None and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.n_steps = 0
+        self.n_collisions = 0
+        self.n_wiggles = 0
+        self._arrays = {}
+        for name in self._shapes:
+            self._arrays[name] = self._allocate(name, capacity)
+
+    def _allocate(self, name, capacity, old=None):
+        shape = (capacity,) + self._shapes[name]
+        if name in ('locations', 'active'):
+            shape = (capacity, self.pop_total) + self._shapes[name]
+        dtype = bool if name == 'active' else float
+        if self.directory is None:
+            array = np.empty(shape, dtype=dtype)
+            if old is not None:
+                array[:len(old)] = old
+            return array
+
+        filename = os.path.join(self.directory, name + '.npy')
+        if old is None:
+            return np.lib.format.open_memmap(filename, mode='w+',
+                                             dtype=dtype, shape=shape)
+        array = np.lib.format.open_memmap(filename + '.tmp', mode='w+',
+                                          dtype=dtype, shape=shape)
+        array[:len(old)] = old
+        del old
+        os.replace(filename + '.tmp', filename)
+        return array
+
+    def _reserve(self, name, size):
+        array = self._arrays[name]
+        if size > len(array):
+            self._arrays[name] = self._allocate(name, max(2*len(array), size),
+                                                array)
+        return self._arrays[name]
+
+    def record(self, locations, active):
+        '''
+        Add a step with the locations (pop_total, 2) of the agents and
+        whether they are active (pop_total,).
+        '''
+        n = self.n_steps
+        self._reserve('locations', n + 1)[n] = locations
+        self._reserve('active', n + 1)[n] = active
+        self.n_steps += 1
+
+    def add_collisions(self, locations, time):
+        '''
+        Add the locations (n, 2) tried by wiggling agents at a time.
+        '''
+        n, m = self.n_collisions, len(locations)
+        self._reserve('collision_locs', n + m)[n:n+m] = locations
+        self._reserve('collision_times', n + m)[n:n+m] = time
+        self.n_collisions += m
+
+    def add_wiggles(self, locations):
+        '''
+        Add the new locations (n, 2) of wiggling agents.
+        '''
+        n, m = self.n_wiggles, len(locations)
+        self._reserve('wiggle_locs', n + m)[n:n+m] = locations
+        self.n_wiggles += m
+
+    def get_lengths(self):
+        return self.n_steps, self.n_collisions, self.n_wiggles
+
+    def truncate(self, lengths):
+        '''
+        Forget everything recorded after get_lengths returned lengths.
+        '''
+        self.n_steps, self.n_collisions, self.n_wiggles = [
+            min(a, b) for a, b in zip(self.get_lengths(), lengths)]
+
+    @property
+    def locations(self):
+        return self._arrays['locations'][:self.n_steps]
+
+    @property
+    def active(self):
+        return self._arrays['active'][:self.n_steps]
+
+    @property
+    def collision_locs(self):
+        return self._arrays['collision_locs'][:self.n_collisions]
+
+    @property
+    def collision_times(self):
+        return self._arrays['collision_times'][:self.n_collisions]
+
+    @property
+    def wiggle_locs(self):
+        return self._arrays['wiggle_locs'][:self.n_wiggles]
+
+    def get_locations(self, agents=None):
+        '''
+        Returns the locations (steps, agents, 2) of the first agents (all
+        if None), with NaN for the agents that were not active.
+        '''
+        locations = self.locations[:, :agents].copy()
+        locations[~self.active[:, :agents]] = np.nan
+        return locations
+
+    def get_agent_locations(self, unique_id):
+        '''
+        Returns the locations of one agent as a list of (x, y) tuples,
+        with (None, None) for the steps in which it was not active.
+        '''
+        locations = self.locations[:, unique_id].tolist()
+        active = self.active[:, unique_id].tolist()
+        return [tuple(loc) if a else (None, None)
+                for loc, a in zip(locations, active)]
+
+
+class TrajectoryFile:
+    '''
+    A whole run in one binary .npy file: a (frames, agents) array of
+    records (frame, agent_id, x, y, status), where frame f is the state at
+    the end of step f+1, status is 0 Not Started, 1 Active, 2 Finished,
+    and x, y are NaN for the agents that are not active.
+
+    The file is opened memory-mapped, so reading a frame or an agent only
+    reads that part of the file.
+    '''
+
+    dtype = np.dtype([('frame', '<i4'), ('agent_id', '<i4'), ('x', '<f8'),
+                      ('y', '<f8'), ('status', 'i1')])
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.records = np.load(filename, mmap_mode='r')
+        self.n_frames, self.pop_total = self.records.shape
+
+    @classmethod
+    def write(cls, filename, locations, active, chunk_size=256):
+        '''
+        Write the locations (frames, agents, 2) and active mask (frames,
+        agents) of a run (see HistoryRecorder) to filename, chunk_size
+        frames at a time.
+        '''
+        n_frames, pop_total = active.shape
+        records = np.lib.format.open_memmap(filename, mode='w+',
+                                            dtype=cls.dtype,
+                                            shape=(n_frames, pop_total))
+        # An agent is active from its first to its last active frame and
+        # finished after that.
+        started = active.any(axis=0)
+        last = n_frames - 1 - np.argmax(active[::-1], axis=0)
+        for start in range(0, n_frames, chunk_size):
+            stop = min(start + chunk_size, n_frames)
+            frames = np.arange(start, stop)
+            chunk = np.empty((stop - start, pop_total), dtype=cls.dtype)
+            chunk['frame'] = frames[:, None]
+            chunk['agent_id'] = np.arange(pop_total)
+            is_active = active[start:stop]
+            chunk['x'] = np.where(is_active, locations[start:stop, :, 0],
+                                  np.nan)
+            chunk['y'] = np.where(is_active, locations[start:stop, :, 1],
+                                  np.nan)
+            chunk['status'] = np.where(
+                is_active, 1, 2 * (started & (frames[:, None] > last)))
+            records[start:stop] = chunk
+        records.flush()
+        del records
+        return cls(filename)
+
+    def get_frame(self, frame):
+        '''
+        Returns the records of the agents active in a frame.
+        '''
+        records = self.records[frame]
+        return records[records['status'] == 1]
+
+    def get_locations(self, frames=slice(None), agents=slice(None)):
+        '''
+        Returns the locations (frames, agents, 2), NaN if not active.
+        '''
+        records = self.records[frames, agents]
+        return np.stack((records['x'], records['y']), axis=-1)
+
+    def get_status(self, frames=slice(None), agents=slice(None)):
+        return np.asarray(self.records[frames, agents]['status'])
+
+    def get_trail(self, unique_id):
+        '''
+        Returns the locations (n, 2) of an agent in the frames in which it
+        was active.
+        '''
+        records = self.records[:, unique_id]
+        records = records[records['status'] == 1]
+        return np.stack((records['x'], records['y']), axis=-1)
+
+
+class SpatialIndex:
+    '''
+    A KD-tree of the locations of the agents of a model, shared by all
+    the agents.
+
+    The tree is only built when it is queried after the agents have
+    moved (see Model.move_agents), i.e. at most once per sub-step.
+    Agents placed after that (activation, wiggle) are kept in a short
+    list of moved agents, whose entries in the tree are ignored and
+    whose current locations are checked directly.
+    '''
+
+    def __init__(self, model):
+        self.model = model
+        self.tree = None
+        self.moved = []
+        self.is_moved = np.zeros(model.pop_total, dtype=bool)
+
+    def invalidate(self):
+        '''
+        Forget the tree after many agents have moved.
+        '''
+        self.tree = None
+        self.moved = []
+
+    def build(self):
+        self.tree = cKDTree(self.model.agents_location[:self.model.pop_total])
+        self.moved = []
+        self.is_moved[:] = False
+
+    def update(self, unique_id):
+        '''
+        Record that an agent has been placed at a new location.
+        '''
+        if self.tree is not None and unique_id < self.model.pop_total:
+            self.is_moved[unique_id] = True
+            self.moved.append(unique_id)
+
+    def query(self, points, r):
+        '''
+        Batched query_ball_point: returns a list with the agents within
+        distance r (a float or one per point) of each point.
+        '''
+        if self.tree is None:
+            self.build()
+        points = np.reshape(points, (-1, 2))
+        neighbours = self.tree.query_ball_point(points, r)
+        if not self.moved:
+            return [list(n) for n in neighbours]
+
+        moved = np.unique(self.moved)
+        diff = points[:, None, :] - self.model.agents_location[moved]
+        near = ((diff**2).sum(axis=2) <=
+                np.reshape(r, (-1, 1))**2)
+        return [[j for j in n if not self.is_moved[j]] +
+                moved[near[k]].tolist() for k, n in enumerate(neighbours)]
+
+    def place(self, ids, points, r, allowed=None):
+        '''
+        Move agent ids[k] to points[k] (for every k where allowed) if
+        there is no other agent within distance r[k] of it. The agents
+        are placed in order, so each one sees the agents placed before
+        it. Returns a boolean array with the agents that were placed.
+        '''
+        neighbours = self.query(points, r)
+        # After query, as it clears the list when it rebuilds the tree
+        start = len(self.moved)
+        placed = np.zeros(len(ids), dtype=bool)
+        for k, unique_id in enumerate(ids):
+            if allowed is not None and not allowed[k]:
+                continue
+            neighbour_agents = neighbours[k]
+            if len(self.moved) > start:
+                # Agents placed in this call
+                moved = np.unique(self.moved[start:])
+                diff = self.model.agents_location[moved] - points[k]
+                near = (diff**2).sum(axis=1) <= r[k]**2
+                neighbour_agents = [j for j in neighbour_agents
+                                    if j not in moved] + \
+                    moved[near].tolist()
+            if (neighbour_agents == [] or
+                    neighbour_agents == [unique_id]):
+                self.model.agents_location[unique_id] = points[k]
+                self.update(unique_id)
+                placed[k] = True
+        return placed
+
+
+class CollisionQueue:
+    '''
+    A priority queue of predicted collision events for the event driven
+    stepper of the StationSim GCS model.
+
+    Agents move in straight lines between wiggles, so a predicted
+    collision time stays valid until one of the agents involved changes
+    course. As in hard-sphere molecular dynamics, each event stores a
+    stamp of its agents; when an agent wiggles its stamp is increased,
+    which invalidates its old events lazily, and only its own events are
+    recomputed. Events hold absolute times (model.total_time) and only
+    the events that happen before the end of the current step (plus the
+    tolerance) are kept.
+
+    The queue gives the same collisions as the collision table only up
+    to floating-point error: the absolute times add rounding errors of
+    about 1e-13 that build up over the steps, until a comparison with
+    the tolerance goes the other way and the trajectories of the two
+    paths part (after some hundreds of steps with 100 agents).
+
+    Agents that already overlap (with each other or with the clock) do
+    not have a fixed collision time in Agent.get_collisionTime2Agents,
+    so these few events are kept apart and recomputed at every sub-step.
+    '''
+
+    def __init__(self, model):
+        self.model = model
+        self.stamps = np.zeros(model.pop_total, dtype=int)
+        self.events = []
+        self.overlaps = []
+        self.overlap_times = np.empty(0)
+        self.horizon = model.total_time
+
+    def rebuild(self, time):
+        '''
+        Predict the events of all the active agents for a step of the
+        given length. The queue is rebuilt at the start of every step,
+        since the agents can be changed from outside (e.g. set_state).
+        '''
+        self.events = []
+        self.overlaps = []
+        self.horizon = self.model.total_time + time + self.model.tolerance
+        self.push_events(None, time)
+
+    def push_events(self, agents, time):
+        '''
+        Predict and push the events of the given agents (all the active
+        agents if None) from the current model time.
+        '''
+        now = self.model.total_time
+        times, agent, partner = self.model.get_collisionEvents(time, agents)
+        soon = times + now < self.horizon
+        times, agent, partner = times[soon], agent[soon], partner[soon]
+        overlap = self.get_overlap(agent, partner)
+
+        stamps = self.stamps
+        for t, a, b, o in zip((times + now).tolist(), agent.tolist(),
+                              partner.tolist(), overlap.tolist()):
+            event = (t, a, b, stamps[a], stamps[b] if b >= 0 else 0)
+            if o:
+                self.overlaps.append(event)
+            else:
+                heapq.heappush(self.events, event)
+
+    def get_overlap(self, agent, partner):
+        '''
+        Returns whether the agents of each event overlap with their
+        partner (another agent or the clock).
+        '''
+        overlap = np.zeros(len(agent), bool)
+        events = np.flatnonzero(partner != -1)
+        if len(events):
+            model = self.model
+            loc, _, size = model.get_agent_arrays(agent[events])
+            loc_partner = np.empty_like(loc)
+            size_partner = np.empty_like(size)
+            clock = partner[events] == -2
+            loc_partner[clock] = model.clock.location
+            size_partner[clock] = model.clock.size
+            loc_partner[~clock], _, size_partner[~clock] =\
+                model.get_agent_arrays(partner[events][~clock])
+            distance = np.sqrt(((loc - loc_partner)**2).sum(axis=1))
+            overlap[events] = distance < size + size_partner
+        return overlap
+
+    def get_overlap_times(self):
+        '''
+        Drop the invalid overlapping events and return the current
+        collision times of the others, relative to the model time.
+        '''
+        self.overlaps = [event for event in self.overlaps
+                         if self.is_valid(event)]
+        if not self.overlaps:
+            return np.empty(0)
+        model = self.model
+        agent = [event[1] for event in self.overlaps]
+        partner = [max(event[2], 0) for event in self.overlaps]
+        clock = np.array([event[2] == -2 for event in self.overlaps])
+        loc, vel, size = model.get_agent_arrays(agent)
+        loc_partner, vel_partner, size_partner =\
+            model.get_agent_arrays(partner)
+        loc_partner[clock] = model.clock.location
+        vel_partner[clock] = 0.0
+        size_partner[clock] = model.clock.size
+        return model.get_collisionTimes(loc, vel, size, loc_partner,
+                                        vel_partner, size_partner)
+
+    def is_valid(self, event):
+        '''
+        An event is valid if its agents are active and have not changed
+        course since it was predicted.
+        '''
+        _, a, b, stamp_a, stamp_b = event
+        agents = self.model.agents
+        if agents[a].status != 1 or self.stamps[a] != stamp_a:
+            return False
+        if b >= 0 and (agents[b].status != 1 or self.stamps[b] != stamp_b):
+            return False
+        return True
+
+    def get_tmin(self):
+        '''
+        Returns the time until the next valid event, as in
+        Model.get_collisionTable. The times of the overlapping events
+        are stored for pop_wiggles.
+        '''
+        while self.events and not self.is_valid(self.events[0]):
+            heapq.heappop(self.events)
+        tmin = 1.0e300
+        if self.events:
+            tmin = self.events[0][0] - self.model.total_time
+        self.overlap_times = self.get_overlap_times()
+        if len(self.overlap_times):
+            tmin = min(tmin, self.overlap_times.min())
+        if tmin <= 1.0e-10:
+            tmin = 0.02
+        return tmin
+
+    def pop_wiggles(self, time):
+        '''
+        Pop the valid events within the tolerance of the model time +
+        time and return the set of agents involved in them (see
+        Model.get_wiggleTable). Overdue events before that window are
+        kept in the queue. Must be called after get_tmin, with the
+        model time of the start of the sub-step.
+        '''
+        centre = self.model.total_time + time
+        tolerance = self.model.tolerance
+        wiggleTable, overdue = set(), []
+        while self.events and self.events[0][0] < centre + tolerance:
+            event = heapq.heappop(self.events)
+            if not self.is_valid(event):
+                continue
+            if event[0] > centre - tolerance:
+                wiggleTable.add(event[1])
+                if event[2] >= 0:
+                    wiggleTable.add(event[2])
+            else:
+                overdue.append(event)
+        for event in overdue:
+            heapq.heappush(self.events, event)
+
+        for t, event in zip(self.overlap_times, self.overlaps):
+            if abs(t - time) < tolerance:
+                wiggleTable.add(event[1])
+                if event[2] >= 0:
+                    wiggleTable.add(event[2])
+        return wiggleTable
+
+    def update(self, agents, time):
+        '''
+        Invalidate the events of the agents that changed course and
+        predict their new events for the rest of the step.
+        '''
+        agents = list(agents)
+        self.stamps[agents] += 1
+        self.push_events(agents, time)
+
+
 class Model:
     '''
     StationSim Model
@@ -428,6 +842,9 @@ class Model:
 
             'do_history': True,
             'do_print': True,
+            'do_cell_list': False,  # prune collision pairs with a cell list
+            'do_event_queue': False,  # update collisions with a heap
+            'history_dir': None,  # keep the history in memory-mapped files
 
             'random_seed': int.from_bytes(os.urandom(4), byteorder='little'),
 
@@ -444,8 +861,8 @@ class Model:
             )
         self.params, self.params_changed = Model._init_kwargs(params, kwargs)
         [setattr(self, key, value) for key, value in self.params.items()]
-        # Set the random seed
-        np.random.seed(self.random_seed)
+        # Set the random number generator of the model
+        self.set_random_seed(self.random_seed)
         self.speed_step = (self.speed_mean - self.speed_min) / self.speed_steps
 
         # Variables
@@ -455,17 +872,17 @@ class Model:
         self.total_time = 0.0
 
         # Initialise station
+        self.init_agent_arrays()
         self.set_station()
 
         # Initialise agents
         self.agents = [Agent(self, unique_id) for unique_id in
                        range(self.pop_total)]
+        self.init_population()
+        self.collision_queue = CollisionQueue(self)
+        self.recorder = HistoryRecorder(self.pop_total, self.history_dir)
 
         if self.do_history:
-            self.history_state = []
-            self.history_wiggle_locs = []
-            self.history_collision_locs = []
-            self.history_collision_times = []
             self.steps_taken = []
             self.steps_exped = []
             self.steps_delay = []
@@ -476,6 +893,57 @@ class Model:
             self._figsize = (self._wid, self._hei)
             self._dpi = 160
 
+    # History lists of the model (cut back by Model.restore)
+    _history_lists = ('steps_taken', 'steps_exped', 'steps_delay')
+
+    @property
+    def history_state(self):
+        '''
+        The location2D state (see get_state) at the end of each step.
+        '''
+        return [list(map(tuple, state))
+                for state in self.recorder.locations.tolist()]
+
+    @property
+    def history_wiggle_locs(self):
+        return self.recorder.wiggle_locs
+
+    @property
+    def history_collision_locs(self):
+        return self.recorder.collision_locs
+
+    @property
+    def history_collision_times(self):
+        return self.recorder.collision_times
+
+    def record_history(self):
+        '''
+        Record the locations of the agents at the end of a step.
+        '''
+        n = self.pop_total
+        self.recorder.record(self.agents_location[:n],
+                             self.agents_status[:n] == 1)
+
+    def init_agent_arrays(self):
+        '''
+        Allocate the arrays that store the state of the agents. Row i
+        belongs to self.agents[i] and the last row to the clock.
+        '''
+        n = self.pop_total + 1
+        self.agents_status = np.zeros(n, dtype=int)
+        self.agents_location = np.zeros((n, 2))
+        self.agents_loc_desire = np.zeros((n, 2))
+        self.agents_speed = np.zeros(n)
+        self.agents_size = np.zeros(n)
+        self.agents_gate_in = np.zeros(n, dtype=int)
+        self.agents_gate_out = np.zeros(n, dtype=int)
+        self.agents_steps_activate = np.zeros(n)
+        self.agents_speed_max = np.zeros(n)
+        self.agents_step_start = np.full(n, np.nan)
+        self.agents_loc_start = np.full((n, 2), np.nan)
+        self.spatial_index = SpatialIndex(self)
+        self.activation_queue = None
+
     @staticmethod
     def _gates_init(x, y, n):
         return np.array([np.full(n, x), np.linspace(0, y, n+2)[1:-1]]).T
@@ -527,6 +995,7 @@ class Model:
             self.boundaries = np.array([[0, 0], [self.width, self.height]])
             # create a clock outside the station.
             self.clock = Agent(self, self.pop_total)
+            self.clock.size = self.agent_size
             self.clock.speed = 0.0
 
             if(self.station is not None):
@@ -544,6 +1013,102 @@ class Model:
         return np.clip(loc, self.boundaries[0] + agent.size*1.1,
                        self.boundaries[1] - agent.size*1.1)
 
+    def init_population(self):
+        '''
+        Draw the entrance and exit gates, destinations, speeds and
+        activation times of all the agents at once.
+        '''
+        n = self.pop_total
+        self.agents_size[:n] = self.agent_size
+        self.agents_gate_in[:n] = self.rng.integers(self.gates_in, size=n)
+        self.set_gates_out()
+        self.set_speeds()
+        self.agents_steps_activate[:n] = np.arange(n) * 25.0 / self.birth_rate
+        self.activation_queue = None
+
+    def get_gates_out(self, gates_in):
+        '''
+        Vectorized Agent.set_gate_out: returns a random exit gate for each
+        entrance gate in gates_in.
+        - ['Grand_Central'] Any gate on a different side of the station.
+        - ['Other'] Any gate in the opposite side of the station.
+        '''
+        gates_in = np.asarray(gates_in, dtype=int)
+        if self.station != 'Grand_Central':
+            return self.rng.integers(self.gates_out, size=len(gates_in)) +\
+                self.gates_in
+
+        # Sides: left {0}, top {1, 2}, right {3, 4, 5, 6},
+        # bottom {7, 8, 9, 10}
+        gate_sides = np.array([0, 1, 1, 2, 2, 2, 2, 3, 3, 3, 3])
+        if np.any((gates_in < 0) | (gates_in >= len(gate_sides))):
+            raise ValueError(f'Invalid entrance gates: {gates_in}')
+        gates = np.arange(self.gates_out)
+        # options[side]: the gates on the other sides, padded with -1
+        options = np.full((4, self.gates_out), -1)
+        for side in range(4):
+            other = gates[gate_sides != side]
+            options[side, :len(other)] = other
+        n_options = (options >= 0).sum(axis=1)
+        sides = gate_sides[gates_in]
+        return options[sides, self.rng.integers(n_options[sides])]
+
+    def get_gate_locations(self, gates, sizes):
+        '''
+        Vectorized Agent.set_agent_location: returns a random point
+        (n, 2) in front of each gate, 1.05 sizes away from the wall.
+        '''
+        gates = np.asarray(gates, dtype=int)
+        wd = np.asarray(self.gates_width, dtype=float)[gates] / 2.0
+        lateral_perturb = self.rng.uniform(-wd, +wd)
+        wall_offset = 1.05 * np.asarray(sizes, dtype=float)
+        gate_location = self.gates_locations[gates]
+
+        x, y = gate_location[:, 0], gate_location[:, 1]
+        walls = [x == 0, x == self.width, y == 0, y == self.height]
+        if not np.all(np.any(walls, axis=0)):
+            raise ValueError('Invalid gate location: '
+                             f'{gate_location[~np.any(walls, axis=0)]}')
+        perturb = np.column_stack((
+            np.select(walls, [wall_offset, -wall_offset, lateral_perturb,
+                              lateral_perturb]),
+            np.select(walls, [lateral_perturb, lateral_perturb, wall_offset,
+                              -wall_offset])))
+        return gate_location + perturb
+
+    def set_gates_out(self, ids=None):
+        '''
+        Draw new exit gates and destinations for the agents in ids (all
+        if None).
+        '''
+        if ids is None:
+            ids = np.arange(self.pop_total)
+        gates_out = self.get_gates_out(self.agents_gate_in[ids])
+        self.agents_gate_out[ids] = gates_out
+        self.agents_loc_desire[ids] = self.get_gate_locations(
+            gates_out, self.agents_size[ids])
+
+    def set_speeds(self, ids=None):
+        '''
+        Draw new maximum speeds, from a normal distribution above
+        speed_min, and current speeds, from the speed ladder of each agent
+        (see Agent.speeds), for the agents in ids (all if None).
+        '''
+        if ids is None:
+            ids = np.arange(self.pop_total)
+        speed_max = np.zeros(len(ids))
+        redraw = np.ones(len(ids), dtype=bool)
+        while redraw.any():
+            speed_max[redraw] = self.rng.normal(self.speed_mean,
+                                                self.speed_std, redraw.sum())
+            redraw = speed_max <= self.speed_min
+        # Same values as np.arange(speed_max, speed_min, -speed_step)
+        delta = (speed_max - self.speed_step) - speed_max
+        n_speeds = np.ceil((self.speed_min - speed_max) / -self.speed_step)
+        choice = self.rng.integers(n_speeds.astype(int))
+        self.agents_speed_max[ids] = speed_max
+        self.agents_speed[ids] = speed_max + choice * delta
+
     @staticmethod
     def _init_kwargs(dict0, dict1):
         '''
@@ -572,32 +1137,42 @@ class Model:
         if self.step_id == 0:
             state = self.get_state('location2D')
 
-        if self.pop_finished < self.pop_total and\
-                self.step_id < self.step_limit and self.status == 1:
+        if self.is_running():
+            if self.fast_forward(1):
+                return
             if self.do_print and self.step_id % 100 == 0:
                 print(f'\tIteration: {self.step_id}/{self.step_limit}')
 
-            [agent.activate() for agent in self.agents]
+            self.activate_agents()
 
             t = 1.0
+            if self.do_event_queue:
+                self.collision_queue.rebuild(t)
             while (t > 0):
-                collisionTable, tmin = self.get_collisionTable()
+                if self.do_event_queue:
+                    tmin = self.collision_queue.get_tmin()
+                else:
+                    collisionTable, tmin = self.get_collisionTable(t)
                 if (tmin > t):
-                    [agent.step(t) for agent in self.agents]
+                    self.move_agents(t)
                     self.total_time += t
                     t -= tmin
                 else:
                     tmin *= 0.98  # stop just before the collision
                     t -= tmin
-                    [agent.step(tmin) for agent in self.agents]
-                    wiggleTable = self.get_wiggleTable(collisionTable, tmin)
-                    [self.agents[i].set_wiggle() for i in wiggleTable]
+                    self.move_agents(tmin)
+                    if self.do_event_queue:
+                        wiggleTable = self.collision_queue.pop_wiggles(tmin)
+                    else:
+                        wiggleTable = self.get_wiggleTable(collisionTable,
+                                                           tmin)
+                    self.set_wiggles(wiggleTable)
                     self.total_time += tmin
+                    if self.do_event_queue:
+                        self.collision_queue.update(wiggleTable, t)
 
             if self.do_history:
-                state = self.get_state('location2D')
-                self.history_state.append(state)
-                [agent.history() for agent in self.agents]
+                self.record_history()
 
             self.step_id += 1
 
@@ -607,13 +1182,320 @@ class Model:
         else:
             print(self.unique_id, 'pass')
 
+    def is_running(self):
+        return self.pop_finished < self.pop_total and\
+            self.step_id < self.step_limit and self.status == 1
+
+    def get_activation_queue(self):
+        '''
+        Returns the agents that have not started, sorted by activation
+        time (then by unique_id), and their activation times.
+
+        The queue is built when needed and kept until an activation time
+        or a status is set back (see restore and set_state).
+        activation_next is the position of the first agent in the queue
+        that may still be waiting, so the agents before it are not
+        visited again.
+        '''
+        if self.activation_queue is None:
+            n = self.pop_total
+            waiting = np.flatnonzero(self.agents_status[:n] == 0)
+            times = self.agents_steps_activate[waiting]
+            order = np.argsort(times, kind='stable')
+            self.activation_queue = (waiting[order], times[order])
+            self.activation_next = 0
+        return self.activation_queue
+
+    def get_due_agents(self):
+        '''
+        Returns the unique_id of the agents (in order) that have not
+        started and whose activation time has passed.
+        '''
+        queue, times = self.get_activation_queue()
+        due = queue[self.activation_next:np.searchsorted(times,
+                                                         self.total_time)]
+        waiting = self.agents_status[due] == 0
+        # Skip the agents at the front of the queue that have started
+        skip = np.argmax(waiting) if waiting.any() else len(due)
+        self.activation_next += skip
+        return np.sort(due[waiting])
+
+    def get_next_activation(self):
+        '''
+        Returns the earliest activation time of the agents in the queue
+        (inf if it is empty).
+        '''
+        queue, times = self.get_activation_queue()
+        if self.activation_next < len(times):
+            return times[self.activation_next]
+        return np.inf
+
+    def fast_forward(self, max_steps=None):
+        '''
+        Iterate the model through the steps in which no agent is active
+        and none is due to be activated (e.g. before the first arrival),
+        up to max_steps. Nothing can move or collide in these steps, so
+        only the clock and the history are updated. Returns the number of
+        steps done (0 if the model is not idle).
+        '''
+        if np.any(self.agents_status[:self.pop_total] == 1) or\
+                len(self.get_due_agents()) > 0:
+            return 0
+        next_activation = self.get_next_activation()
+        steps = 0
+        while (max_steps is None or steps < max_steps) and\
+                self.is_running() and self.total_time <= next_activation:
+            if self.do_print and self.step_id % 100 == 0:
+                print(f'\tIteration: {self.step_id}/{self.step_limit}')
+            self.total_time += 1.0
+            if self.do_history:
+                self.record_history()
+            self.step_id += 1
+            steps += 1
+        return steps
+
+    def activate_agents(self, agents=None):
+        '''
+        Activate the agents (all of them if None) whose activation time
+        has passed (see Agent.activate). If agents is None, only the
+        agents that are due in the activation queue are visited (see
+        get_activation_queue).
+
+        Each agent gets up to 10 attempts to find an entrance location
+        that is not within 1.1 sizes of another agent. The attempts of
+        all the waiting agents are queried together in the spatial
+        index, and only the agents that failed try again.
+        '''
+        if agents is None:
+            pending = [self.agents[i] for i in self.get_due_agents()]
+        else:
+            pending = [agent for agent in agents if agent.status == 0 and
+                       self.total_time > agent.steps_activate]
+        for _ in range(10):
+            if not pending:
+                break
+            ids = [agent.unique_id for agent in pending]
+            new_locations = self.get_gate_locations(self.agents_gate_in[ids],
+                                                    self.agents_size[ids])
+            radius = self.agents_size[ids] * 1.1
+            placed = self.spatial_index.place(ids, new_locations, radius)
+
+            for agent in [a for a, p in zip(pending, placed) if p]:
+                agent.status = 1
+                self.pop_active += 1
+                agent.step_start = self.total_time
+                agent.loc_start = agent.location.copy()
+            pending = [agent for agent, p in zip(pending, placed) if not p]
+
+    def set_wiggles(self, wiggle_ids):
+        '''
+        Vectorized Agent.set_wiggle: determine a new position for all the
+        agents in wiggle_ids, that collided with another agent or with
+        some element of the station.
+
+        Every agent proposes a lateral step at the same time, the steps
+        are checked against the clock and the spatial index together, and
+        only the agents that failed propose a new step, up to 10 times.
+        Agents are placed in the order of their ids, whatever the order of
+        wiggle_ids (a set, built in the order of the collision pairs), so
+        every collision path gives the same trajectories.
+        '''
+        pending = np.unique(np.fromiter(wiggle_ids, dtype=int))
+        if pending.size == 0:
+            return
+        direction = self.get_directions(self.agents_loc_desire[pending],
+                                        self.agents_location[pending])
+        clock = self.clock
+        for _ in range(10):
+            n = pending.size
+            size = self.agents_size[pending]
+            normal_direction = direction[:, ::-1] * \
+                np.column_stack((np.ones(n), self.rng.choice((-1, 1), n)))
+            new_locations = self.agents_location[pending] + \
+                normal_direction * self.rng.normal(size, size)[:, None]
+
+            # Rebound
+            margin = size[:, None]
+            within = np.all((self.boundaries[0] + margin*2.0 < new_locations) &
+                            (new_locations < self.boundaries[1] - margin*2.0),
+                            axis=1)
+            new_locations[~within] = np.clip(
+                new_locations[~within],
+                self.boundaries[0] + margin[~within]*1.1,
+                self.boundaries[1] - margin[~within]*1.1)
+
+            # collision_map
+            if self.do_history:
+                for i in pending:
+                    self.agents[i].history_collisions += 1
+                self.recorder.add_collisions(new_locations, self.total_time)
+
+            # Check if the new locations are possible
+            dist = np.linalg.norm(new_locations - clock.location, axis=1)
+            placed = self.spatial_index.place(pending, new_locations,
+                                              size*1.1,
+                                              dist > size + clock.size)
+            # wiggle_map
+            if self.do_history:
+                for i in pending[placed]:
+                    self.agents[i].history_wiggles += 1
+                self.recorder.add_wiggles(
+                    self.agents_location[pending[placed]])
+
+            pending = pending[~placed]
+            direction = direction[~placed]
+            if pending.size == 0:
+                break
+
+    def move_agents(self, time_step):
+        '''
+        Vectorized Agent.step: move all the active agents towards their
+        destination and deactivate the ones that arrived.
+        '''
+        active = np.flatnonzero(self.agents_status[:self.pop_total] == 1)
+        loc = self.agents_location[active]
+        loc_desire = self.agents_loc_desire[active]
+        direction = self.get_directions(loc_desire, loc)
+        loc = loc + self.agents_speed[active, None] * direction * time_step
+        self.agents_location[active] = loc
+        self.spatial_index.invalidate()
+
+        diff = loc - loc_desire
+        dist = (diff[:, 0]*diff[:, 0] + diff[:, 1]*diff[:, 1])**.5
+        # Agent.deactivate makes the final decision
+        for i in active[dist < self.gates_space + 1e-9]:
+            self.agents[i].deactivate()
+
     # information about next collision
-    def get_collisionTable(self):
+    def get_collisionTable(self, time=None):
         '''
         Returns the time of next colision (tmin) and a table with
         information about every possible colision:
-        - collisionTable[0]: collision time
-        - collisionTable[1]: agent agent.unique_id
+        - collisionTable[:, 0]: collision time
+        - collisionTable[:, 1]: agent agent.unique_id
+
+        The agent-wall, agent-clock and agent-agent collision times of
+        all the active agents are calculated at once from arrays of
+        locations, velocities and sizes (see get_collisionEvents, and
+        get_collisionTable_pairwise for the agent by agent version).
+        '''
+        times, agent, partner = self.get_collisionEvents(time)
+        if len(times) == 0:
+            return np.empty((0, 2)), 1.0e300
+
+        pair = partner >= 0
+        collisionTable = np.column_stack((
+            np.concatenate((times, times[pair])),
+            np.concatenate((agent, partner[pair]))))
+
+        tmin = collisionTable[:, 0].min()
+        if tmin <= 1.0e-10:
+            tmin = 0.02
+
+        return collisionTable, tmin
+
+    def get_collisionEvents(self, time=None, agents=None):
+        '''
+        Returns the collision times of the active agents as three arrays
+        (times, agent, partner). Each agent has one event with the walls
+        (partner -1) and one with the clock (partner -2), and each pair
+        of agents has one event (partner >= 0). If agents is given, only the
+        events that involve those agents are returned.
+
+        If do_cell_list is True and the remaining time of the step is
+        given, only pairs of agents in neighbouring cells of a uniform
+        grid are considered (see get_neighbourPairs). Pairs that are
+        further apart cannot collide within time + tolerance, so tmin
+        and the wiggle table are the same as with all pairs whenever a
+        collision happens within the step.
+        '''
+        active, loc, vel, size = self.get_active_arrays()
+        touched = np.ones(len(active), bool)
+        if agents is not None:
+            touched = np.isin(active, list(agents))
+        rows = np.flatnonzero(touched)
+        if len(rows) == 0:
+            return np.empty(0), np.empty(0, int), np.empty(0, int)
+
+        wall_times = self.get_collisionTimeWalls(loc[rows], vel[rows],
+                                                 size[rows])
+        clock_loc = np.asarray(self.clock.location, dtype=float)
+        clock_times = self.get_collisionTimes(loc[rows], vel[rows],
+                                              size[rows], clock_loc,
+                                              np.zeros(2), self.clock.size)
+
+        if self.do_cell_list and time is not None:
+            speed_max = np.sqrt((vel**2).sum(axis=1)).max()
+            cutoff = 2 * (size.max() + speed_max * (time + self.tolerance))
+            i, j = self.get_neighbourPairs(loc, cutoff)
+            keep = touched[i] | touched[j]
+            i, j = i[keep], j[keep]
+        elif agents is None:
+            i, j = np.triu_indices(len(active), 1)
+        else:
+            # Pairs between two touched agents are only kept once
+            i = np.repeat(rows, len(active))
+            j = np.tile(np.arange(len(active)), len(rows))
+            keep = (i != j) & (~touched[j] | (i < j))
+            i, j = i[keep], j[keep]
+        pair_times = self.get_collisionTimes(loc[i], vel[i], size[i],
+                                             loc[j], vel[j], size[j])
+
+        times = np.concatenate((wall_times, clock_times, pair_times))
+        agent = np.concatenate((active[rows], active[rows], active[i]))
+        partner = np.concatenate((np.full(len(rows), -1),
+                                  np.full(len(rows), -2), active[j]))
+        return times, agent, partner
+
+    def get_neighbourPairs(self, loc, cutoff):
+        '''
+        Cell list broad phase for the collision table.
+
+        The station is divided into square cells with side >= cutoff and
+        each location is assigned to a cell. Returns the indices (i, j)
+        of every pair of locations in the same or in adjacent cells, so
+        every pair closer than cutoff is included exactly once.
+        '''
+        n_x = max(int(self.width // cutoff), 1)
+        n_y = max(int(self.height // cutoff), 1)
+        cell_x = np.clip((loc[:, 0] * n_x / self.width).astype(int),
+                         0, n_x - 1)
+        cell_y = np.clip((loc[:, 1] * n_y / self.height).astype(int),
+                         0, n_y - 1)
+        cell = cell_x * n_y + cell_y
+
+        order = np.argsort(cell, kind='stable')
+        cell_sorted = cell[order]
+        cells = np.arange(n_x * n_y)
+        cell_start = np.searchsorted(cell_sorted, cells, side='left')
+        cell_end = np.searchsorted(cell_sorted, cells, side='right')
+
+        pairs_i, pairs_j = [], []
+        # Half of the neighbouring cells, so that each pair appears once
+        for dx, dy in ((0, 0), (1, -1), (1, 0), (1, 1), (0, 1)):
+            nx, ny = cell_x + dx, cell_y + dy
+            inside = (nx < n_x) & (ny >= 0) & (ny < n_y)
+            first = np.where(inside, cell_start[(nx * n_y + ny) % cells.size],
+                             0)
+            count = np.where(inside, cell_end[(nx * n_y + ny) % cells.size],
+                             0) - first
+            i = np.repeat(np.arange(len(loc)), count)
+            offset = np.arange(count.sum()) - np.repeat(np.cumsum(count) -
+                                                        count, count)
+            j = order[np.repeat(first, count) + offset]
+            if dx == 0 and dy == 0:
+                keep = i < j
+                i, j = i[keep], j[keep]
+            pairs_i.append(i)
+            pairs_j.append(j)
+
+        return np.concatenate(pairs_i), np.concatenate(pairs_j)
+
+    def get_collisionTable_pairwise(self):
+        '''
+        Agent by agent version of get_collisionTable, based on
+        Agent.get_collisionTime2Agents and Agent.get_collisionTimeWall.
+        It is kept as a reference for tests and benchmarks.
         '''
         collisionTable = []
         for i in range(self.pop_total):
@@ -644,7 +1526,80 @@ class Model:
         except:
             tmin = 1.0e300
 
-        return collisionTable, tmin
+        return np.reshape(collisionTable, (-1, 2)), tmin
+
+    def get_active_arrays(self):
+        '''
+        Returns the indices of the active agents and arrays with their
+        locations (n, 2), velocities (n, 2) and sizes (n,).
+        '''
+        active = np.flatnonzero(self.agents_status[:self.pop_total] == 1)
+        return (active, *self.get_agent_arrays(active))
+
+    def get_agent_arrays(self, ids):
+        '''
+        Returns arrays with the locations (n, 2), velocities (n, 2) and
+        sizes (n,) of the agents with the given indices.
+        '''
+        ids = np.asarray(ids, dtype=int)
+        loc = self.agents_location[ids]
+        speed = self.agents_speed[ids]
+        vel = speed[:, None] * self.get_directions(
+            self.agents_loc_desire[ids], loc)
+        return loc, vel, self.agents_size[ids]
+
+    @staticmethod
+    def get_directions(loc_desire, loc):
+        '''
+        Vectorized Agent.get_direction: unit vectors (n, 2) from loc to
+        loc_desire, or (0, 0) when both points are the same.
+        '''
+        diff = loc_desire - loc
+        distance = (diff[:, 0]*diff[:, 0] + diff[:, 1]*diff[:, 1])**.5
+        direction = np.zeros_like(diff)
+        moving = distance != 0
+        direction[moving] = diff[moving] / distance[moving, None]
+        return direction
+
+    @staticmethod
+    def get_collisionTimes(locA, velA, sizeA, locB, velB, sizeB):
+        '''
+        Vectorized Agent.get_collisionTime2Agents. The arguments are
+        broadcast against each other, so B can be a single obstacle
+        (e.g. the clock) or one partner per row of A. Pairs that do not
+        collide get a collision time of 1.0e300.
+        '''
+        locA, locB = np.asarray(locA), np.asarray(locB)
+        velA, velB = np.asarray(velA), np.asarray(velB)
+        rx = locA[..., 0] - locB[..., 0]
+        ry = locA[..., 1] - locB[..., 1]
+        vx = velA[..., 0] - velB[..., 0]
+        vy = velA[..., 1] - velB[..., 1]
+        sizeAB = np.asarray(sizeA) + np.asarray(sizeB)
+
+        bAB = vx*rx + vy*ry
+        vAB2 = vx*vx + vy*vy
+        delta = bAB**2 - vAB2*(rx*rx + ry*ry - sizeAB**2)
+        collide = (bAB < 0.0) & (delta > 0.0)
+
+        tmin = np.full(np.shape(bAB), 1.0e300)
+        tmin[collide] = np.abs((-bAB[collide] - np.sqrt(delta[collide])) /
+                               vAB2[collide])
+        return tmin
+
+    def get_collisionTimeWalls(self, loc, vel, size):
+        '''
+        Vectorized Agent.get_collisionTimeWall.
+        '''
+        tmin = np.full(len(loc), 1.0e300)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for axis, limit in ((1, self.height), (0, self.width)):
+                v = vel[:, axis]
+                collisionTime = np.where(
+                    v > 0, (limit - size - loc[:, axis]) / v,
+                    np.where(v < 0, (size - loc[:, axis]) / v, 1.0e300))
+                tmin = np.minimum(tmin, collisionTime)
+        return tmin
 
     def get_wiggleTable(self, collisionTable, time):
         '''
@@ -656,33 +1611,33 @@ class Model:
         - Column 0: collision time
         - Column 1: agent.unique_id
         '''
-        return set([line[1] for line in collisionTable
-                    if (abs(line[0] - time) < self.tolerance)])
+        collisionTable = np.reshape(collisionTable, (-1, 2))
+        wiggle = np.abs(collisionTable[:, 0] - time) < self.tolerance
+        return set(collisionTable[wiggle, 1].astype(int).tolist())
 
     # State
     def get_state(self, sensor=None):
         '''
-        Convert list of agents in model to state vector.
+        Convert the agent arrays of the model to a state vector. The
+        state is always a copy, so it can be stored by the caller.
         '''
+        n = self.pop_total
         if sensor is None:
-            state = [(agent.status, *agent.location, agent.speed) for agent in
-                     self.agents]
+            state = np.column_stack((self.agents_status[:n],
+                                     self.agents_location[:n],
+                                     self.agents_speed[:n]))
             state = np.append(self.step_id, np.ravel(state))
         elif sensor == 'location':
-            state = [agent.location for agent in self.agents]
-            state = np.ravel(state)
+            state = self.agents_location[:n].flatten()
         elif sensor == 'location2D':
-            state = [agent.location for agent in self.agents]
+            state = [tuple(loc) for loc in self.agents_location[:n].tolist()]
         elif sensor == 'loc_exit':
-            locations = self.get_state('location2D')
-            x, y = [l[0] for l in locations], [l[1] for l in locations]
-            exits = [agent.gate_out for agent in self.agents]
+            x, y = self.agents_location[:n].T.tolist()
+            exits = self.agents_gate_out[:n].tolist()
             state = x + y + exits
         elif sensor == 'locationVel':
-            state0 = [agent.location for agent in self.agents]
-            state0 = np.ravel(state0)
-            state1 = [agent.speed for agent in self.agents]
-            state1 = np.ravel(state1)
+            state0 = self.agents_location[:n].flatten()
+            state1 = self.agents_speed[:n].copy()
             state = [state0, state1]
         return state
 
@@ -690,31 +1645,108 @@ class Model:
         '''
         Use state vector to set agent locations.
         '''
+        n = self.pop_total
         if sensor is None:
             self.step_id = int(state[0])
-            state = np.reshape(state[1:], (self.pop_total, 3))
-            for i, agent in enumerate(self.agents):
-                agent.status = int(state[i, 0])
-                agent.location = state[i, 1:]
+            state = np.reshape(state[1:], (n, 3))
+            self.agents_status[:n] = state[:, 0].astype(int)
+            self.agents_location[:n] = state[:, 1:]
+            self.activation_queue = None
         elif sensor == 'location':
-            state = np.reshape(state, (self.pop_total, 2))
-            for i, agent in enumerate(self.agents):
-                agent.location = state[i, :]
+            self.agents_location[:n] = np.reshape(state, (n, 2))
         elif sensor == 'location2D':
-            for i, agent in enumerate(self.agents):
-                agent.location = state[i, :]
+            self.agents_location[:n] = np.reshape(state, (n, 2))
         elif sensor == 'exit':
-            for i, agent in enumerate(self.agents):
-                agent.gate_out = state[i]
-                agent.loc_desire = agent.set_agent_location(state[i])
+            self.agents_gate_out[:n] = state[:n]
+            self.agents_loc_desire[:n] = self.get_gate_locations(
+                state[:n], self.agents_size[:n])
         elif sensor == 'locationVel':
-            state0 = np.reshape(state[0], (self.pop_total, 2))
-            state1 = np.reshape(state[1], (self.pop_total, 1))
-            for i, agent in enumerate(self.agents):
-                agent.location = state0[i, :]
-                agent.speed = state1[i, :]
+            self.agents_location[:n] = np.reshape(state[0], (n, 2))
+            self.agents_speed[:n] = np.reshape(state[1], n)
         else:
             raise ValueError('Sensor type not recognised.')
+        self.spatial_index.invalidate()
+
+    def snapshot(self):
+        '''
+        Returns the dynamic state of the model (agent arrays, clocks,
+        counters and random generator) as a small dictionary of arrays,
+        that can be pickled and loaded back with restore, in this model
+        or in a copy of it. The history is not copied, only its length.
+        '''
+        n = self.pop_total
+        agents = self.agents
+        snapshot = {
+            'step_id': self.step_id,
+            'status': self.status,
+            'pop_active': self.pop_active,
+            'pop_finished': self.pop_finished,
+            'total_time': self.total_time,
+            'agents_status': self.agents_status[:n].copy(),
+            'agents_location': self.agents_location[:n].copy(),
+            'agents_loc_desire': self.agents_loc_desire[:n].copy(),
+            'agents_speed': self.agents_speed[:n].copy(),
+            'agents_gate_in': self.agents_gate_in[:n].copy(),
+            'agents_gate_out': self.agents_gate_out[:n].copy(),
+            'steps_activate': self.agents_steps_activate[:n].copy(),
+            'step_start': self.agents_step_start[:n].copy(),
+            'loc_start': self.agents_loc_start[:n].copy(),
+            'speed_max': self.agents_speed_max[:n].copy(),
+            'rng': self.rng.bit_generator.state,
+            'recorder': self.recorder.get_lengths(),
+        }
+        if self.do_history:
+            snapshot['history_wiggles'] = np.array([a.history_wiggles
+                                                    for a in agents])
+            snapshot['history_collisions'] = np.array([a.history_collisions
+                                                       for a in agents])
+            snapshot['history_lengths'] = [len(getattr(self, name)) for name
+                                           in self._history_lists]
+        return snapshot
+
+    def restore(self, snapshot):
+        '''
+        Load a snapshot (see Model.snapshot) into the model. The history
+        recorded after the snapshot was taken is dropped.
+        '''
+        n = self.pop_total
+        for key in ('step_id', 'status', 'pop_active', 'pop_finished',
+                    'total_time'):
+            setattr(self, key, snapshot[key])
+        for key in ('agents_status', 'agents_location', 'agents_loc_desire',
+                    'agents_speed', 'agents_gate_in', 'agents_gate_out'):
+            getattr(self, key)[:n] = snapshot[key]
+        self.agents_steps_activate[:n] = snapshot['steps_activate']
+        self.agents_speed_max[:n] = snapshot['speed_max']
+        self.spatial_index.invalidate()
+        self.activation_queue = None
+
+        self.agents_step_start[:n] = snapshot['step_start']
+        self.agents_loc_start[:n] = snapshot['loc_start']
+        self.rng.bit_generator.state = snapshot['rng']
+        self.recorder.truncate(snapshot['recorder'])
+
+        if self.do_history and 'history_lengths' in snapshot:
+            for i, agent in enumerate(self.agents):
+                agent.history_wiggles = snapshot['history_wiggles'][i]
+                agent.history_collisions = snapshot['history_collisions'][i]
+            for name, length in zip(self._history_lists,
+                                    snapshot['history_lengths']):
+                del getattr(self, name)[length:]
+
+    def copy(self):
+        '''
+        Returns a new model with the parameters and the dynamic state
+        (see snapshot) of this one, e.g. for the particles of a filter.
+        This is much faster than deepcopy for large populations, but the
+        history recorded so far is not copied, and the copy keeps its
+        history in memory: it must not reopen (and truncate) the files of
+        this model in history_dir.
+        '''
+        params = dict(self.params, history_dir=None)
+        model = type(self)(unique_id=self.unique_id, **params)
+        model.restore(self.snapshot())
+        return model
 
     # TODO: Deprecated, update PF
     def agents2state(self, do_ravel=True):
@@ -730,24 +1762,31 @@ class Model:
     def get_data(self, time_id, agents=None, sensor='frame'):
         '''
         Save all locations of all agents. there are many ways to
-        organize this information. In principle, each frame will be
-        stored in a different file.
+        organize this information:
+        - 'trajectories': the whole run in one binary file,
+          trajectories.npy, that can be read with TrajectoryFile.
+        - 'frame': one text file per frame.
+        - 'trails': one text file per agent.
+        - 'activation': one text file with the parameters of each agent.
         '''
         directory = sensor + '_' + time_id
         if not(os.path.exists(directory)):
             os.mkdir(directory)
-        locs = np.array([agent.history_locations for agent in
-                         self.agents[:agents]]).transpose((1, 2, 0))
+        if(sensor == 'trajectories'):
+            return TrajectoryFile.write(
+                directory + '/trajectories.npy',
+                self.recorder.locations[:, :agents],
+                self.recorder.active[:, :agents])
+        locs = self.recorder.get_locations(agents)
         if(sensor == 'frame'):
             for frame in range(self.step_id):
                 filename = directory + '/frame_' + str(frame+1) + '.dat'
                 save_file = open(filename, 'w')
                 print('#agentID', 'x', 'y', file=save_file)
-                x = locs[frame-1][0]
-                y = locs[frame-1][1]
-                for agent in range(self.pop_total):
-                    if(x[agent] is not None):
-                        print(agent, x[agent], y[agent], file=save_file)
+                x = locs[frame-1, :, 0]
+                y = locs[frame-1, :, 1]
+                for agent in np.flatnonzero(~np.isnan(x)):
+                    print(agent, x[agent], y[agent], file=save_file)
                 save_file.close()
         elif(sensor == 'activation'):
             save_file = open(directory+'/activation.dat', 'w')
@@ -764,10 +1803,9 @@ class Model:
             for agent in self.agents:
                 filename = directory + f'/agent_{agent.unique_id}.dat'
                 save_file = open(filename, 'w')
-                loc = agent.history_locations
-                for xy in loc:
-                    if(xy[0] is not None):
-                        print(xy[0], xy[1], file=save_file)
+                loc = locs[:, agent.unique_id]
+                for xy in loc[~np.isnan(loc[:, 0])]:
+                    print(xy[0], xy[1], file=save_file)
                 save_file.close()
 
     # Analytics
@@ -819,6 +1857,7 @@ class Model:
         if plot_legend:
             plt.legend(['Active', 'Finished'])
         plt.tight_layout(pad=0)
+        history_locs = self.recorder.get_locations()
         for agent in self.agents:
             if agent.status == 1:
                 alpha = 1
@@ -829,7 +1868,7 @@ class Model:
             else:
                 alpha = 1
                 colour = colours[2]
-            locs = np.array(agent.history_locations).T
+            locs = history_locs[:, agent.unique_id].T
             plt.plot(*locs, color=colour, alpha=alpha, linewidth=.5)
         if xlim is not None:  # Optionally set the x limits
             plt.xlim(xlim)
@@ -897,12 +1936,7 @@ class Model:
         :param title: (optional) title for the plot
         :return:
         '''
-        history_locs = []
-        for agent in self.agents:
-            for loc in agent.history_locations:
-                if None not in loc:
-                    history_locs.append(loc)
-        history_locs = np.array(history_locs).T
+        history_locs = self.recorder.locations[self.recorder.active].T
         fig, ax = plt.subplots(1, figsize=self._figsize, dpi=self._dpi)
         fig.tight_layout(pad=0)
         self._heightmap(data=history_locs, ax=ax, kdeplot=do_kdeplot,
@@ -917,8 +1951,7 @@ class Model:
     def get_ani(self, agents=None, colour='k', alpha=.5, show_separation=False,
                 wiggle_map=False):
         # Load Data
-        locs = np.array([agent.history_locations for agent in
-                         self.agents[:agents]]).transpose((1, 2, 0))
+        locs = self.recorder.get_locations(agents).transpose((0, 2, 1))
         markersize1 = self.separation * 216*self._rel  # 3*72px/in=216
         markersize2 = 216*self._rel
         #
@@ -949,15 +1982,17 @@ class Model:
     def get_distace_plot(self, real_data_dir, frame_i, frame_f, dt):
         self.graphX1, self.graphY1, self.graphERR1 = [], [], []  # x, y, dy
         data = []
+        history_locs = self.recorder.get_locations()
         for frame in range(frame_i, frame_f, dt):
             ID, x, y = np.loadtxt(real_data_dir + str(frame) + '.0.dat',
                                   unpack=True)
             dist = []
+            locs = history_locs[int(frame/dt)]
             for i in range(len(ID)):
                 agent_ID = int(ID[i])
-                r1 = self.agents[agent_ID].history_locations[int(frame/dt)]
+                r1 = locs[agent_ID]
                 r2 = (x[i], y[i])
-                if np.all(r1 != (None, None)):
+                if not np.isnan(r1[0]):
                     distance = self.agents[agent_ID].distance(r1, r2)
                     dist.append(distance)
                     time = int(frame - self.agents[agent_ID].step_start)
@@ -990,15 +2025,225 @@ class Model:
         self.graphY2.append(dist.mean())
         self.graphERR2.append(dist.std())
 
-    @classmethod
-    def set_random_seed(cls, seed=None):
-        '''Set a new numpy random seed
-        :param seed: the optional seed value (if None then
-        get one from os.urandom)
-        '''
-        new_seed = int.from_bytes(os.urandom(4), byteorder='little')\
-            if seed is None else seed
-        np.random.seed(new_seed)
+    def set_random_seed(self, seed=None):
+        '''Give the model (and its agents) a new numpy random Generator
+        :param seed: the optional seed value or np.random.SeedSequence
+        (if None then get fresh entropy from the operating system)
+        '''
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        self.seed_sequence = seed
+        self.rng = np.random.default_rng(seed)
+
+    def spawn_random_seeds(self, n):
+        '''
+        Returns n independent np.random.SeedSequence children of the seed
+        of the model, e.g. for copies of the model used as particles.
+        The same seed always gives the same children, in order: they are
+        spawned from a fresh copy of the seed, as SeedSequence.spawn would
+        give new children on every call.
+        '''
+        seed = self.seed_sequence
+        return np.random.SeedSequence(seed.entropy, spawn_key=seed.spawn_key,
+                                      pool_size=seed.pool_size).spawn(n)
+
+
+class ModelEnsemble:
+    '''
+    K replicas of a Model (e.g. the particles of a particle filter)
+    stepped together.
+
+    The agent arrays of the replicas (see Model.init_agent_arrays) are
+    stacked into arrays of shape (K, pop_total + 1, ...), and each model
+    keeps a view of its own row, so the agents and the models work as
+    before. In each sub-step the collision tables of all the replicas
+    that are still moving are calculated with one set of array
+    operations, and all the agents of all the replicas are moved at
+    once. Activation and wiggles are done by each model, with its own
+    random generator, so the replicas are independent of each other.
+
+    All the models must have the same population and station. The
+    collision table is always used, even if do_event_queue is True (see
+    CollisionQueue: the two agree only up to floating-point error).
+    '''
+
+    def __init__(self, models, seeds=None):
+        '''
+        Stack the agent arrays of the models. If seeds (one per model)
+        are given, the models get new random generators from them.
+        '''
+        self.models = list(models)
+        self.pop_total = self.models[0].pop_total
+        if any(model.pop_total != self.pop_total for model in self.models):
+            raise ValueError('All the models must have the same pop_total.')
+
+        for name in ('status', 'location', 'loc_desire', 'speed', 'size',
+                     'gate_in', 'gate_out'):
+            array = np.stack([getattr(model, 'agents_' + name)
+                              for model in self.models])
+            setattr(self, name, array)
+            for k, model in enumerate(self.models):
+                setattr(model, 'agents_' + name, array[k])
+        for model in self.models:
+            model.spatial_index.invalidate()
+
+        if seeds is not None:
+            for model, seed in zip(self.models, seeds):
+                model.set_random_seed(seed)
+
+    def step(self, num_iter=1):
+        '''
+        Iterate all the models forward num_iter seconds. The result for
+        each replica is the same as with Model.step and do_event_queue
+        False (with do_event_queue True it only agrees up to
+        floating-point error, see CollisionQueue).
+        '''
+        for _ in range(num_iter):
+            running = []
+            for k, model in enumerate(self.models):
+                if not model.is_running():
+                    model.step()
+                elif not model.fast_forward(1):
+                    running.append(k)
+
+            for k in running:
+                model = self.models[k]
+                if model.do_print and model.step_id % 100 == 0:
+                    print(f'\tIteration: {model.step_id}/{model.step_limit}')
+                model.activate_agents()
+
+            replicas = np.array(running, dtype=int)
+            t = np.ones(len(replicas))
+            while len(replicas) > 0:
+                collisionTables, tmin = self.get_collisionTables(replicas, t)
+                collide = tmin <= t
+                time_step = np.where(collide, tmin * 0.98, t)
+                self.move_agents(replicas, time_step)
+                for k, replica in enumerate(replicas):
+                    model = self.models[replica]
+                    if collide[k]:
+                        wiggleTable = model.get_wiggleTable(
+                            collisionTables[k], time_step[k])
+                        model.set_wiggles(wiggleTable)
+                    model.total_time += time_step[k]
+                t = np.where(collide, t - time_step, 0)
+                replicas, t = replicas[t > 0], t[t > 0]
+
+            for k in running:
+                model = self.models[k]
+                if model.do_history:
+                    model.record_history()
+                model.step_id += 1
+
+    def get_collisionTables(self, replicas, times):
+        '''
+        Model.get_collisionTable for several replicas at once. Returns a
+        list with the collision table of each replica and an array with
+        their tmin.
+        '''
+        n = self.pop_total
+        actives = [np.flatnonzero(self.status[k, :n] == 1) for k in replicas]
+        counts = np.array([len(active) for active in actives], dtype=int)
+        starts = np.cumsum(counts) - counts
+        rep = np.repeat(replicas, counts)
+        ids = np.concatenate(actives).astype(int)
+
+        loc = self.location[rep, ids]
+        vel = self.speed[rep, ids, None] * Model.get_directions(
+            self.loc_desire[rep, ids], loc)
+        size = self.size[rep, ids]
+        model = self.models[replicas[0]]
+        wall_times = model.get_collisionTimeWalls(loc, vel, size)
+        clock_times = Model.get_collisionTimes(loc, vel, size,
+                                               self.location[rep, n],
+                                               np.zeros(2), self.size[rep, n])
+
+        pairs_i, pairs_j = [], []
+        for k, replica in enumerate(replicas):
+            model = self.models[replica]
+            rows = slice(starts[k], starts[k] + counts[k])
+            if counts[k] == 0:
+                i, j = np.empty(0, int), np.empty(0, int)
+            elif model.do_cell_list:
+                speed_max = np.sqrt((vel[rows]**2).sum(axis=1)).max()
+                cutoff = 2 * (size[rows].max() +
+                              speed_max * (times[k] + model.tolerance))
+                i, j = model.get_neighbourPairs(loc[rows], cutoff)
+            else:
+                i, j = np.triu_indices(counts[k], 1)
+            pairs_i.append(i + starts[k])
+            pairs_j.append(j + starts[k])
+        pair_counts = [len(i) for i in pairs_i]
+        i, j = np.concatenate(pairs_i), np.concatenate(pairs_j)
+        pair_times = Model.get_collisionTimes(loc[i], vel[i], size[i],
+                                              loc[j], vel[j], size[j])
+
+        collisionTables = []
+        tmin = np.full(len(replicas), 1.0e300)
+        pair_start = 0
+        for k in range(len(replicas)):
+            if counts[k] == 0:
+                collisionTables.append(np.empty((0, 2)))
+                continue
+            rows = slice(starts[k], starts[k] + counts[k])
+            pairs = slice(pair_start, pair_start + pair_counts[k])
+            pair_start += pair_counts[k]
+            collisionTable = np.column_stack((
+                np.concatenate((wall_times[rows], clock_times[rows],
+                                pair_times[pairs], pair_times[pairs])),
+                np.concatenate((ids[rows], ids[rows], ids[i[pairs]],
+                                ids[j[pairs]]))))
+            collisionTables.append(collisionTable)
+            tmin[k] = collisionTable[:, 0].min()
+            if tmin[k] <= 1.0e-10:
+                tmin[k] = 0.02
+        return collisionTables, tmin
+
+    def move_agents(self, replicas, time_steps):
+        '''
+        Model.move_agents for several replicas at once, each one with its
+        own time step.
+        '''
+        k, ids = np.nonzero(self.status[replicas, :self.pop_total] == 1)
+        rep = replicas[k]
+        loc = self.location[rep, ids]
+        loc_desire = self.loc_desire[rep, ids]
+        direction = Model.get_directions(loc_desire, loc)
+        loc = loc + self.speed[rep, ids, None] * direction * \
+            time_steps[k, None]
+        self.location[rep, ids] = loc
+        for replica in replicas:
+            self.models[replica].spatial_index.invalidate()
+
+        diff = loc - loc_desire
+        dist = (diff[:, 0]*diff[:, 0] + diff[:, 1]*diff[:, 1])**.5
+        arrived = dist < self.models[0].gates_space + 1e-9
+        # Agent.deactivate makes the final decision
+        for replica, i in zip(rep[arrived], ids[arrived]):
+            self.models[replica].agents[i].deactivate()
+
+    def get_state(self, sensor='location'):
+        '''
+        Returns the states of all the replicas as an array (K, ...), see
+        Model.get_state.
+        '''
+        if sensor == 'location':
+            return self.location[:, :self.pop_total].reshape(
+                len(self.models), -1).copy()
+        return np.array([model.get_state(sensor) for model in self.models])
+
+    def set_state(self, states, sensor='location'):
+        '''
+        Set the states (K, ...) of all the replicas, see Model.set_state.
+        '''
+        if sensor == 'location':
+            self.location[:, :self.pop_total] = np.reshape(
+                states, (len(self.models), self.pop_total, 2))
+            for model in self.models:
+                model.spatial_index.invalidate()
+        else:
+            for model, state in zip(self.models, states):
+                model.set_state(state, sensor)
 
 
 if __name__ == '__main__':
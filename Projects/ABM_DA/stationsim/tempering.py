@@ -0,0 +1,153 @@
+'''
+Adaptive tempering for the tempered particle filters.
+
+Instead of weighting the particles by the likelihood of an observation in
+one go, a tempered filter brings it in through temperatures
+0 < t_1 < ... < t_K = 1, weighting by likelihood ** (t_k - t_k-1) at each
+stage, resampling, and moving the particles with Monte Carlo steps (MCMC
+rejuvenation) that keep the ones that fit the tempered likelihood.
+
+AdaptiveTempering chooses every temperature by bisection, so the
+conditional effective sample size of the stage is target_ess of the
+particles, and stops the moves of a stage as soon as a round of moves
+stops making more particles move. Easy observations take a single stage
+and few moves, and hard ones as many as they need.
+'''
+import numpy as np
+from resampling import log_normalise
+
+
+def conditional_ess(log_weights, log_increment):
+    '''
+    Returns the conditional effective sample size (Zhou, Johansen and Aston,
+    2016) of the incremental log weights log_increment, given the normalised
+    log weights of the particles: number_of_particles * (sum W w) ** 2 /
+    sum W w ** 2. It is the number of particles when the increment is the
+    same for all of them.
+    '''
+    log_increment = log_increment - np.max(log_increment)
+    log_first = np.logaddexp.reduce(log_weights + log_increment)
+    log_second = np.logaddexp.reduce(log_weights + 2 * log_increment)
+    return len(log_weights) * np.exp(2 * log_first - log_second)
+
+
+def next_temperature(log_weights, log_likelihood, temperature=0.,
+                     target_ess=0.5, tolerance=1e-6):
+    '''
+    Returns the next temperature, after temperature, at which the
+    conditional effective sample size of the weights likelihood **
+    (next - temperature) is target_ess of the particles, found by
+    bisection, or 1 if it is above target_ess at 1.
+    '''
+    target = target_ess * len(log_weights)
+
+    def ess(next_temperature):
+        return conditional_ess(log_weights,
+                               (next_temperature - temperature) * log_likelihood)
+
+    if ess(1.) >= target:
+        return 1.
+    low, high = temperature, 1.
+    while high - low > tolerance:
+        middle = (low + high) / 2
+        if ess(middle) >= target:
+            low = middle
+        else:
+            high = middle
+    # A stage always moves the temperature on
+    return max(low, temperature + tolerance)
+
+
+def metropolis_accept(log_likelihood, proposed_log_likelihood, temperature,
+                      rng=None):
+    '''
+    Returns which particles accept their proposed move (a boolean array),
+    with probability min(1, (proposed likelihood / likelihood) **
+    temperature), the proposal being the model dynamics.
+    '''
+    if rng is None:
+        rng = np.random.default_rng()
+    log_ratio = temperature * (proposed_log_likelihood - log_likelihood)
+    with np.errstate(invalid='ignore'):
+        return np.log(rng.uniform(size=len(log_ratio))) < log_ratio
+
+
+class AdaptiveTempering:
+    '''
+    The adaptive tempering of a particle filter (see temper).
+
+    - target_ess:       The conditional effective sample size (a fraction
+                        of the particles) of each stage
+    - max_moves:        The most rounds of moves in a stage
+    - min_improvement:  Stop the moves of a stage when a round moves fewer
+                        than this fraction of particles that had not moved
+    - max_stages:       The most stages in a window (the last one goes
+                        straight to temperature 1)
+
+    The temperatures, the rounds of moves and the acceptance rates of
+    every window are kept in temperatures, moves and acceptance.
+    '''
+
+    def __init__(self, target_ess=0.5, max_moves=10, min_improvement=0.05,
+                 max_stages=20):
+        self.target_ess = target_ess
+        self.max_moves = max_moves
+        self.min_improvement = min_improvement
+        self.max_stages = max_stages
+        self.temperatures = []
+        self.moves = []
+        self.acceptance = []
+
+    def temper(self, log_likelihood, resample, move, log_weights=None):
+        '''
+        Bring in the likelihood of an observation, in stages. At each one,
+        the particles are weighted up to the next temperature (see
+        next_temperature), resampled and moved.
+
+        :param log_likelihood: The log-likelihood of the observation for every particle (number_of_particles,)
+        :param resample: resample(weights) resamples the particles and returns their indexes
+        :param move: move(temperature, log_likelihood) moves the particles (see metropolis_accept) and
+                     returns which ones moved and their new log-likelihoods
+        :param log_weights: The normalised log weights of the particles (uniform by default)
+        :return: The log weights of the particles after the last stage (uniform)
+        '''
+        number_of_particles = len(log_likelihood)
+        if log_weights is None:
+            log_weights = np.full(number_of_particles,
+                                  -np.log(number_of_particles))
+        temperatures = []
+        moves = 0
+        accepted = []
+        temperature = 0.
+        while temperature < 1:
+            if len(temperatures) == self.max_stages - 1:
+                new_temperature = 1.
+            else:
+                new_temperature = next_temperature(
+                    log_weights, log_likelihood, temperature,
+                    self.target_ess)
+            log_weights = log_normalise(
+                log_weights + (new_temperature - temperature) * log_likelihood)
+            temperature = new_temperature
+            temperatures.append(temperature)
+
+            indexes = resample(np.exp(log_weights))
+            log_likelihood = log_likelihood[indexes]
+            log_weights = np.full(number_of_particles,
+                                  -np.log(number_of_particles))
+
+            # Move the particles until a round moves (almost) no new ones
+            moved = np.zeros(number_of_particles, dtype=bool)
+            for _ in range(self.max_moves):
+                accept, log_likelihood = move(temperature, log_likelihood)
+                moves += 1
+                accepted.append(np.mean(accept))
+                improvement = np.mean(accept & ~moved)
+                moved |= accept
+                if improvement < self.min_improvement or np.all(moved):
+                    break
+
+        self.temperatures.append(temperatures)
+        self.moves.append(moves)
+        self.acceptance.append(np.mean(accepted))
+        return log_weights
@@ -28,6 +28,52 @@ def set_up_model(population_size=3, step_limit=3600):
     return model
 
 
+def set_up_active_model(population_size, seed):
+    """
+    Set up active model.
+
+    Set up an instance of the stationsim_gcs model in which every agent is
+    active and placed at a random location inside the station.
+
+    Parameters
+    ----------
+    population_size : int
+        The number of agents in the model population.
+    seed : int
+        The random seed used by the model.
+    """
+    model_params = {'pop_total': population_size,
+                    'station': 'Grand_Central',
+                    'random_seed': seed,
+                    'do_print': False}
+    model = Model(**model_params)
+    margin = 2 * model.agent_size
+    for agent in model.agents:
+        agent.status = 1
+        agent.location = model.rng.uniform((margin, margin),
+                                           (model.width - margin,
+                                            model.height - margin))
+        agent.step_start = model.total_time
+        agent.loc_start = agent.location.copy()
+    model.pop_active = population_size
+    return model
+
+
+def get_collision_data():
+    """
+    Get collision data.
+
+    Generate population sizes and random seeds with which to compare the
+    vectorized collision table with the agent by agent version.
+    """
+    population_sizes = [1, 2, 10, 50, 200]
+    seeds = [1, 7, 42, 123, 2020]
+
+    collision_data = list(zip(population_sizes, seeds))
+
+    return collision_data
+
+
 def get_location_data():
     """
     Get location data.
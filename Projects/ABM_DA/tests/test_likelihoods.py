@@ -0,0 +1,85 @@
+# Imports
+import numpy as np
+import pytest
+import sys
+from scipy import stats
+sys.path.append('../stationsim/')
+
+from likelihoods import (get_likelihood, InverseDistanceLikelihood,
+                         GaussianLikelihood, StudentTLikelihood)
+
+
+# Helpers
+def set_up_states(number_of_particles=50, dimensions=40, seed=1):
+    rng = np.random.default_rng(seed)
+    observation = rng.uniform(0, 100, size=dimensions)
+    states = observation + rng.normal(0, 2, size=(number_of_particles,
+                                                  dimensions))
+    return states, observation
+
+
+# Tests
+def test_inverse_distance():
+    """
+    Test that the default likelihood gives the weights the particle
+    filters used before.
+    """
+    states, observation = set_up_states()
+    distance = np.linalg.norm(states - observation, axis=1)
+
+    weights = 1 / (distance + 1e-9) ** 2
+    log_weights = get_likelihood().log_weights(states, observation)
+    assert np.allclose(np.exp(log_weights), weights / np.sum(weights))
+
+    # ParticleFilter_MK: 1/distance
+    weights = 1 / np.fmax(distance, 1e-99)
+    likelihood = InverseDistanceLikelihood(power=1, offset=0)
+    log_weights = likelihood.log_weights(states, observation)
+    assert np.allclose(np.exp(log_weights), weights / np.sum(weights))
+
+
+@pytest.mark.parametrize('likelihood, logpdf', [
+    (GaussianLikelihood(std=2), lambda r: stats.norm.logpdf(r, scale=2)),
+    (StudentTLikelihood(std=2, dof=3),
+     lambda r: stats.t.logpdf(r, df=3, scale=2))])
+def test_log_likelihood(likelihood, logpdf):
+    """
+    Test the Gaussian and Student-t log-likelihoods against scipy (up to a
+    constant), leaving out the masked and NaN parts of the observation.
+    """
+    states, observation = set_up_states()
+    mask = np.ones(len(observation), dtype=bool)
+    mask[:10] = False
+    observation[-4:] = np.nan
+    observed = mask & ~np.isnan(observation)
+
+    log_likelihood = likelihood.log_likelihood(states, observation, mask)
+    expected = np.sum(logpdf(states[:, observed] - observation[observed]),
+                      axis=1)
+    assert np.allclose(log_likelihood - log_likelihood[0],
+                       expected - expected[0])
+
+    # Moving the particles in the parts that are not observed changes nothing
+    moved = states.copy()
+    moved[:, ~observed] += 1000
+    assert np.allclose(likelihood.log_likelihood(moved, observation, mask),
+                       log_likelihood)
+
+
+def test_log_weights_do_not_underflow():
+    """
+    Test that the weights of many agents far from the observation still
+    tell the particles apart.
+    """
+    states, observation = set_up_states(dimensions=20000)
+    log_weights = GaussianLikelihood(std=0.1).log_weights(states,
+                                                          observation)
+    assert np.all(np.isfinite(log_weights))
+    assert np.isclose(np.sum(np.exp(log_weights)), 1)
+    distance = np.linalg.norm(states - observation, axis=1)
+    assert np.argmax(log_weights) == np.argmin(distance)
+
+
+def test_unknown_likelihood():
+    with pytest.raises(ValueError):
+        get_likelihood('poisson')
@@ -0,0 +1,85 @@
+# Imports
+import numpy as np
+import pytest
+import sys
+sys.path.append('../stationsim/')
+
+from stationsim_gcs_model import Model
+from particle_filter_gcs import ParticleFilter
+
+
+# Helpers
+class Stop(Exception):
+    pass
+
+
+class StoppingFilter(ParticleFilter):
+    # A run that is killed right after saving the checkpoint of a window
+    stop_window = 2
+
+    def checkpoint(self, filename=None):
+        result = super().checkpoint(filename)
+        if self.window_counter == self.stop_window:
+            raise Stop
+        return result
+
+
+def set_up_params(**filter_params):
+    model_params = {'pop_total': 10, 'station': 'Grand_Central',
+                    'do_print': False, 'do_history': False,
+                    'batch_iterations': 200, 'random_seed': 1,
+                    'birth_rate': 2}
+    params = {'number_of_particles': 6, 'number_of_runs': 1,
+              'resample_window': 50, 'multi_step': True,
+              'particle_std': 0.5, 'model_std': 1.0,
+              'agents_to_visualise': 2, 'do_save': True,
+              'plot_save': False, 'do_ani': False, 'show_ani': False,
+              'do_external_data': False, 'pf_method': 'sir'}
+    params.update(filter_params)
+    return model_params, params
+
+
+# Tests
+@pytest.mark.parametrize('filter_params', [{}, {'do_resident': True},
+                                           {'nodes': 2}])
+def test_resume(tmp_path, filter_params):
+    """
+    Test that a run resumed from a checkpoint gives the same results as
+    the run that was not stopped.
+    """
+    model_params, params = set_up_params(**filter_params)
+    pf = ParticleFilter(Model, model_params, dict(params), numcores=2)
+    result = pf.step()
+
+    params['checkpoint_dir'] = str(tmp_path)
+    with pytest.raises(Stop):
+        StoppingFilter(Model, model_params, params, numcores=2).step()
+    resumed = ParticleFilter.resume(str(tmp_path / 'checkpoint.pkl'),
+                                    numcores=1)
+    assert resumed.window_counter == StoppingFilter.stop_window
+    assert np.array_equal(resumed.step(), result)
+    assert np.array_equal(resumed.metrics.records, pf.metrics.records)
+    assert np.array_equal(resumed.states, pf.states)
+    assert np.array_equal(resumed.estimate_model.recorder.locations,
+                          pf.estimate_model.recorder.locations)
+
+
+def test_save_without_active_agents():
+    """
+    Test that a window without active agents is still saved, with NaN
+    errors that the summary leaves out.
+    """
+    model_params, params = set_up_params()
+    pf = ParticleFilter(Model, model_params, params, numcores=1)
+    pf.active_states = np.zeros_like(pf.active_states)
+    pf.save(before=True)
+    pf.active_states = pf.get_active_states()
+    pf.active_states[:4] = True
+    pf.save(before=True)
+
+    records = pf.metrics.records
+    assert list(records['active_agents']) == [0, 2]
+    assert np.isnan(records['mean_error'][0])
+    assert not np.isnan(records['mean_error'][1])
+    summary = pf.metrics.summary()
+    assert summary[0]['mean_error']['average'] == records['mean_error'][1]
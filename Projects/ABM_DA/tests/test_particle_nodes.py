@@ -0,0 +1,55 @@
+# Imports
+import numpy as np
+import pytest
+import sys
+sys.path.append('../stationsim/')
+
+from particle_nodes import ParticleNodes, parse_address
+from test_particle_workers import set_up_particles, step_locally
+
+
+# Tests
+def test_parse_address():
+    assert parse_address('node-1:6000') == ('node-1', 6000)
+    assert parse_address(('localhost', '6001')) == ('localhost', 6001)
+
+
+@pytest.mark.parametrize('number_of_nodes', [1, 2])
+def test_particle_nodes(number_of_nodes):
+    """
+    Test ParticleNodes on nodes started on this machine.
+
+    Test that the particles kept in the nodes give the same states as the
+    same particles stepped in this process, that a resample copies the
+    states and agents of the right particles, also between nodes, and
+    that the bytes going through the connections are counted.
+    """
+    models = set_up_particles()
+    local = [model.copy() for model in models]
+    nodes = ParticleNodes(models, number_of_nodes)
+    try:
+        assert nodes.traffic() > 0
+        states = nodes.step(20, 0.5)
+        assert np.array_equal(states, step_locally(local, 20, 0.5))
+
+        traffic = nodes.traffic()
+        indexes = np.array([0, 0, 1, 5, 5, 2])
+        n = local[0].pop_total
+        speeds = [model.agents_speed[:n].copy() for model in local]
+        states = states.copy()
+        nodes.states.array[:] = states[indexes]
+        nodes.resample(indexes, copy_agents=True)
+        assert nodes.traffic() > traffic
+
+        snapshots = nodes.get_snapshots()
+        for i, j in enumerate(indexes):
+            assert np.array_equal(snapshots[i]['agents_speed'], speeds[j])
+            assert np.array_equal(snapshots[i]['agents_location'].ravel(),
+                                  states[j])
+    finally:
+        nodes.close()
+
+
+def test_particle_nodes_need_authkey():
+    with pytest.raises(ValueError):
+        ParticleNodes(set_up_particles(), ['localhost:6000'])
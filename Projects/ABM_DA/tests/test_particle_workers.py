@@ -0,0 +1,102 @@
+# Imports
+import multiprocessing
+import numpy as np
+import pytest
+import sys
+sys.path.append('../stationsim/')
+
+from stationsim_gcs_model import Model
+from particle_workers import ParticleWorkers
+from shared_arrays import SharedArray
+
+
+# Helpers
+def set_up_particles(number_of_particles=6, pop_total=20):
+    base_model = Model(pop_total=pop_total, station='Grand_Central',
+                       random_seed=2, birth_rate=3, do_print=False)
+    seeds = base_model.spawn_random_seeds(number_of_particles)
+    models = [base_model.copy() for _ in range(number_of_particles)]
+    for model, seed in zip(models, seeds):
+        model.set_random_seed(seed)
+    return models
+
+
+def step_locally(models, num_iter, particle_std):
+    states = []
+    for model in models:
+        for _ in range(num_iter):
+            model.step()
+        noise = model.rng.normal(0, particle_std ** 2,
+                                 size=2 * model.pop_total)
+        state = model.get_state(sensor='location') + noise
+        model.set_state(state, sensor='location')
+        states.append(state)
+    return np.array(states)
+
+
+def write_row(states, i):
+    states.array[i] = i
+    return states.name
+
+
+# Tests
+def test_shared_array():
+    """
+    Test that SharedArray goes to other processes by name, and that what
+    they write in it is seen here.
+    """
+    shared = SharedArray((4, 3))
+    try:
+        with multiprocessing.Pool(2) as pool:
+            names = pool.starmap(write_row, [(shared, i) for i in range(4)])
+        assert names == [shared.name] * 4
+        assert np.array_equal(shared.array, np.repeat(np.arange(4.), 3)
+                              .reshape(4, 3))
+    finally:
+        shared.close()
+
+
+@pytest.mark.parametrize('numcores', [1, 2, 4])
+def test_particle_workers(numcores):
+    """
+    Test ParticleWorkers.
+
+    Test that the particles kept in the workers give the same states as the
+    same particles stepped in this process, written in the shared states
+    (also when stepping them asynchronously), and that resampling copies the speeds and destinations of the right
+    particles, inside a worker and between workers.
+    """
+    models = set_up_particles()
+    local = [model.copy() for model in models]
+    shared = SharedArray((len(models), 2 * models[0].pop_total))
+    workers = ParticleWorkers(models, numcores, states=shared)
+    try:
+        states = workers.step(20, 0.5)
+        assert states is shared.array
+        assert np.array_equal(states, step_locally(local, 20, 0.5))
+
+        # This process can work while the workers step
+        pending = workers.step_async(20, 0.5)
+        expected = step_locally(local, 20, 0.5)
+        pending.get()
+        assert np.array_equal(states, expected)
+
+        indexes = np.array([0, 0, 1, 5, 5, 2])
+        n = local[0].pop_total
+        speeds = [model.agents_speed[:n].copy() for model in local]
+        loc_desires = [model.agents_loc_desire[:n].copy() for model in local]
+        states = states.copy()
+        # The workers read the resampled states from the shared states
+        shared.array[:] = states[indexes]
+        workers.resample(indexes, copy_agents=True)
+
+        snapshots = workers.get_snapshots()
+        for i, j in enumerate(indexes):
+            assert np.array_equal(snapshots[i]['agents_speed'], speeds[j])
+            assert np.array_equal(snapshots[i]['agents_loc_desire'],
+                                  loc_desires[j])
+            assert np.array_equal(snapshots[i]['agents_location'].ravel(),
+                                  states[j])
+    finally:
+        workers.close()
+        shared.close()
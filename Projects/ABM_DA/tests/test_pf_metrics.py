@@ -0,0 +1,48 @@
+# Imports
+import numpy as np
+import sys
+sys.path.append('../stationsim/')
+
+from pf_metrics import MetricsAccumulator, weighted_moments
+
+
+# Tests
+def test_weighted_moments():
+    """
+    Test the weighted mean and variance against np.average.
+    """
+    rng = np.random.default_rng(1)
+    states = rng.normal(size=(20, 6))
+    weights = rng.uniform(size=20)
+    mean, variance = weighted_moments(states, weights)
+    expected = np.average(states, weights=weights, axis=0)
+    assert np.allclose(mean, expected)
+    assert np.allclose(variance, np.average((states - expected) ** 2,
+                                            weights=weights, axis=0))
+
+
+def test_metrics_accumulator():
+    """
+    Test that the accumulator grows past its capacity and summarises the
+    saves before and after resampling.
+    """
+    metrics = MetricsAccumulator(capacity=1)
+    errors = np.arange(10.)
+    for window, error in enumerate(errors):
+        metrics.record(window=window // 2, before=window % 2 == 0,
+                       mean_error=error, variance=2 * error)
+    assert len(metrics) == 10
+    assert np.array_equal(metrics.records['mean_error'], errors)
+
+    summary = metrics.summary()
+    assert list(summary['before']) == [True, False]
+    assert tuple(summary[0]['mean_error']) == (0, 8, 4)
+    assert tuple(summary[1]['variance']) == (2, 18, 10)
+
+    assert np.all(np.isnan(MetricsAccumulator().summary()['mean_error']['min']))
+
+    # Saves without active agents have NaN errors, left out of the summary
+    metrics.record(window=5, before=True, mean_error=np.nan,
+                   variance=np.nan)
+    assert len(metrics) == 11
+    assert tuple(metrics.summary()[0]['mean_error']) == (0, 8, 4)
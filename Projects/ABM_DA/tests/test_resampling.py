@@ -0,0 +1,142 @@
+# Imports
+import numpy as np
+import pytest
+import sys
+sys.path.append('../stationsim/')
+
+import resampling
+
+
+# Helpers
+def set_up_weights(number_of_particles=1000, seed=1):
+    weights = np.random.default_rng(seed).exponential(
+        size=number_of_particles)
+    weights[::7] = 0
+    return weights / np.sum(weights)
+
+
+def systematic_loop(weights, rng):
+    # Systematic resampling as ParticleFilter.resample used to do it
+    n = len(weights)
+    offset_partition = (np.arange(n) + rng.uniform()) / n
+    cumsum = np.cumsum(weights)
+    indexes = np.zeros(n, 'i')
+    i, j = 0, 0
+    while i < n:
+        if offset_partition[i] < cumsum[j]:
+            indexes[i] = j
+            i += 1
+        else:
+            j += 1
+    return indexes
+
+
+# Tests
+def test_systematic():
+    """
+    Test that systematic resampling gives the same indexes as the loop
+    used before, and copies particle i floor(N * w_i) or ceil(N * w_i)
+    times.
+    """
+    weights = set_up_weights()
+    for seed in range(5):
+        indexes = resampling.systematic(weights, np.random.default_rng(seed))
+        expected = systematic_loop(weights, np.random.default_rng(seed))
+        assert np.array_equal(indexes, expected)
+
+        counts = np.bincount(indexes, minlength=len(weights))
+        scaled = len(weights) * weights
+        assert np.all(counts >= np.floor(scaled) - 1e-9)
+        assert np.all(counts <= np.ceil(scaled) + 1e-9)
+
+
+@pytest.mark.parametrize('scheme', sorted(resampling.schemes))
+def test_resample(scheme):
+    """
+    Test that every scheme returns N valid indexes, never picks a particle
+    with no weight, and copies every particle N * w_i times on average.
+    """
+    weights = set_up_weights()
+    n = len(weights)
+    rng = np.random.default_rng(2)
+    counts = np.zeros(n)
+    repeats = 200
+    for _ in range(repeats):
+        indexes = resampling.resample(weights, scheme, rng)
+        assert indexes.shape == (n,)
+        assert np.all(weights[indexes] > 0)
+        counts += np.bincount(indexes, minlength=n)
+    # Within 5 standard deviations of the multinomial counts
+    tolerance = 5 * np.sqrt(n * weights / repeats) + 1e-9
+    assert np.all(np.abs(counts / repeats - n * weights) <= tolerance)
+
+    # The same generator state gives the same indexes
+    assert np.array_equal(
+        resampling.resample(weights, scheme, np.random.default_rng(3)),
+        resampling.resample(weights, scheme, np.random.default_rng(3)))
+
+    if scheme == 'residual':
+        counts = np.bincount(indexes, minlength=n)
+        assert np.all(counts >= np.floor(n * weights))
+
+
+@pytest.mark.parametrize('scheme', sorted(resampling.schemes))
+def test_minimise_copies(scheme):
+    """
+    Test that minimise_copies keeps the same particles, with every
+    survivor in its own place.
+    """
+    weights = set_up_weights()
+    indexes = resampling.resample(weights, scheme, np.random.default_rng(4))
+    kept = resampling.minimise_copies(indexes)
+    assert np.array_equal(np.sort(kept), np.sort(indexes))
+    survivors = np.unique(indexes)
+    assert np.array_equal(kept[survivors], survivors)
+    # Only the places of the particles that died get copies
+    copied = np.flatnonzero(kept != np.arange(len(kept)))
+    assert len(copied) == len(kept) - len(survivors)
+
+
+@pytest.mark.parametrize('number_of_shards', [1, 3, 8])
+def test_balance_copies(number_of_shards):
+    """
+    Test that balance_copies keeps the same particles in the same places
+    and moves the fewest copies between shards.
+    """
+    weights = set_up_weights()
+    indexes = resampling.minimise_copies(
+        resampling.resample(weights, 'systematic', np.random.default_rng(4)))
+    shard_of = np.repeat(np.arange(number_of_shards),
+                         -(-len(indexes) // number_of_shards))[:len(indexes)]
+    balanced = resampling.balance_copies(indexes, shard_of)
+    assert np.array_equal(np.sort(balanced), np.sort(indexes))
+    survivors = np.unique(indexes)
+    assert np.array_equal(balanced[survivors], survivors)
+
+    targets = np.flatnonzero(balanced != np.arange(len(balanced)))
+    moved = np.sum(shard_of[targets] != shard_of[balanced[targets]])
+    places = np.bincount(shard_of[targets], minlength=number_of_shards)
+    copies = np.bincount(shard_of[indexes[targets]],
+                         minlength=number_of_shards)
+    assert moved == np.sum(np.maximum(copies - places, 0))
+
+
+def test_effective_sample_size():
+    """
+    Test the effective sample size from log weights, including weights
+    whose exponentials would underflow.
+    """
+    weights = set_up_weights()
+    weights = weights[weights > 0] / np.sum(weights)
+    log_weights = np.log(weights) - 1000
+    assert np.allclose(np.exp(resampling.log_normalise(log_weights)),
+                       weights)
+    assert np.isclose(resampling.effective_sample_size(log_weights),
+                      1 / np.sum(weights ** 2))
+    assert np.isclose(resampling.effective_sample_size(np.zeros(10)), 10)
+    assert np.isclose(resampling.effective_sample_size([0, -1e4, -1e4]), 1)
+
+
+def test_resample_unknown_scheme():
+    with pytest.raises(ValueError):
+        resampling.resample(set_up_weights(), 'bootstrap')
@@ -2,10 +2,14 @@
 from generate_data.stationsim_gcs_model_data import *
 from math import floor
 import numpy as np
+import os
 import pytest
+import tarfile
+from scipy.spatial import cKDTree
 import sys
 sys.path.append('../stationsim')
-from stationsim_gcs_model import Agent
+from stationsim_gcs_model import Agent, Model, ModelEnsemble, TrajectoryFile
+from gct_observations import ObservationStore
 
 
 # Data
@@ -19,6 +23,8 @@ gate_location_data = get_gate_location_data()
 
 distance_data = get_distance_data()
 
+collision_data = get_collision_data()
+
 
 # Helper functions
 def __is_valid_location(agent_location, upper, lower, side):
@@ -191,7 +197,7 @@ def test_clock_setup():
     # Stationary
     speed = model.clock.speed == 0
     # Location
-    location = model.clock.location == [370, 275]
+    location = np.array_equal(model.clock.location, [370, 275])
     # isAgent
     cl = isinstance(model.clock, Agent)
     assert all([size, speed, location, cl])
@@ -350,6 +356,502 @@ def test_model_speed_defaults():
     assert model.speed_steps == 3
 
 
+@pytest.mark.parametrize('population_size, seed', collision_data)
+def test_collision_table(population_size, seed):
+    """
+    Test Model.get_collisionTable().
+
+    Test that the vectorized collision table gives the same time of next
+    collision and the same set of agents to wiggle as the agent by agent
+    version.
+
+    Parameters
+    ----------
+    population_size : int
+        The number of active agents in the model.
+    seed : int
+        The random seed used to place the agents.
+    """
+    model = set_up_active_model(population_size, seed)
+    table, tmin = model.get_collisionTable()
+    expected_table, expected_tmin = model.get_collisionTable_pairwise()
+
+    assert tmin == pytest.approx(expected_tmin)
+    assert len(table) == len(expected_table)
+    wiggle = model.get_wiggleTable(table, tmin * 0.98)
+    expected_wiggle = model.get_wiggleTable(expected_table,
+                                            expected_tmin * 0.98)
+    assert wiggle == expected_wiggle
+
+
+@pytest.mark.parametrize('population_size, seed', collision_data)
+def test_collision_table_cell_list(population_size, seed):
+    """
+    Test Model.get_collisionTable() with the cell list broad phase.
+
+    Test that the cell list finds every pair of agents that are close enough
+    to collide within one step, and that the collision table built from it
+    gives the same tmin and set of agents to wiggle as the all-pairs table.
+
+    Parameters
+    ----------
+    population_size : int
+        The number of active agents in the model.
+    seed : int
+        The random seed used to place the agents.
+    """
+    model = set_up_active_model(population_size, seed)
+    _, loc, _, _ = model.get_active_arrays()
+    cutoff = 40
+    i, j = model.get_neighbourPairs(loc, cutoff)
+    pairs = set(zip(np.minimum(i, j).tolist(), np.maximum(i, j).tolist()))
+    assert len(pairs) == len(i)
+    for a in range(len(loc)):
+        for b in range(a + 1, len(loc)):
+            if Agent.distance(loc[a], loc[b]) < cutoff:
+                assert (a, b) in pairs
+
+    table, tmin = model.get_collisionTable(1.0)
+    model.do_cell_list = True
+    cell_table, cell_tmin = model.get_collisionTable(1.0)
+    if tmin <= 1.0:
+        assert cell_tmin == tmin
+        assert (model.get_wiggleTable(cell_table, cell_tmin * 0.98) ==
+                model.get_wiggleTable(table, tmin * 0.98))
+    else:
+        assert cell_tmin > 1.0
+
+
+def test_cell_list_trajectory():
+    """
+    Test that a model with the cell list broad phase follows exactly the
+    same trajectory as with all the pairs, as the wiggling agents are
+    placed in the same order whatever the order of the pairs.
+    """
+    states = []
+    for cell_list in (False, True):
+        model = Model(pop_total=150, station='Grand_Central', random_seed=1,
+                      birth_rate=2, do_print=False, do_history=False,
+                      do_cell_list=cell_list)
+        for _ in range(1500):
+            model.step()
+        states.append(model.get_state(sensor='location'))
+    assert np.array_equal(states[0], states[1])
+
+
+@pytest.mark.parametrize('population_size, seed', collision_data)
+def test_collision_queue(population_size, seed):
+    """
+    Test CollisionQueue.
+
+    Test that the collision event queue gives the same time of next collision
+    and the same set of agents to wiggle as the collision table, both when it
+    is built and after the wiggling agents have been updated.
+
+    Parameters
+    ----------
+    population_size : int
+        The number of active agents in the model.
+    seed : int
+        The random seed used to place the agents.
+    """
+    model = set_up_active_model(population_size, seed)
+    queue = model.collision_queue
+    queue.rebuild(1.0)
+
+    table, tmin = model.get_collisionTable()
+    assert queue.get_tmin() == pytest.approx(tmin) or tmin > 1.0
+    if tmin > 1.0:
+        return
+
+    time = tmin * 0.98
+    wiggle = queue.pop_wiggles(time)
+    assert wiggle == model.get_wiggleTable(table, time)
+
+    [agent.step(time) for agent in model.agents]
+    [model.agents[i].set_wiggle() for i in wiggle]
+    model.total_time += time
+    queue.update(wiggle, 1.0 - time)
+
+    table, tmin = model.get_collisionTable()
+    if tmin <= 1.0 - time:
+        assert queue.get_tmin() == pytest.approx(tmin)
+    else:
+        assert queue.get_tmin() > 1.0 - time
+
+
+@pytest.mark.parametrize('population_size, seed', [(60, 1), (100, 2)])
+def test_collision_queue_steps(population_size, seed):
+    """
+    Test that a model stepped with the collision queue stays within
+    floating-point error of the same model stepped with the collision
+    table, step by step, for some hundreds of steps.
+
+    Parameters
+    ----------
+    population_size : int
+        The number of agents in the model.
+    seed : int
+        The random seed of the model.
+    """
+    models = [Model(pop_total=population_size, station='Grand_Central',
+                    random_seed=seed, birth_rate=2, do_print=False,
+                    do_history=False, do_event_queue=event_queue)
+              for event_queue in (False, True)]
+    for _ in range(400):
+        for model in models:
+            model.step()
+        np.testing.assert_allclose(models[1].get_state(sensor='location'),
+                                   models[0].get_state(sensor='location'),
+                                   rtol=0, atol=1e-6)
+        assert np.array_equal(models[1].agents_status, models[0].agents_status)
+
+
+def test_model_random_generator():
+    """
+    Test the random number generator of the model.
+
+    Test that two models with the same seed give the same locations, even if
+    the global numpy random state and the other model are used in between,
+    and that the spawned seeds are the same on every call and give
+    different locations.
+    """
+    model_params = {'pop_total': 20, 'station': 'Grand_Central',
+                    'random_seed': 11, 'birth_rate': 2, 'do_print': False}
+    model1 = Model(**model_params)
+    model2 = Model(**model_params)
+    for _ in range(40):
+        model1.step()
+        np.random.seed(0)
+        np.random.uniform()
+    for _ in range(40):
+        model2.step()
+    assert np.array_equal(model1.get_state(sensor='location'),
+                          model2.get_state(sensor='location'))
+
+    seeds = model1.spawn_random_seeds(2)
+    assert [s.entropy for s in seeds] == [11, 11]
+    # Spawning again gives the same children
+    again = model1.spawn_random_seeds(2)
+    assert [s.spawn_key for s in again] == [s.spawn_key for s in seeds]
+    assert np.array_equal(again[1].generate_state(4),
+                          seeds[1].generate_state(4))
+    model1.set_random_seed(seeds[0])
+    model2.set_random_seed(seeds[1])
+    for _ in range(40):
+        model1.step()
+        model2.step()
+    assert not np.array_equal(model1.get_state(sensor='location'),
+                              model2.get_state(sensor='location'))
+
+
+@pytest.mark.parametrize('use_directory', [False, True])
+def test_history_recorder(use_directory, tmp_path):
+    """
+    Test HistoryRecorder.
+
+    Test that the recorded history grows past its initial capacity, in memory
+    and in memory-mapped files, that inactive agents are NaN, and that the
+    agent and model views of the history agree with the recorder.
+
+    Parameters
+    ----------
+    use_directory : bool
+        Whether the history is kept in memory-mapped files.
+    tmp_path : pathlib.Path
+        Temporary directory provided by pytest.
+    """
+    directory = str(tmp_path) if use_directory else None
+    model = Model(pop_total=10, station='Grand_Central', random_seed=3,
+                  birth_rate=2, do_print=False, history_dir=directory)
+    for _ in range(100):
+        model.step()
+
+    recorder = model.recorder
+    locations = recorder.get_locations()
+    assert locations.shape == (100, 10, 2)
+    assert np.array_equal(np.isnan(locations[:, :, 0]), ~recorder.active)
+    assert np.array_equal(locations[-1][recorder.active[-1]],
+                          model.agents_location[:10][recorder.active[-1]])
+    assert model.history_state[-1] == model.get_state('location2D')
+    for agent in model.agents:
+        expected = [(None, None) if np.isnan(x) else (x, y)
+                    for x, y in locations[:, agent.unique_id]]
+        assert agent.history_locations == expected
+    assert len(model.history_wiggle_locs) == sum(agent.history_wiggles for
+                                                 agent in model.agents)
+    if use_directory:
+        saved = np.load(tmp_path / 'locations.npy', mmap_mode='r')
+        assert np.array_equal(saved[:100], recorder.locations)
+
+
+def test_model_copy_history_dir(tmp_path):
+    """
+    Test that copying a model that keeps its history in memory-mapped
+    files does not touch the files, and that the copy keeps its own
+    history in memory.
+    """
+    model = Model(pop_total=20, station='Grand_Central', random_seed=3,
+                  birth_rate=2, do_print=False, history_dir=str(tmp_path))
+    for _ in range(80):
+        model.step()
+    locations = model.recorder.get_locations()
+    files = sorted(os.listdir(tmp_path))
+
+    copy = model.copy()
+    assert copy.history_dir is None
+    assert copy.recorder.directory is None
+    assert sorted(os.listdir(tmp_path)) == files
+    np.testing.assert_array_equal(model.recorder.get_locations(), locations)
+    saved = np.load(tmp_path / 'locations.npy', mmap_mode='r')
+    np.testing.assert_array_equal(saved[:80], model.recorder.locations)
+
+    copy.step()
+    model.step()
+    np.testing.assert_array_equal(model.recorder.get_locations()[:80],
+                                  locations)
+
+
+def test_activation_queue():
+    """
+    Test the activation queue and Model.fast_forward.
+
+    Test that the agents are queued by activation time, that the idle
+    steps before the first activation are skipped with the same clock as
+    Model.step, and that agents are activated when they are due.
+    """
+    model = Model(pop_total=5, station='Grand_Central', random_seed=1,
+                  do_print=False)
+    for agent, time in zip(model.agents, [30, 10, 12.5, 50, 20]):
+        agent.steps_activate = time
+    queue, times = model.get_activation_queue()
+    assert list(queue) == [1, 2, 4, 0, 3]
+    assert list(times) == [10, 12.5, 20, 30, 50]
+
+    assert model.fast_forward() == 11
+    assert (model.step_id, model.total_time) == (11, 11.0)
+    assert len(model.recorder.locations) == 11
+    assert model.fast_forward() == 0
+    model.step()
+    assert list(model.agents_status[:5]) == [0, 1, 0, 0, 0]
+    model.step()
+    model.step()
+    assert list(model.agents_status[:5]) == [0, 1, 1, 0, 0]
+    assert model.fast_forward() == 0
+
+    # Changing an activation time rebuilds the queue
+    model.agents[3].steps_activate = 0
+    model.step()
+    assert model.agents_status[3] == 1
+
+
+def test_trajectory_file(tmp_path, monkeypatch):
+    """
+    Test the binary trajectory export of Model.get_data.
+
+    Test that TrajectoryFile reads back the locations recorded by the model,
+    frame by frame and agent by agent, with the status of every agent.
+    """
+    monkeypatch.chdir(tmp_path)
+    model = Model(pop_total=10, station='Grand_Central', random_seed=5,
+                  birth_rate=2, do_print=False)
+    for _ in range(200):
+        model.step()
+    trajectories = model.get_data('test', sensor='trajectories')
+    assert isinstance(trajectories, TrajectoryFile)
+    assert (tmp_path / 'trajectories_test' / 'trajectories.npy').exists()
+
+    locations = model.recorder.get_locations()
+    # assert_array_equal treats the NaNs of inactive agents as equal
+    np.testing.assert_array_equal(trajectories.get_locations(), locations)
+    status = trajectories.get_status()
+    assert np.array_equal(status == 1, model.recorder.active)
+    assert np.array_equal(status[-1] == 2, model.agents_status[:10] == 2)
+    assert np.all(np.diff(status, axis=0) >= 0)
+
+    frame = trajectories.get_frame(100)
+    assert np.all(frame['frame'] == 100)
+    assert np.array_equal(frame['agent_id'],
+                          np.flatnonzero(model.recorder.active[100]))
+    trail = trajectories.get_trail(3)
+    assert np.array_equal(trail, locations[:, 3][model.recorder.active[:, 3]])
+
+
+@pytest.mark.parametrize('packed', [False, True])
+def test_observation_store(packed, tmp_path):
+    """
+    Test ObservationStore.
+
+    Test that the GCT frames are ingested, from frame files or from
+    frames.tar.gz, including frames with one pedestrian or none, that
+    update_model sets the agents as the old text loop did, and that the
+    store is built again when the data changes.
+    """
+    frames = {0: '', 1: '1 10.0 20.0\n', 2: '0 5.0 6.0\n1 11.0 21.0\n',
+              3: '0 5.5 6.5\n'}
+    source = tmp_path / 'frames'
+    source.mkdir()
+    for frame, text in frames.items():
+        (source / f'frame_{frame}.0.dat').write_text(
+            '# pedestrianID x y\n' + text)
+    directory = tmp_path / 'data'
+    directory.mkdir()
+    (directory / 'activation.dat').write_text(
+        '# pedestrianID time_activation gate_in gate_out speed\n'
+        '0 2.0 1 2 1.5\n1 1.0 3 4 1.2\n')
+    if packed:
+        with tarfile.open(directory / 'frames.tar.gz', 'w:gz') as tar:
+            tar.add(source, arcname='frames')
+    else:
+        directory = source
+        (source / 'activation.dat').write_text(
+            (tmp_path / 'data' / 'activation.dat').read_text())
+
+    store = ObservationStore.open(str(directory))
+    assert (directory / 'trajectories.npy').exists()
+    assert (store.n_frames, store.pop_total) == (4, 2)
+    assert np.array_equal(store.activation[:, 1], [2.0, 1.0])
+
+    model = Model(pop_total=3, station='Grand_Central', do_print=False)
+    expected_status = {0: [0, 0, 0], 1: [0, 1, 0], 2: [1, 1, 0],
+                       3: [1, 2, 0], 4: [2, 2, 2]}
+    for frame, status in expected_status.items():
+        store.update_model(model, frame)
+        assert list(model.agents_status[:3]) == status
+    assert np.array_equal(model.agents_location[0], [5.5, 6.5])
+    assert np.array_equal(model.agents_location[1], [11.0, 21.0])
+
+    # The store is built again when the data is newer than it
+    assert not ObservationStore.is_stale(str(directory))
+    for name in ('trajectories.npy', 'activation.npy'):
+        earlier = os.path.getmtime(directory / name) - 10
+        os.utime(directory / name, (earlier, earlier))
+    (directory / 'activation.dat').write_text(
+        '# pedestrianID time_activation gate_in gate_out speed\n'
+        '0 3.0 1 2 1.5\n1 1.0 3 4 1.2\n')
+    assert ObservationStore.is_stale(str(directory))
+    store = ObservationStore.open(str(directory))
+    assert np.array_equal(store.activation[:, 1], [3.0, 1.0])
+    assert not ObservationStore.is_stale(str(directory))
+
+
+def test_model_snapshot():
+    """
+    Test Model.snapshot and Model.restore.
+
+    Test that a model restored from a snapshot, and a copy of the model that
+    loads the snapshot, continue exactly as the model did after the
+    snapshot was taken, and that the history is cut back.
+    """
+    model_params = {'pop_total': 20, 'station': 'Grand_Central',
+                    'random_seed': 5, 'birth_rate': 2, 'do_print': False}
+    model = Model(**model_params)
+    for _ in range(60):
+        model.step()
+    snapshot = model.snapshot()
+    for _ in range(60):
+        model.step()
+    expected = model.get_state(sensor='location')
+
+    model.restore(snapshot)
+    assert model.step_id == 60
+    assert len(model.history_state) == 60
+    copy = Model(**model_params)
+    copy.restore(snapshot)
+    for _ in range(60):
+        model.step()
+        copy.step()
+    assert np.array_equal(model.get_state(sensor='location'), expected)
+    assert np.array_equal(copy.get_state(sensor='location'), expected)
+    assert copy.pop_finished == model.pop_finished
+
+
+@pytest.mark.parametrize('cell_list', [False, True])
+def test_model_ensemble(cell_list):
+    """
+    Test ModelEnsemble.
+
+    Test that stepping the replicas of a model together gives the same
+    locations as stepping a copy of the model alone with the same seed.
+
+    Parameters
+    ----------
+    cell_list : bool
+        Whether the models use the cell list broad phase.
+    """
+    seeds = [3, 5, 8, 13]
+    models = []
+    for _ in seeds:
+        model = Model(pop_total=30, station='Grand_Central', random_seed=1,
+                      birth_rate=2, do_print=False, do_cell_list=cell_list)
+        models.append(model)
+
+    ensemble = ModelEnsemble(models, seeds)
+    ensemble.step(60)
+
+    for seed, replica in zip(seeds, models):
+        model = Model(pop_total=30, station='Grand_Central', random_seed=1,
+                      birth_rate=2, do_print=False, do_cell_list=cell_list)
+        model.set_random_seed(seed)
+        for _ in range(60):
+            model.step()
+        assert np.array_equal(model.get_state(sensor='location'),
+                              replica.get_state(sensor='location'))
+        assert model.pop_active == replica.pop_active
+
+    states = ensemble.get_state()
+    assert states.shape == (len(seeds), 60)
+    assert not np.array_equal(states[0], states[1])
+
+
+@pytest.mark.parametrize('population_size, seed', get_collision_data())
+def test_spatial_index(population_size, seed):
+    """
+    Test SpatialIndex.
+
+    Test that the neighbours found with the spatial index of the model are
+    the same as with a new KD-tree, after some agents have been placed at
+    new locations.
+
+    Parameters
+    ----------
+    population_size : int
+        The number of active agents in the model.
+    seed : int
+        The random seed used to place the agents.
+    """
+    model = set_up_active_model(population_size, seed)
+    index = model.spatial_index
+    points = model.rng.uniform((0, 0), (model.width, model.height), (20, 2))
+    index.query(points, 50)
+
+    for i in range(0, population_size, 3):
+        model.agents[i].location = points[i % 20]
+    tree = cKDTree(model.agents_location[:population_size])
+    neighbours = index.query(points, 50)
+    expected = tree.query_ball_point(points, 50)
+    for found, nearby in zip(neighbours, expected):
+        assert sorted(found) == sorted(nearby)
+
+
+def test_spatial_index_place_after_invalidate():
+    """
+    Test that SpatialIndex.place sees the agents it placed itself after the
+    tree was invalidated while agents were listed as moved.
+    """
+    model = set_up_active_model(10, 3)
+    index = model.spatial_index
+    index.query(model.agents_location[:10], 1.0)
+    for agent in model.agents[:5]:
+        agent.location = agent.location + 0.5
+    index.invalidate()
+
+    point = np.array([[300.0, 300.0], [300.0, 300.0]])
+    model.agents_location[:10] = np.arange(20).reshape(10, 2) * 20 + 100
+    placed = index.place([8, 9], point, np.array([5.0, 5.0]))
+    assert list(placed) == [True, False]
+
+
 # Agent tests
 def test_speed_allocation():
     """
@@ -380,6 +882,40 @@ def test_speed_allocation():
     assert proportion > 0.68
 
 
+def test_population_generation():
+    """
+    Test Model.init_population.
+
+    Test that the gates, destinations and speeds drawn for the whole
+    population at once follow the rules of the Grand Central station, and
+    that Model.copy gives a model with the same population.
+    """
+    model = Model(pop_total=2000, station='Grand_Central', random_seed=4,
+                  do_print=False)
+    gate_sides = np.array([0, 1, 1, 2, 2, 2, 2, 3, 3, 3, 3])
+    n = model.pop_total
+    gates_in, gates_out = model.agents_gate_in[:n], model.agents_gate_out[:n]
+    assert np.all(gate_sides[gates_in] != gate_sides[gates_out])
+    assert set(gates_in) == set(range(model.gates_in))
+
+    # Destinations are in front of the exit gates
+    offset = model.agents_loc_desire[:n] - model.gates_locations[gates_out]
+    width = np.asarray(model.gates_width)[gates_out] / 2
+    assert np.all(np.isclose(np.abs(offset), 1.05 * model.agent_size).any(1))
+    assert np.all((np.abs(offset) <= width[:, None]).any(1))
+
+    assert np.all(model.agents_speed_max[:n] > model.speed_min)
+    for agent in model.agents[:100]:
+        assert agent.speed in agent.speeds
+        assert agent.speeds[0] == agent.speed_max
+
+    copy = model.copy()
+    assert copy.rng.bit_generator.state == model.rng.bit_generator.state
+    for name in ('agents_gate_out', 'agents_loc_desire', 'agents_speed',
+                 'agents_speed_max', 'agents_steps_activate'):
+        assert np.array_equal(getattr(copy, name), getattr(model, name))
+
+
 @pytest.mark.parametrize('location1, location2, distance', distance_data)
 def test_distance_calculation(location1, location2, distance):
     """
@@ -488,5 +1024,34 @@ def test_set_agent_location():
     assert all(results)
 
 
-def test_set_wiggle():
-    pass
+@pytest.mark.parametrize('population_size, seed', get_collision_data())
+def test_set_wiggle(population_size, seed):
+    """
+    Test Model.set_wiggles.
+
+    Test that the agents that found a new location are not within 1.1 sizes
+    of any other agent nor on the clock, and that the other agents did not
+    move.
+
+    Parameters
+    ----------
+    population_size : int
+        The number of active agents in the model.
+    seed : int
+        The random seed used to place the agents.
+    """
+    model = set_up_active_model(population_size, seed)
+    before = model.agents_location[:population_size].copy()
+    wiggle = list(range(0, population_size, 2))
+    model.set_wiggles(wiggle)
+
+    after = model.agents_location[:population_size]
+    moved = np.flatnonzero(np.any(after != before, axis=1))
+    assert set(moved) <= set(wiggle)
+    for i in moved:
+        agent = model.agents[i]
+        distance = np.linalg.norm(after - after[i], axis=1)
+        distance[i] = np.inf
+        assert np.all(distance > agent.size * 1.1)
+        assert (np.linalg.norm(after[i] - model.clock.location) >
+                agent.size + model.clock.size)
@@ -0,0 +1,90 @@
+# Imports
+import numpy as np
+import pytest
+import sys
+sys.path.append('../stationsim/')
+
+from resampling import effective_sample_size, log_normalise, systematic
+from tempering import (conditional_ess, next_temperature, metropolis_accept,
+                       AdaptiveTempering)
+
+
+# Helpers
+def set_up_log_likelihood(number_of_particles=200, scale=50., seed=1):
+    rng = np.random.default_rng(seed)
+    return -0.5 * scale * rng.normal(size=number_of_particles) ** 2
+
+
+# Tests
+def test_conditional_ess():
+    """
+    Test that the conditional ESS of uniform weights is the ESS of the
+    increment, and that it does not depend on a constant in the increment.
+    """
+    log_increment = set_up_log_likelihood()
+    log_weights = np.full(len(log_increment), -np.log(len(log_increment)))
+    assert np.isclose(conditional_ess(log_weights, log_increment),
+                      effective_sample_size(log_normalise(log_increment)))
+    assert np.isclose(conditional_ess(log_weights, log_increment + 1000),
+                      conditional_ess(log_weights, log_increment))
+
+
+@pytest.mark.parametrize('target_ess', [0.3, 0.5, 0.9])
+def test_next_temperature(target_ess):
+    """
+    Test that the bisection hits the target conditional ESS, and that an
+    easy observation goes straight to temperature 1.
+    """
+    log_likelihood = set_up_log_likelihood()
+    log_weights = np.full(len(log_likelihood), -np.log(len(log_likelihood)))
+    temperature = next_temperature(log_weights, log_likelihood, 0.,
+                                   target_ess)
+    assert 0 < temperature < 1
+    assert np.isclose(conditional_ess(log_weights,
+                                      temperature * log_likelihood),
+                      target_ess * len(log_likelihood), rtol=1e-3)
+    assert next_temperature(log_weights, log_likelihood / 1e6) == 1
+
+
+def test_metropolis_accept():
+    """
+    Test that better proposals are always accepted, and worse ones less
+    often at higher temperatures.
+    """
+    rng = np.random.default_rng(1)
+    log_likelihood = np.zeros(10000)
+    assert np.all(metropolis_accept(log_likelihood, log_likelihood + 1, 1.,
+                                    rng))
+    rates = [np.mean(metropolis_accept(log_likelihood, log_likelihood - 1,
+                                       temperature, rng))
+             for temperature in (0.5, 1.)]
+    assert np.allclose(rates, np.exp([-0.5, -1]), atol=0.02)
+
+
+@pytest.mark.parametrize('scale, many_stages', [(1e-3, False), (100., True)])
+def test_adaptive_tempering(scale, many_stages):
+    """
+    Test that a harder observation takes more stages, that the moves stop
+    when a round stops moving new particles, and that the particles end
+    with uniform weights.
+    """
+    rng = np.random.default_rng(1)
+    log_likelihood = set_up_log_likelihood(scale=scale)
+
+    def resample(weights):
+        return systematic(weights, rng)
+
+    def move(temperature, log_likelihood):
+        # The same half of the particles move in every round, so the second
+        # round of a stage moves no new ones
+        accept = np.arange(len(log_likelihood)) % 2 == 0
+        return accept, log_likelihood
+
+    tempering = AdaptiveTempering(target_ess=0.5)
+    log_weights = tempering.temper(log_likelihood, resample, move)
+    temperatures = tempering.temperatures[-1]
+    assert (len(temperatures) > 1) == many_stages
+    assert temperatures[-1] == 1 and np.all(np.diff(temperatures) > 0)
+    assert tempering.moves == [2 * len(temperatures)]
+    assert tempering.acceptance == [0.5]
+    assert np.allclose(np.exp(log_weights), 1 / len(log_likelihood))